@@ -0,0 +1,450 @@
+import os, sys
+import argparse
+import json
+import shlex
+import shutil
+import subprocess
+import time
+import numpy as np
+
+import equivalence_RIFTEHR
+import run_RIFTEHR
+import synthetic_ehr
+
+
+"""
+Benchmarks the stages of RIFTEHR on synthetic data of increasing size.
+
+The whole pipeline is run once per size on inputs from synthetic_ehr.py,
+with --checkpoint, then each stage is run on its own in its own process
+with --from_stage and --to_stage, on the checkpointed results of the stages
+before it.  A stage's process so holds only the inputs of that stage, and
+a failure at one size does not stop the others.  Each stage, and the
+functions within it, is measured by the pipeline, which writes the wall
+time, CPU time and memory to run_metrics.json.  The memory of a step is
+what it adds to the process at its peak, or the peak of its worker
+processes if larger.  From these the throughput of each step is
+calculated at every size and a scaling exponent fitted across sizes, then
+compared against a stored baseline.
+"""
+
+
+BENCHMARK_VERSION = 2
+DEFAULT_SIZES = '10k,100k,1M,10M'
+SIZE_SUFFIXES = {'k': 1000, 'm': 1000000}
+
+# Steps left out of the regression gates, inference rounds differ with the
+# data rather than the code
+UNGATED_STEPS = ['/round ']
+
+
+def parse_size(a_str):
+    """Parses a number of patients like 10000, 10k or 1M"""
+
+    a_str = a_str.strip().lower()
+    if a_str[-1:] in SIZE_SUFFIXES:
+        return int(float(a_str[:-1]) * SIZE_SUFFIXES[a_str[-1]])
+    return int(a_str)
+
+
+def benchmark_data(data_dir, patients, seed):
+    """
+    Generates the synthetic inputs of a size, once.  Files are generated in a
+    temporary directory that replaces the final one when complete.
+
+    Args:
+        data_dir (str): Directory the inputs of every size are kept in
+        patients (int): Number of patients
+        seed (int): Seed of the synthetic data
+
+    Returns:
+        str: Directory of the inputs
+    """
+
+    size_dir = data_dir + os.sep + 'patients_' + str(patients) + '_seed_' + str(seed)
+    if os.path.isdir(size_dir):
+        return size_dir
+
+    print("Generating " + str(patients) + " patients")
+    shutil.rmtree(size_dir + '.tmp', ignore_errors=True)
+    synthetic_ehr.generate(patients, size_dir + '.tmp', seed)
+    os.replace(size_dir + '.tmp', size_dir)
+
+    return size_dir
+
+
+def run_command(size_dir, out_dir, run_args):
+    """
+    Runs RIFTEHR on the inputs of a size in its own process.
+
+    Args:
+        size_dir (str): Directory of the inputs
+        out_dir (str): Output directory of the run, created if needed
+        run_args (list): Extra arguments for run_RIFTEHR.py
+
+    Returns:
+        bool: Whether the run succeeded
+    """
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    command = [sys.executable, os.path.dirname(os.path.abspath(__file__)) + os.sep + 'run_RIFTEHR.py',
+               '--pt_file', size_dir + os.sep + 'pt_file.tsv',
+               '--ec_file', size_dir + os.sep + 'ec_file.tsv',
+               '--dg_file', size_dir + os.sep + 'pt_demog.tsv',
+               '--mc_link', size_dir + os.sep + 'mc_file.tsv',
+               '--of_link', size_dir + os.sep + 'of_file.tsv',
+               '--out_dir', out_dir] + run_args
+
+    with open(out_dir + os.sep + 'run.log', 'wt') as log:
+        completed = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT)
+    if completed.returncode != 0:
+        print("\tRun failed, see " + out_dir + os.sep + 'run.log')
+
+    return completed.returncode == 0
+
+
+def checkpoint_size(size_dir, out_dir, run_args):
+    """
+    Runs the whole pipeline on the inputs of a size with --checkpoint, for
+    the stages to be run on their own from.
+
+    Returns:
+        bool: Whether the run succeeded
+    """
+
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+    return run_command(size_dir, out_dir, run_args + ['--checkpoint'])
+
+
+def run_stages(size_dir, checkpoint_dir, out_dir, run_args):
+    """
+    Runs each stage on its own, in its own process, on the checkpointed
+    results of the stages before it.  A stage's process holds only what the
+    stage needs, so its memory is not inflated by the data earlier stages
+    leave behind in a whole run.
+
+    Args:
+        size_dir (str): Directory of the inputs
+        checkpoint_dir (str): Output directory of checkpoint_size()
+        out_dir (str): Directory of the output directory of each stage
+        run_args (list): Extra arguments for run_RIFTEHR.py
+
+    Returns:
+        list: Steps of the stages' run_metrics.json, None if a run failed
+    """
+
+    steps = list()
+    for stage in run_RIFTEHR.STAGE_NAMES:
+        stage_dir = out_dir + os.sep + stage
+        equivalence_RIFTEHR.prepare_stage_dir(checkpoint_dir, stage_dir, stage)
+        if not run_command(size_dir, stage_dir, run_args + ['--from_stage', stage, '--to_stage', stage]):
+            return None
+        if equivalence_RIFTEHR.stages_run(stage_dir) != [stage]:
+            print("\tRan stages " + ', '.join(equivalence_RIFTEHR.stages_run(stage_dir)) + " rather than " + stage + " alone, see " + stage_dir)
+            return None
+
+        with open(stage_dir + os.sep + 'run_metrics.json', 'rt') as infile:
+            steps += [x for x in json.load(infile)['steps'] if x['step'] == stage or x['step'].startswith(stage + '/')]
+
+    return steps
+
+
+def summarize_steps(steps, patients):
+    """
+    Metrics of each step measured in a run.
+
+    Args:
+        steps (list): Steps of run_metrics.json
+        patients (int): Number of patients of the run
+
+    Returns:
+        dict: wall_seconds, cpu_seconds, peak_rss_bytes, memory_bytes,
+              rows_in and patients_per_second by step name
+    """
+
+    summary = dict()
+    for step in steps:
+        if step.get('skipped'):
+            continue
+        wall_seconds = step['wall_seconds']
+        summary[step['step']] = {
+            'wall_seconds': wall_seconds,
+            'cpu_seconds': step['cpu_seconds'] + step['child_cpu_seconds'],
+            'peak_rss_bytes': step['peak_rss_bytes'],
+            'memory_bytes': step_memory(step),
+            'rows_in': sum(step['rows_in'].values()),
+            'patients_per_second': patients / wall_seconds if wall_seconds > 0 else None,
+        }
+
+    return summary
+
+
+def step_memory(step):
+    """
+    Memory a step needed, the growth of the process at its peak or the peak
+    of its largest worker process.  None if neither is known.
+    """
+
+    memory = [x for x in [step['rss_growth_bytes'], step['child_peak_rss_bytes']] if x is not None]
+
+    return max(memory) if memory else None
+
+
+def fastest_runs(summaries):
+    """
+    Combines the step summaries of repeated runs of a size, keeping the
+    fastest run of each step.  Slower runs mostly measure other load on the
+    machine.
+    """
+
+    fastest = dict()
+    for summary in summaries:
+        for name, metric in summary.items():
+            if name not in fastest or metric['wall_seconds'] < fastest[name]['wall_seconds']:
+                fastest[name] = metric
+
+    return fastest
+
+
+def scaling_exponents(sizes):
+    """
+    Fits the exponent b of metric = a * patients ** b for the wall time and
+    memory of each step measured at two or more sizes.  1 is linear,
+    2 quadratic.
+
+    Args:
+        sizes (dict): Step summaries by number of patients
+
+    Returns:
+        dict: time and memory exponents by step name, None where there are
+              not two sizes to fit
+    """
+
+    exponents = dict()
+    step_names = sorted(set(name for summary in sizes.values() for name in summary))
+    for name in step_names:
+        exponents[name] = dict()
+        for exponent, metric in [('time', 'wall_seconds'), ('memory', 'memory_bytes')]:
+            points = [(int(patients), summary[name][metric]) for patients, summary in sizes.items() if name in summary and summary[name][metric]]
+            if len(set(x for x, y in points)) < 2:
+                exponents[name][exponent] = None
+                continue
+            x, y = np.log(np.array(points, dtype=float)).T
+            exponents[name][exponent] = float(np.polyfit(x, y, 1)[0])
+
+    return exponents
+
+
+def gated(step_name):
+    """Whether a step is checked for regressions"""
+
+    return not any(x in step_name for x in UNGATED_STEPS)
+
+
+def largest_size_seconds(results, step_name):
+    """Wall time of a step at the largest size it was measured at, 0 if never"""
+
+    sizes = [int(x) for x, summary in results['sizes'].items() if step_name in summary and x not in results['failed']]
+    if not sizes:
+        return 0
+
+    return results['sizes'][str(max(sizes))][step_name]['wall_seconds']
+
+
+def find_regressions(results, baseline, max_slowdown, max_memory_growth, max_exponent_increase, min_seconds, min_memory_bytes):
+    """
+    Compares a benchmark against a baseline.
+
+    Args:
+        results (dict): Benchmark results
+        baseline (dict): Earlier benchmark results
+        max_slowdown (float): Largest allowed ratio of wall times
+        max_memory_growth (float): Largest allowed ratio of step memory
+        max_exponent_increase (float): Largest allowed increase of the time
+            scaling exponent
+        min_seconds (float): Steps faster than this in the baseline are not
+            checked for slowdowns, their times are mostly noise.  Nor is the
+            scaling of steps faster than this at the largest baseline size
+        min_memory_bytes (int): Steps needing less memory than this in the
+            baseline are not checked for memory growth, it is mostly noise
+
+    Returns:
+        list: Descriptions of the regressions found
+    """
+
+    regressions = list()
+    for patients, summary in results['sizes'].items():
+        if patients in baseline['failed']:
+            continue
+        if patients in results['failed']:
+            regressions.append(patients + " patients: run failed")
+            continue
+        base_summary = baseline['sizes'].get(patients, dict())
+        for name, metric in sorted(summary.items()):
+            base = base_summary.get(name)
+            if base is None or not gated(name):
+                continue
+            if base['wall_seconds'] >= min_seconds and metric['wall_seconds'] > base['wall_seconds'] * max_slowdown:
+                regressions.append("%s patients %s: %.2fs, baseline %.2fs" % (patients, name, metric['wall_seconds'], base['wall_seconds']))
+            if base.get('memory_bytes') and base['memory_bytes'] >= min_memory_bytes and metric['memory_bytes'] and metric['memory_bytes'] > base['memory_bytes'] * max_memory_growth:
+                regressions.append("%s patients %s: memory %d MB, baseline %d MB" % (patients, name, metric['memory_bytes'] // 2 ** 20, base['memory_bytes'] // 2 ** 20))
+
+    for name, exponents in sorted(results['exponents'].items()):
+        base = baseline['exponents'].get(name)
+        if base is None or not gated(name) or exponents['time'] is None or base['time'] is None:
+            continue
+        if largest_size_seconds(baseline, name) < min_seconds:
+            continue
+        if exponents['time'] > base['time'] + max_exponent_increase:
+            regressions.append("%s: scales as patients^%.2f, baseline patients^%.2f" % (name, exponents['time'], base['time']))
+
+    return regressions
+
+
+def print_report(results):
+    """Prints the wall time, throughput, memory and process peak memory of each step at each size"""
+
+    for patients, summary in results['sizes'].items():
+        print("\n" + patients + " patients")
+        print("\t".join(['step', 'seconds', 'patients/s', 'memory_MB', 'peak_MB']))
+        for name, metric in summary.items():
+            rate = '' if metric['patients_per_second'] is None else '%.0f' % metric['patients_per_second']
+            memory = '' if metric['memory_bytes'] is None else str(metric['memory_bytes'] // 2 ** 20)
+            peak = '' if metric['peak_rss_bytes'] is None else str(metric['peak_rss_bytes'] // 2 ** 20)
+            print("\t".join([name, '%.3f' % metric['wall_seconds'], rate, memory, peak]))
+
+    print("\nScaling exponents")
+    print("\t".join(['step', 'time', 'memory']))
+    for name, exponents in sorted(results['exponents'].items()):
+        print("\t".join([name] + ['' if exponents[x] is None else '%.2f' % exponents[x] for x in ['time', 'memory']]))
+
+
+def parse_arguments():
+    """
+    Parses Command line arguments
+
+    Returns:
+        args: argpase object of input arguemnts
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmarks the stages of RIFTEHR on synthetic data of increasing size')
+
+    parser.add_argument('--sizes', action='store', default=DEFAULT_SIZES,
+                        dest='sizes',
+                        type=str,
+                        help='Comma separated numbers of patients to benchmark, as 10000, 10k or 1M')
+
+    parser.add_argument('--out_dir', action='store', default='benchmark',
+                        dest='out_dir',
+                        type=str,
+                        help='Output Directory for the runs and benchmark.json')
+
+    parser.add_argument('--data_dir', action='store',
+                        dest='data_dir',
+                        type=str,
+                        help='Directory the generated inputs are kept in and reused from.  Defaults to data in the output directory')
+
+    parser.add_argument('--seed', action='store', default=1,
+                        dest='seed',
+                        type=int,
+                        help='Seed of the synthetic data')
+
+    parser.add_argument('--repeats', action='store', default=1,
+                        dest='repeats',
+                        type=int,
+                        help='Runs of each size, the fastest run of each step is kept')
+
+    parser.add_argument('--run_args', action='store', default='',
+                        dest='run_args',
+                        type=str,
+                        help='Extra arguments for run_RIFTEHR.py, as "--match_engine index --workers 4"')
+
+    parser.add_argument('--baseline', action='store',
+                        dest='baseline',
+                        type=str,
+                        help='benchmark.json of an earlier benchmark to check for regressions against')
+
+    parser.add_argument('--save_baseline', action='store',
+                        dest='save_baseline',
+                        type=str,
+                        help='Also save the results to this file, as a baseline for later benchmarks')
+
+    parser.add_argument('--max_slowdown', action='store', default=1.25,
+                        dest='max_slowdown',
+                        type=float,
+                        help='Fail if a step takes longer than this times its baseline')
+
+    parser.add_argument('--max_memory_growth', action='store', default=1.25,
+                        dest='max_memory_growth',
+                        type=float,
+                        help='Fail if the memory of a step is over this times its baseline')
+
+    parser.add_argument('--max_exponent_increase', action='store', default=0.15,
+                        dest='max_exponent_increase',
+                        type=float,
+                        help='Fail if the scaling exponent of a step grows by more than this')
+
+    parser.add_argument('--min_seconds', action='store', default=0.5,
+                        dest='min_seconds',
+                        type=float,
+                        help='Steps faster than this in the baseline are not checked for slowdowns, nor for worse scaling if this fast at the largest size')
+
+    parser.add_argument('--min_memory_mb', action='store', default=16,
+                        dest='min_memory_mb',
+                        type=float,
+                        help='Steps needing less memory than this many megabytes in the baseline are not checked for memory growth')
+
+    return parser.parse_args()
+
+
+def main():
+    cli_args = parse_arguments()
+    print(cli_args)
+
+    sizes = sorted(parse_size(x) for x in cli_args.sizes.split(','))
+    data_dir = cli_args.data_dir or cli_args.out_dir + os.sep + 'data'
+    os.makedirs(data_dir, exist_ok=True)
+
+    results = {'version': BENCHMARK_VERSION, 'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'seed': cli_args.seed, 'repeats': cli_args.repeats, 'run_args': cli_args.run_args, 'sizes': dict(), 'failed': list()}
+    for patients in sizes:
+        size_dir = benchmark_data(data_dir, patients, cli_args.seed)
+        run_dir = cli_args.out_dir + os.sep + 'run_' + str(patients)
+        run_args = shlex.split(cli_args.run_args)
+        summaries = list()
+        print("Checkpointing " + str(patients) + " patients")
+        if not checkpoint_size(size_dir, run_dir + os.sep + 'pipeline', run_args):
+            results['failed'].append(str(patients))
+        for repeat in range(cli_args.repeats if str(patients) not in results['failed'] else 0):
+            print("Running the stages of " + str(patients) + " patients")
+            steps = run_stages(size_dir, run_dir + os.sep + 'pipeline', run_dir + os.sep + 'stages', run_args)
+            if steps is None:
+                results['failed'].append(str(patients))
+                break
+            summaries.append(summarize_steps(steps, patients))
+        results['sizes'][str(patients)] = fastest_runs(summaries)
+    results['exponents'] = scaling_exponents({x: y for x, y in results['sizes'].items() if x not in results['failed']})
+
+    print_report(results)
+    for out_file in [cli_args.out_dir + os.sep + 'benchmark.json', cli_args.save_baseline]:
+        if out_file is not None:
+            with open(out_file, 'wt') as outfile:
+                json.dump(results, outfile, indent=1)
+
+    regressions = list()
+    if cli_args.baseline is not None:
+        with open(cli_args.baseline, 'rt') as infile:
+            baseline = json.load(infile)
+        regressions = find_regressions(results, baseline, cli_args.max_slowdown, cli_args.max_memory_growth, cli_args.max_exponent_increase, cli_args.min_seconds, cli_args.min_memory_mb * 2 ** 20)
+        print("\n" + str(len(regressions)) + " regressions against " + cli_args.baseline)
+        for regression in regressions:
+            print("\t" + regression)
+    elif results['failed']:
+        regressions = results['failed']
+
+    exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,363 @@
+import os, sys
+import argparse
+import collections
+import json
+import pickle
+import shutil
+import subprocess
+
+import run_RIFTEHR
+
+
+"""
+Checks that every implementation of the stages of RIFTEHR reproduces the
+same output files.
+
+The reference implementation is run once through the whole pipeline, with
+the intermediate files and checkpoints of every stage kept, and its files
+are compared against golden outputs, by default those of example_files/.
+Every other implementation then runs each stage on its own, on the
+checkpointed results of the reference's earlier stages, so a difference in
+one stage does not carry over into the files of the stages after it.  Each
+file is compared for the last stage that writes it, against the golden
+outputs or the reference run.  Rows are compared as multisets, so the order
+rows are written in does not matter, but every field of every row does.
+Family ids are arbitrary labels, so families are compared as sets of
+members.
+"""
+
+
+# Run arguments of each implementation
+IMPLEMENTATIONS = [
+    ('reference', []),
+    ('coded', ['--match_engine', 'coded']),
+    ('index', ['--match_engine', 'index']),
+    ('shared_drop', ['--share_drop_matching']),
+    ('sparse', ['--infer_engine', 'sparse']),
+    ('chunked', ['--chunk_rows', '7']),
+    ('parallel', ['--match_engine', 'index', '--workers', '{workers}']),
+    ('parallel_sparse', ['--match_engine', 'coded', '--infer_engine', 'sparse', '--workers', '{workers}']),
+]
+IMPLEMENTATION_NAMES = [x[0] for x in IMPLEMENTATIONS]
+
+EXAMPLE_INPUTS = {
+    'pt_file': 'pt_file.tsv',
+    'ec_file': 'ec_file.tsv',
+    'dg_file': 'pt_demog.tsv',
+    'mc_link': 'mc_file.tsv',
+    'of_link': 'of_file.tsv',
+}
+EXAMPLE_DIR = os.path.dirname(os.path.abspath(__file__)) + os.sep + 'example_files'
+
+FAMILY_FILE = 'all_family_IDS.tsv'
+
+# State a stage hands on, as (state name, file name), for the stages whose
+# files a later stage rewrites.  The load's QC stats are rewritten by the
+# links stage.
+STATE_FILES = {'load': [('qc_stats', 'QC_stats.tsv')]}
+
+
+def stage_files():
+    """
+    Output files of the pipeline in stage order, as (stage, file name).
+    Files written by more than one stage belong to the last of them.
+    """
+
+    owners = dict()
+    for stage, function, needs, out_file_names in run_RIFTEHR.PIPELINE_STAGES:
+        for file_name in out_file_names:
+            owners[file_name] = stage
+
+    return [(stage, file_name) for stage, function, needs, out_file_names in run_RIFTEHR.PIPELINE_STAGES for file_name in out_file_names if owners[file_name] == stage]
+
+
+def run_implementation(inputs, out_dir, run_args):
+    """
+    Runs RIFTEHR with the intermediate files of every stage kept.
+
+    Args:
+        inputs (dict): Input files by argument name
+        out_dir (str): Output directory of the run, created if needed
+        run_args (list): Arguments selecting the implementation and stages
+
+    Returns:
+        bool: Whether the run succeeded
+    """
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    command = [sys.executable, os.path.dirname(os.path.abspath(__file__)) + os.sep + 'run_RIFTEHR.py', '--out_dir', out_dir, '--keep_intermediates'] + run_args
+    for argument, in_file in inputs.items():
+        if in_file is not None:
+            command += ['--' + argument, in_file]
+
+    with open(out_dir + os.sep + 'run.log', 'wt') as log:
+        completed = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT)
+
+    return completed.returncode == 0
+
+
+def prepare_stage_dir(reference_dir, stage_dir, stage):
+    """
+    Sets up the output directory of a run of a single stage, with the
+    checkpoints of the reference run and the files of the stages before it.
+
+    Args:
+        reference_dir (str): Output directory of the reference run
+        stage_dir (str): Output directory of the stage run
+        stage (str): Stage to run
+    """
+
+    shutil.rmtree(stage_dir, ignore_errors=True)
+    shutil.copytree(reference_dir + os.sep + 'checkpoints', stage_dir + os.sep + 'checkpoints')
+
+    earlier = run_RIFTEHR.STAGE_NAMES[:run_RIFTEHR.STAGE_NAMES.index(stage)]
+    for owner, file_name in stage_files():
+        if owner in earlier and os.path.exists(reference_dir + os.sep + file_name):
+            shutil.copy2(reference_dir + os.sep + file_name, stage_dir + os.sep + file_name)
+
+
+def stages_run(out_dir):
+    """Stages a run ran, rather than loaded from checkpoints, by its run_metrics.json"""
+
+    with open(out_dir + os.sep + 'run_metrics.json', 'rt') as infile:
+        steps = json.load(infile)['steps']
+
+    return [x['step'] for x in steps if x['step'] in run_RIFTEHR.STAGE_NAMES and not x.get('skipped')]
+
+
+def write_state_files(reference_dir):
+    """
+    Writes the state of STATE_FILES from the checkpoints of the reference
+    run, as the expected files of the stages that hand it on.
+
+    Args:
+        reference_dir (str): Output directory of the reference run
+
+    Returns:
+        str: Directory holding a directory of the files of each stage
+    """
+
+    state_dir = reference_dir + os.sep + 'state_files'
+    for stage, state_files in STATE_FILES.items():
+        os.makedirs(state_dir + os.sep + stage, exist_ok=True)
+        for name, file_name in state_files:
+            with open(run_RIFTEHR.checkpoint_file(reference_dir + os.sep + 'checkpoints', stage, name), 'rb') as infile:
+                state = pickle.load(infile)
+            with open(state_dir + os.sep + stage + os.sep + file_name, 'wt') as outfile:
+                outfile.write(state)
+
+    return state_dir
+
+
+def expected_files(golden_dir, state_dir, stage=None):
+    """
+    Expected files of a stage, or of the whole pipeline if stage is None, as
+    (stage, expected file).
+    """
+
+    expected = [(owner, golden_dir + os.sep + file_name) for owner, file_name in stage_files() if stage is None or owner == stage]
+    if stage is not None:
+        expected += [(stage, state_dir + os.sep + stage + os.sep + file_name) for name, file_name in STATE_FILES.get(stage, [])]
+
+    return expected
+
+
+def read_rows(file_name):
+    """
+    Reads the rows of an output file as a multiset of lines.  Families are
+    relabeled by their smallest member, so the same families give the same
+    rows whatever ids they were numbered with.
+    """
+
+    with open(file_name, 'rt') as infile:
+        lines = infile.read().splitlines()
+
+    if os.path.basename(file_name) != FAMILY_FILE or not lines:
+        return collections.Counter(lines)
+
+    members = collections.defaultdict(list)
+    for line in lines[1:]:
+        family_id, individual_id = line.split('\t')
+        members[family_id].append(individual_id)
+    rows = [lines[0]]
+    for family in members.values():
+        label = min(family)
+        rows += [label + '\t' + individual_id for individual_id in family]
+
+    return collections.Counter(rows)
+
+
+def diff_rows(expected, actual, max_rows):
+    """
+    Lists the rows of expected missing from actual, as - lines, and the rows
+    of actual not in expected, as + lines, with their extra counts.
+
+    Args:
+        expected (Counter): Expected rows
+        actual (Counter): Actual rows
+        max_rows (int): Most rows of each kind to list
+
+    Returns:
+        list: Diff lines, empty if the rows are equal
+    """
+
+    diff = list()
+    for sign, rows in [('-', expected - actual), ('+', actual - expected)]:
+        for row, count in sorted(rows.items())[:max_rows]:
+            diff.append(sign + ' ' + row + ('' if count == 1 else '\t(x' + str(count) + ')'))
+        if len(rows) > max_rows:
+            diff.append(sign + ' ... ' + str(len(rows) - max_rows) + ' more rows')
+
+    return diff
+
+
+def compare_outputs(expected, actual_dir, max_rows):
+    """
+    Compares the output files of a run against expected ones.  Expected
+    files that do not exist are not compared.
+
+    Args:
+        expected (list): Expected files, as (stage, expected file)
+        actual_dir (str): Output directory of the run
+        max_rows (int): Most differing rows of each kind to print per file
+
+    Returns:
+        int: Number of files that differ
+    """
+
+    n_different = 0
+    for stage, expected_file in expected:
+        if not os.path.exists(expected_file):
+            continue
+        file_name = os.path.basename(expected_file)
+        actual_file = actual_dir + os.sep + file_name
+        if not os.path.exists(actual_file):
+            print("\t" + stage + "\t" + file_name + ":\tMISSING")
+            n_different += 1
+            continue
+
+        expected, actual = read_rows(expected_file), read_rows(actual_file)
+        diff = diff_rows(expected, actual, max_rows)
+        if not diff:
+            print("\t" + stage + "\t" + file_name + ":\tequal, " + str(sum(actual.values())) + " rows")
+            continue
+
+        n_different += 1
+        print("\t" + stage + "\t" + file_name + ":\tDIFFERENT, " + str(sum((expected - actual).values())) + " rows missing, " + str(sum((actual - expected).values())) + " rows extra")
+        for line in diff:
+            print("\t\t" + line)
+
+    return n_different
+
+
+def parse_arguments():
+    """
+    Parses Command line arguments
+
+    Returns:
+        args: argpase object of input arguemnts
+    """
+
+    parser = argparse.ArgumentParser(description='Checks every implementation of the stages of RIFTEHR reproduces the golden outputs.  Runs on the example files by default')
+
+    for argument, help_text in [('pt_file', 'Patient File'), ('ec_file', 'Emergency Contact File'), ('dg_file', 'Patient Demographic File'), ('mc_link', 'Mother Child Linkage File'), ('of_link', 'Other Family Linkage File')]:
+        parser.add_argument('--' + argument, action='store',
+                            dest=argument,
+                            type=str,
+                            help=help_text + '.  Defaults to the example file if no input file is given')
+
+    parser.add_argument('--golden_dir', action='store',
+                        dest='golden_dir',
+                        type=str,
+                        help='Directory of the expected outputs.  Defaults to example_files for the example, otherwise the outputs of the reference implementation')
+
+    parser.add_argument('--out_dir', action='store', default='equivalence',
+                        dest='out_dir',
+                        type=str,
+                        help='Output Directory for the runs of each implementation')
+
+    parser.add_argument('--implementations', action='store', default=','.join(IMPLEMENTATION_NAMES),
+                        dest='implementations',
+                        type=str,
+                        help='Comma separated implementations to check, of ' + ', '.join(IMPLEMENTATION_NAMES))
+
+    parser.add_argument('--workers', action='store', default=4,
+                        dest='workers',
+                        type=int,
+                        help='Processes of the parallel implementations')
+
+    parser.add_argument('--max_diff_rows', action='store', default=20,
+                        dest='max_diff_rows',
+                        type=int,
+                        help='Most missing and extra rows printed per file')
+
+    args = parser.parse_args()
+    args.implementations = [x.strip() for x in args.implementations.split(',') if x.strip()]
+    unknown = [x for x in args.implementations if x not in IMPLEMENTATION_NAMES]
+    if unknown:
+        parser.error('unknown implementations ' + ', '.join(unknown) + ', choose from ' + ', '.join(IMPLEMENTATION_NAMES))
+    if not args.implementations:
+        parser.error('--implementations selects no implementation')
+
+    return args
+
+
+def main():
+    cli_args = parse_arguments()
+    print(cli_args)
+
+    inputs = {argument: getattr(cli_args, argument) for argument in EXAMPLE_INPUTS}
+    golden_dir = cli_args.golden_dir
+    if all(x is None for x in inputs.values()):
+        inputs = {argument: EXAMPLE_DIR + os.sep + file_name for argument, file_name in EXAMPLE_INPUTS.items()}
+        golden_dir = golden_dir or EXAMPLE_DIR
+
+    names = cli_args.implementations
+    failed = list()
+
+    # The reference run checkpoints the inputs of every stage
+    reference_name, reference_args = IMPLEMENTATIONS[0]
+    print("Running " + reference_name)
+    reference_dir = cli_args.out_dir + os.sep + reference_name
+    shutil.rmtree(reference_dir, ignore_errors=True)
+    if not run_implementation(inputs, reference_dir, reference_args + ['--checkpoint']):
+        print("\tRun failed, see " + reference_dir + os.sep + 'run.log')
+        print("Not equivalent: " + reference_name)
+        exit(1)
+    state_dir = write_state_files(reference_dir)
+
+    if golden_dir is None:
+        golden_dir = reference_dir
+        print("\tReference outputs for the other implementations")
+    elif reference_name in names and compare_outputs(expected_files(golden_dir, state_dir), reference_dir, cli_args.max_diff_rows):
+        failed.append(reference_name)
+
+    for name, run_args in IMPLEMENTATIONS[1:]:
+        if name not in names:
+            continue
+        for stage in run_RIFTEHR.STAGE_NAMES:
+            print("Running " + name + " " + stage)
+            stage_dir = cli_args.out_dir + os.sep + name + os.sep + stage
+            prepare_stage_dir(reference_dir, stage_dir, stage)
+            if not run_implementation(inputs, stage_dir, [x.format(workers=cli_args.workers) for x in run_args] + ['--from_stage', stage, '--to_stage', stage]):
+                print("\tRun failed, see " + stage_dir + os.sep + 'run.log')
+                failed.append(name + " " + stage)
+                continue
+            if stages_run(stage_dir) != [stage]:
+                print("\tRan stages " + ', '.join(stages_run(stage_dir)) + " rather than the checkpointed results of the reference")
+                failed.append(name + " " + stage)
+                continue
+            if compare_outputs(expected_files(golden_dir, state_dir, stage), stage_dir, cli_args.max_diff_rows):
+                failed.append(name + " " + stage)
+
+    if failed:
+        print("Not equivalent: " + ', '.join(failed))
+    else:
+        print("All implementations equivalent")
+
+    exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
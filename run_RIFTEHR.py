@@ -1,9 +1,16 @@
 import os, sys
 import argparse
+import collections.abc
+import contextlib
 import copy
+import functools
+import hashlib
+import json
+import multiprocessing
+import pickle
+import time
+import numpy as np
 import pandas as pd
-import networkx as nx
-import networkx.algorithms.isomorphism as iso
 import cchardet as chardet
 import unidecode
 
@@ -30,7 +37,7 @@ from Familial Relationships Reported in Medical Records. Cell.
 """
 
 
-def final_out(cleaned_matched_link_list, dg_dict, file_location, out_file_name):
+def final_out(cleaned_matched_link_list, dg_dict, file_location, out_file_name, mrn_ids=None, file_format='tsv'):
     """
     Creates the final output of RIFTEHR.  Siblings with the same birth year
     are marked as Twins and relations are converted from general to specific.
@@ -38,40 +45,52 @@ def final_out(cleaned_matched_link_list, dg_dict, file_location, out_file_name):
     Args:
         cleaned_matched_link_list (dict): Link List dictionary of imputed
                                             familial links
-        dg_dict (dict): Dictionary of demographic data
+        dg_dict (Demographics): Demographic data by MRN id
         file_location (str): Directory output files are saved to
         out_file_name (str): Output File name to write final out too
+        mrn_ids (dict): MRN dictionary the link list is coded with
+        file_format (str): Format of the output file, one of FILE_FORMATS
 
     Returns:
         final_link_list (dict): Final Linklist dictionary
 
     """
 
-    final_link_list = dict()
+    links = list(cleaned_matched_link_list)
+    pairs = np.array(links, dtype=np.int64).reshape(-1, 2)
+    relations = np.array(list(cleaned_matched_link_list.values()), dtype=object)
 
-    for k, v in cleaned_matched_link_list.items():
-        if k[0] in dg_dict and k[1] in dg_dict:
-            if v == "Sibling" and dg_dict[k[0]][1] == dg_dict[k[1]][1]:
-                final_link_list[k] = "Twins"
-            else:
-                final_link_list[k] = get_specific_relation(k[1], v, dg_dict)
-        else:
-            final_link_list[k] = v
+    known = dg_dict.contains(pairs[:, 0]) & dg_dict.contains(pairs[:, 1])
+    birth_years = dg_dict.birth_years_of(pairs[:, 0])
+    twins = known & (relations == "Sibling") & (birth_years == dg_dict.birth_years_of(pairs[:, 1])) & (birth_years != MISSING_BIRTH_YEAR)
 
-    outfile = open(file_location + os.sep + out_file_name, 'wt')
+    # The specific relation only depends on the general relation and the
+    # sex of the match, so convert each distinct pair of the two once
+    rows = np.flatnonzero(known & ~twins)
+    relation_codes, relation_uniques = pd.factorize(relations[rows])
+    kinds, first_rows, kind_of_rows = np.unique(relation_codes * len(SEX_CODES) + dg_dict.sex_codes_of(pairs[rows, 1]), return_index=True, return_inverse=True)
+    specific_relations = np.array([get_specific_relation(links[rows[i]][1], relations[rows[i]], dg_dict) for i in first_rows], dtype=object)
 
-    for match, relation in final_link_list.items():
-        outfile.write(match[0] + "\t" + relation + "\t" + match[1] + "\n")
-    outfile.close()
+    final_relations = relations.copy()
+    final_relations[rows] = specific_relations[kind_of_rows.reshape(-1)]
+    final_relations[twins] = "Twins"
+
+    final_link_list = dict(zip(links, final_relations.tolist()))
+
+    write_link_list(final_link_list, file_location, out_file_name, mrn_ids, file_format)
 
     return final_link_list
 
 
-def more_stats(cleaned_matched_link_list, dg_dict, rel_abbrev_group, pt_df, ec_df, cli_args):
+def more_stats(cleaned_matched_link_list, dg_dict, rel_abbrev_group, pt_df, ec_df, cli_args, mrn_ids):
     """
-    Ouptputs TP data for further analsyis.  Commented out in main.
+    Ouptputs TP data for further analsyis.  Commented out in main.  MRNs of
+    the data frames and dictionaries are coded with mrn_ids.
     """
 
+    pt_mrns = set(pt_df['MRN'].tolist())
+    ec_mrns = set(ec_df['MRN_1'].tolist())
+
     outfile_PT = open(cli_args.out_dir + os.sep + "MissingPT_ContactInfo.tsv", 'wt')
     outfile_EC = open(cli_args.out_dir + os.sep + "MissingECInfo.tsv", 'wt')
 
@@ -87,9 +106,7 @@ def more_stats(cleaned_matched_link_list, dg_dict, rel_abbrev_group, pt_df, ec_d
     all_no_pt_data = set()
     all_no_dg_data = set()
 
-    infile = open(cli_args.pt_file, 'rt')
-
-    for line in infile:
+    for line in read_input_lines(cli_args.pt_file, cli_args.input_format):
         line = line.lower().strip()
         if line.strip() == "" or "mrn" in line.lower():
             continue
@@ -103,11 +120,8 @@ def more_stats(cleaned_matched_link_list, dg_dict, rel_abbrev_group, pt_df, ec_d
             someset = set()
             someset.add(line.strip())
             PT_Contact[fields[0]] = someset
-    infile.close()
 
-    infile = open(cli_args.ec_file, 'rt')
-
-    for line in infile:
+    for line in read_input_lines(cli_args.ec_file, cli_args.input_format):
         line = line.lower().strip()
         if line.strip() == "" or "mrn" in line.lower():
             continue
@@ -120,24 +134,21 @@ def more_stats(cleaned_matched_link_list, dg_dict, rel_abbrev_group, pt_df, ec_d
             someset = set()
             someset.add(line.strip())
             EC_Contact[fields[0]] = someset
-    infile.close()
 
     mc_link = dict()
 
     mc_link_test = dict()
     mc_imput_link_test = dict()
 
-    infile = open(cli_args.mc_link, 'rt')
-
-    for line in infile:
+    for line in read_input_lines(cli_args.mc_link, cli_args.input_format):
         line = line.lower().strip()
         if line.strip() == "" or "mrn" in line.lower():
             continue
         fields = [x.strip() for x in line.strip().split("\t")]
 
-        if fields[0] not in dg_dict:
+        if mrn_ids.get(fields[0]) not in dg_dict:
             continue
-        if fields[-1] not in dg_dict:
+        if mrn_ids.get(fields[-1]) not in dg_dict:
             continue
 
         outfile_TP.write(line+"\n")
@@ -160,15 +171,15 @@ def more_stats(cleaned_matched_link_list, dg_dict, rel_abbrev_group, pt_df, ec_d
             outfile_EC_TP.write(outline+"\n")
             outfile_c_TP_ec.write(outline+"\n")
 
-        if fields[0] not in pt_df['MRN'].values:
+        if mrn_ids.get(fields[0]) not in pt_mrns:
             outline = "\n".join(PT_Contact[fields[0]])
             outfile_PT.write(outline+"\n")
 
-        if fields[-1] not in pt_df['MRN'].values:
+        if mrn_ids.get(fields[-1]) not in pt_mrns:
             outline = "\n".join(PT_Contact[fields[-1]])
             outfile_PT.write(outline+"\n")
 
-        if fields[0] not in ec_df['MRN_1'].values:
+        if mrn_ids.get(fields[0]) not in ec_mrns:
             if fields[0] not in EC_Contact:
                 outfile_EC.write(fields[0]+"\tNoECData\tNoECData\tNoECData\tNoECData\tNoECData\n")
 
@@ -176,7 +187,7 @@ def more_stats(cleaned_matched_link_list, dg_dict, rel_abbrev_group, pt_df, ec_d
                 outline = "\n".join(EC_Contact[fields[0]])
                 outfile_EC.write(outline+"\n")
 
-        if fields[-1] not in ec_df['MRN_1'].values:
+        if mrn_ids.get(fields[-1]) not in ec_mrns:
             if fields[-1] not in EC_Contact:
                 outfile_EC.write(fields[-1]+"\tNoECData\tNoECData\tNoECData\tNoECData\tNoECData\n")
 
@@ -193,81 +204,140 @@ def more_stats(cleaned_matched_link_list, dg_dict, rel_abbrev_group, pt_df, ec_d
     return
 
 
-def get_family_groups(file_location, in_file_name):
-    """Use graph theory packages to identify disconnected subgraphs of the
-    inferred relationship. Each disconnected subgraph is called a "family."
-    Each family is assigned a single identifer.
+def get_family_groups(file_location, in_file_name, chunk_lines=1000000, file_format='tsv'):
+    """Identify disconnected subgraphs of the inferred relationship. Each
+    disconnected subgraph is called a "family." Each family is assigned a
+    single identifer, numbered from the largest family down.
+
+    Edges are streamed from the input file in chunks into an array backed
+    disjoint-set union over integer coded MRNs, so no graph of the
+    relationships is held in memory.
 
     Args:
         file_location (str): Location of temp files
         in_file_name (str): Input File to read
+        chunk_lines (int): Number of edges read per chunk
+        file_format (str): Format of the input and output files, one of
+                           FILE_FORMATS
 
     """
 
-    infile = open(file_location + os.sep + in_file_name, 'rt')
+    mrn_codes = dict()
+    parent = np.zeros(0, dtype=np.int64)
 
-    all_relationships = set()
+    for edges in read_family_edges(file_location + os.sep + format_file_name(in_file_name, file_format), chunk_lines, file_format):
+        codes = np.fromiter((mrn_codes.setdefault(x, len(mrn_codes)) for x in edges), dtype=np.int64, count=len(edges))
+        if len(mrn_codes) > len(parent):
+            parent = np.concatenate([parent, np.arange(len(parent), len(mrn_codes), dtype=np.int64)])
+        union_families(parent, codes[0::2], codes[1::2])
 
-    for line in infile:
-        fields = [x.strip() for x in line.strip().split("\t")]
-        all_relationships.add(tuple([fields[0], fields[-1], fields[1]]))
-    infile.close()
+    family_roots = find_family_roots(parent)
+    family_sizes = np.bincount(family_roots, minlength=len(parent))
 
-    u = nx.Graph()  # directed graph
+    # Families sorted by size, ties in order of first appearance.  Roots are
+    # the first appearing MRN of each family.
+    roots = np.flatnonzero(family_sizes)
+    roots = roots[np.lexsort((roots, -family_sizes[roots]))]
+    family_ids = np.zeros(len(parent), dtype=np.int64)
+    family_ids[roots] = np.arange(len(roots))
+    family_of = family_ids[family_roots]
 
-    for r in all_relationships:
-        u.add_edge(r[0], r[1], rel=r[2])
+    mrns = np.empty(len(mrn_codes), dtype=object)
+    for mrn, code in mrn_codes.items():
+        mrns[code] = mrn
 
-    # Components sorted by size
-    comp = sorted(nx.connected_component_subgraphs(u), key=len, reverse=True)
+    if file_format != 'tsv':
+        order = np.argsort(family_of, kind='stable')
+        write_frame(pd.DataFrame({'family_id': family_of[order], 'individual_id': mrns[order]}), file_location, "all_family_IDS.tsv", file_format)
+        return
 
     outfile = open(file_location + os.sep + "all_family_IDS.tsv", 'wt')
 
     outfile.write("family_id\tindividual_id\n")
 
-    for family_id in range(len(comp)):
-        for individual_id in comp[family_id].nodes():
-            outfile.write(str(family_id)+"\t"+individual_id+"\n")
+    for code in np.argsort(family_of, kind='stable'):
+        outfile.write(str(family_of[code])+"\t"+mrns[code]+"\n")
     outfile.close()
 
     return
 
 
-def bi_directional(relation):
+def read_family_edges(in_file, chunk_lines, file_format='tsv'):
+    """
+    Reads the relationship edges of a link list file in chunks.
+
+    Args:
+        in_file (str): Location of the link list file
+        chunk_lines (int): Number of edges read per chunk
+        file_format (str): Format of the file, one of FILE_FORMATS
+
+    Yields:
+        list: pt_id, match_id of each edge of the next chunk, flattened
+    """
+
+    if file_format != 'tsv':
+        for batch in read_columnar_batches(in_file, file_format, chunk_lines):
+            columns = string_columns(batch)
+            edges = np.empty(2 * len(columns[0]), dtype=object)
+            edges[0::2] = columns[0]
+            edges[1::2] = columns[-1]
+            yield [x.strip() for x in edges]
+        return
+
+    infile = open(in_file, 'rt')
+
+    while True:
+        edges = list()
+        for line in infile:
+            fields = [x.strip() for x in line.strip().split("\t")]
+            edges.append(fields[0])
+            edges.append(fields[-1])
+            if len(edges) >= 2 * chunk_lines:
+                break
+        if len(edges) == 0:
+            break
+        yield edges
+    infile.close()
+
+
+def find_family_roots(parent):
     """
-    Flips relation for bidriectional directed relation
+    Compresses every path of a disjoint-set union parent array in place.
+
     Args:
-        relation (str): Relationship
+        parent (array): Parent of each node, roots are their own parent
+
     Returns:
-        new_relation(str): Flipped relationship or None
-    """
-    new_relation = None
-    if relation == 'Parent':
-        new_relation = 'Child'
-    elif relation == 'Child':
-        new_relation = 'Parent'
-    elif relation == 'Sibling':
-        new_relation = 'Sibling'
-    elif relation == 'Cousin':
-        new_relation = 'Cousin'
-    elif relation == 'Grandparent':
-        new_relation = 'Grandchild'
-    elif relation == 'Grandchild':
-        new_relation = 'Grandparent'
-    elif relation == 'Great-grandparent':
-        new_relation = 'Great-grandchild'
-    elif relation == 'Great-grandchild':
-        new_relation = 'Great-grandparent'
-    elif relation == 'Aunt/Uncle':
-        new_relation = 'Nephew/Niece'
-    elif relation == 'Nephew/Niece':
-        new_relation = 'Aunt/Uncle'
-    elif relation == 'Grandaunt/Granduncle':
-        new_relation = 'Grandnephew/Grandniece'
-    elif relation == 'Grandnephew/Grandniece':
-        new_relation = 'Grandaunt/Granduncle'
-
-    return new_relation
+        parent (array): The compressed array, the root of each node
+    """
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            return parent
+        parent[:] = grandparent
+
+
+def union_families(parent, from_codes, to_codes):
+    """
+    Unions the endpoints of a batch of edges in an array backed disjoint-set
+    union.  The roots of each edge are hooked onto the smaller root, so every
+    root is the smallest node of its family, until no edge joins two roots.
+
+    Args:
+        parent (array): Parent of each node, updated in place
+        from_codes (array): First node of each edge
+        to_codes (array): Second node of each edge
+    """
+    while True:
+        roots = find_family_roots(parent)
+        from_roots = roots[from_codes]
+        to_roots = roots[to_codes]
+        joins = from_roots != to_roots
+        if not joins.any():
+            return
+        from_roots = from_roots[joins]
+        to_roots = to_roots[joins]
+        np.minimum.at(parent, np.maximum(from_roots, to_roots), np.minimum(from_roots, to_roots))
 
 
 def fix_sex(a_str):
@@ -287,23 +357,80 @@ def fix_sex(a_str):
         return None
 
 
-def find_encoding(fname):
+def fix_sex_codes(codes):
+    """Vectorized fix_sex() over a matrix of ASCII codes"""
+
+    start, end = strip_bounds(codes)
+    first = LOWER_CASE[codes[np.arange(len(codes)), np.minimum(start, max(codes.shape[1] - 1, 0))]] if codes.shape[1] else np.zeros(len(codes), dtype=np.uint8)
+
+    sexes = np.full(len(codes), None, dtype=object)
+    sexes[(end > start) & (first == ord("f"))] = "F"
+    sexes[(end > start) & (first == ord("m"))] = "M"
+
+    return sexes
+
+
+def fix_sex_series(sexes):
+    """Vectorized fix_sex() over a Series of sexes
+
+    Args:
+        sexes (Series): Strings indicating Sex
+
+    Returns:
+        Series: Single Character indicating sex or None
+    """
+
+    return apply_vectorized(sexes, fix_sex_codes, fix_sex)
+
+
+ENCODING_SAMPLE_BYTES = 4 * 1024 * 1024
+ENCODING_SAMPLE_BLOCKS = 8
+ENCODING_BLOCK_BYTES = 64 * 1024
+
+
+def find_encoding(fname, sample_bytes=ENCODING_SAMPLE_BYTES, sample_blocks=ENCODING_SAMPLE_BLOCKS):
     """
-    Finds file encoding for ile loading
+    Finds file encoding for file loading.  Only a sample of the file is read:
+    the first sample_bytes, then sample_blocks blocks from random offsets in
+    the rest of the file.  Detection stops early once the detector is
+    confident.
 
     Args:
         fname (str): Name of file to analyze for character encoding
+        sample_bytes (int): Bytes read from the start of the file
+        sample_blocks (int): Blocks read from the rest of the file
 
     Returns:
         charenc: Detected encoding
     """
-    r_file = open(fname, 'rb').read()
-    result = chardet.detect(r_file)
-    charenc = result['encoding']
+    detector = chardet.UniversalDetector()
+    file_size = os.path.getsize(fname)
+
+    with open(fname, 'rb') as infile:
+        offsets = list(range(0, min(sample_bytes, file_size), ENCODING_BLOCK_BYTES))
+        if file_size > sample_bytes + sample_blocks * ENCODING_BLOCK_BYTES:
+            # Seeded by the file size, so a file is always sampled alike
+            rand = np.random.default_rng(file_size)
+            offsets.extend(sorted(rand.integers(sample_bytes, file_size - ENCODING_BLOCK_BYTES, sample_blocks)))
+        elif file_size > sample_bytes:
+            offsets.extend(range(sample_bytes, file_size, ENCODING_BLOCK_BYTES))
+
+        for offset in offsets:
+            infile.seek(offset)
+            detector.feed(infile.read(ENCODING_BLOCK_BYTES))
+            if detector.done:
+                break
+
+    detector.close()
+    charenc = detector.result['encoding']
+
+    # Non ASCII text may lie outside the sample, read ASCII as its superset
+    if charenc == 'ASCII' and file_size > sample_bytes + sample_blocks * ENCODING_BLOCK_BYTES:
+        charenc = 'UTF-8'
     return charenc
 
 
-def stats_and_load_other_links(cli_args, cleaned_matched_link_list, dg_dict, rel_abbrev_group, pt_df, ec_df):
+def stats_and_load_other_links(cli_args, cleaned_matched_link_list, dg_dict, rel_abbrev_group, pt_df, ec_df, mrn_ids, group_opposite=None):
     """
     Loads additonal relationship files if and calculates sensitivity
     and the positive predictive value for the infered relatons based off of
@@ -315,10 +442,14 @@ def stats_and_load_other_links(cli_args, cleaned_matched_link_list, dg_dict, rel
         cli_args.mc_file (str): Input file of Mother/Child Links
         cleaned_matched_link_list (dict): Link List dictionary of imputed
                                             familial links
-        dg_dict (dict): Dictionary of demographic data
+        dg_dict (Demographics): Demographic data by MRN id
         rel_abbrev_group (dict): Dictionary of group abbreviaton converstions
         pt_df (df): Pandas Dataframe of the PT contact data
         ec_df (df): Pandas Dataframe of emergency contact data
+        mrn_ids (dict): MRN dictionary, extended with the MRNs only found
+                        in the provided links
+        group_opposite (dict): Opposite of each relationship group, loaded
+                               from the default references if None
 
     Returns:
         cleaned_matched_link_list (dict): Updated link list dictionary with
@@ -327,8 +458,15 @@ def stats_and_load_other_links(cli_args, cleaned_matched_link_list, dg_dict, rel
 
     """
 
+    if group_opposite is None:
+        group_opposite, _ = load_references()
+    reverses = reverse_relations(group_opposite)
+
     outfile = open(cli_args.out_dir + os.sep + "QC_stats.tsv", 'at')
 
+    pt_mrns = set(pt_df['MRN'].tolist())
+    ec_mrns = set(ec_df['MRN_1'].tolist())
+
     of_link = dict()
     mc_link = dict()
 
@@ -336,21 +474,20 @@ def stats_and_load_other_links(cli_args, cleaned_matched_link_list, dg_dict, rel
     mc_imput_link_test = dict()
 
     if cli_args.of_link is not None:
-        infile = open(cli_args.of_link, 'rt')
-        for line in infile:
+        for line in read_input_lines(cli_args.of_link, cli_args.input_format):
             if line.strip() == "" or "mrn" in line.lower():
                 continue
             fields = [x.strip() for x in line.strip().split("\t")]
             relation = fields[-1].lower()
+            fields[0] = mrn_ids.setdefault(fields[0], len(mrn_ids))
+            fields[1] = mrn_ids.setdefault(fields[1], len(mrn_ids))
             if relation in rel_abbrev_group:
                 relation_group = rel_abbrev_group[relation]
                 of_link[tuple([fields[0], fields[1]])] = relation_group
-                new_relation = bi_directional(relation_group)
+                new_relation = reverses.get(relation_group)
                 if new_relation is not None:
                     of_link[tuple([fields[1], fields[0]])] = new_relation
 
-        infile.close()
-
     all_no_ec_data = set()
     all_no_pt_data = set()
     all_no_dg_data = set()
@@ -361,11 +498,12 @@ def stats_and_load_other_links(cli_args, cleaned_matched_link_list, dg_dict, rel
 
     if cli_args.mc_link is not None:
 
-        infile = open(cli_args.mc_link, 'rt')
-        for line in infile:
+        for line in read_input_lines(cli_args.mc_link, cli_args.input_format):
             if line.strip() == "" or "mrn" in line.lower():
                 continue
             fields = [x.strip() for x in line.strip().split("\t")]
+            fields[0] = mrn_ids.setdefault(fields[0], len(mrn_ids))
+            fields[-1] = mrn_ids.setdefault(fields[-1], len(mrn_ids))
 
             mc_count += 1
 
@@ -380,14 +518,14 @@ def stats_and_load_other_links(cli_args, cleaned_matched_link_list, dg_dict, rel
                 all_no_dg_data.add(fields[-1])
                 continue
 
-            if fields[0] not in pt_df['MRN'].values:
+            if fields[0] not in pt_mrns:
                 all_no_pt_data.add(fields[0])
-            if fields[-1] not in pt_df['MRN'].values:
+            if fields[-1] not in pt_mrns:
                 all_no_pt_data.add(fields[-1])
 
-            if fields[0] not in ec_df['MRN_1'].values:
+            if fields[0] not in ec_mrns:
                 all_no_ec_data.add(fields[0])
-            if fields[-1] not in ec_df['MRN_1'].values:
+            if fields[-1] not in ec_mrns:
                 all_no_ec_data.add(fields[-1])
 
             # TP for mc stats, only those with good demographic or contact info
@@ -400,11 +538,9 @@ def stats_and_load_other_links(cli_args, cleaned_matched_link_list, dg_dict, rel
                 if tuple([fields[0], fields[-1]]) in cleaned_matched_link_list:
                     mc_imput_link_test[tuple([fields[0], fields[-1]])] = cleaned_matched_link_list[tuple([fields[0], fields[-1]])]
                 elif tuple([fields[-1], fields[0]]) in cleaned_matched_link_list:
-                    new_relation = bi_directional(cleaned_matched_link_list[tuple([fields[-1], fields[0]])])
+                    new_relation = reverses.get(cleaned_matched_link_list[tuple([fields[-1], fields[0]])])
                     mc_imput_link_test[tuple([fields[0], fields[-1]])] = new_relation
 
-        infile.close()
-
         outfile.write("Total provided Mother/Child links:\t" + str(mc_count)+"\n")
         outfile.write("Total Number of Mother/Child IDs w/o proper contact information:\t"+ str(len(all_no_pt_data))+"\n")
         outfile.write("Total Number of Mother/Child IDs w/o proper demographic information:\t"+ str(len(all_no_dg_data))+"\n")
@@ -460,9 +596,9 @@ def get_specific_relation(pt_id, relation, dg_dict):
     Convertes general relation to specific
 
     Args:
-        pt_id (str): PT_ID to look up
+        pt_id (int): MRN id to look up
         relation (str): General relation to convert
-        dg_dict (dict): Dictionary of pt demographics
+        dg_dict (Demographics): Demographic data by MRN id
 
     Returns:
         specific_relation: Converted Specific Relation
@@ -506,386 +642,640 @@ def get_specific_relation(pt_id, relation, dg_dict):
     return specific_relation
 
 
-def clean_inferences(file_location, matches_dict, out_file_name):
+def write_link_list(link_list, file_location, out_file_name, mrn_ids=None, file_format='tsv'):
+    """
+    Writes a relationship linklist dictionary as tab seperated
+    pt_id, relation, match_id rows, decoding coded MRNs with mrn_ids.
+    Parquet and Feather files get LINK_LIST_COLUMNS as column names.
+    """
+
+    decode_mrn = mrn_decoder(mrn_ids)
+
+    if file_format != 'tsv':
+        rows = [tuple([decode_mrn(match[0]), relation, decode_mrn(match[1])]) for match, relation in link_list.items()]
+        write_frame(pd.DataFrame(rows, columns=LINK_LIST_COLUMNS), file_location, out_file_name, file_format)
+        return
+
+    outfile = open(file_location + os.sep + out_file_name, 'wt')
+
+    for match, relation in link_list.items():
+        outfile.write(decode_mrn(match[0]) + "\t" + relation + "\t" + decode_mrn(match[1]) + "\n")
+    outfile.close()
+
+
+# Resolution of a patient with several relations to the same match, by the
+# first of these ambiguous relations among them: the relations it resolves
+# to, the first of them present is kept.  A match none of them resolve is
+# dropped.  Parent/Aunt/Uncle with Parent resolves to no relation, dropping
+# the match, as it always has.
+INFERENCE_RESOLUTIONS = [
+    ('Parent/Parent-in-law', [('Parent', 'Parent')]),
+    ('Parent/Aunt/Uncle', [('Parent', None), ('Aunt/Uncle', 'Aunt/Uncle')]),
+    ('Sibling/Sibling-in-law', [('Sibling', 'Sibling')]),
+    ('Sibling/Cousin', [('Sibling', 'Sibling'), ('Cousin', 'Cousin')]),
+    ('Child/Nephew/Niece', [('Child', 'Child'), ('Nephew/Niece', 'Nephew/Niece')]),
+    ('Child/Child-in-law', [('Child', 'Child')]),
+    ('Nephew/Niece/Nephew-in-law/Niece-in-law', [('Nephew/Niece', 'Nephew/Niece')]),
+    ('Grandparent/Grandparent-in-law', [('Grandparent', 'Grandparent')]),
+    ('Grandchild/Grandchild-in-law', [('Grandchild', 'Grandchild')]),
+    ('Grandnephew/Grandniece/Grandnephew-in-law/Grandniece-in-law', [('Grandnephew/Grandniece', 'Grandnephew/Grandniece')]),
+    ('Grandaunt/Granduncle/Grandaunt-in-law/Granduncle-in-law', [('Grandaunt/Granduncle', 'Grandaunt/Granduncle')]),
+    ('Great-grandparent/Great-grandparent-in-law', [('Great-grandparent', 'Great-grandparent')]),
+    ('Great-grandchild/Great-grandchild-in-law', [('Great-grandchild', 'Great-grandchild')]),
+]
+
+# Resolved relations the opposite relation is added for
+BIDIRECTIONAL_RELATIONS = ['Parent', 'Child', 'Sibling', 'Cousin', 'Grandparent', 'Grandchild', 'Great-grandparent', 'Great-grandchild', 'Aunt/Uncle', 'Nephew/Niece', 'Grandaunt/Granduncle', 'Grandnephew/Grandniece']
+
+
+def resolve_relation_set(relations):
     """
-    Cleans up infered relationships and writes the relationship linklist
-        to a temp file
+    Resolves the relations of a patient to a match by INFERENCE_RESOLUTIONS.
+
+    Args:
+        relations (set): Provided and infered relations to the match
+
+    Returns:
+        str: Resolved relation, None if the match is dropped
+    """
+
+    if len(relations) == 1:
+        return next(iter(relations))
+
+    for ambiguous, preferences in INFERENCE_RESOLUTIONS:
+        if ambiguous in relations:
+            for present, resolved in preferences:
+                if present in relations:
+                    return resolved
+            return None
+
+    return None
+
+
+def reverse_relations(group_opposite):
+    """Opposite of each of BIDIRECTIONAL_RELATIONS, from the relationship group opposites"""
+
+    return {relation: group_opposite[relation] for relation in BIDIRECTIONAL_RELATIONS if relation in group_opposite}
+
+
+def resolve_inferences(matches_dict, group_opposite=None):
+    """
+    Resolves patients with several provided or infered relations to a single
+    relation and adds the bidirectional relations.
+
+    The relations of each patient to each match are collected as a bitmask
+    of relation codes in one pass over the matches.  Each distinct bitmask is
+    resolved once into a lookup table, which then resolves every match.
 
     Args:
-        file_location (str): Location of temp files
         matches_dict (dict): Dictionary of provided and infered relationships
-        out_file_name (str): Out file name
+        group_opposite (dict): Opposite of each relationship group, loaded
+                               from the default references if None
 
     Returns:
         cleaned_matched_list: Cleaned Dictionary Link list of actual and
                               infered relations
-
     """
 
     # Conflicting provided relationships removed at data import step
 
-    match_linked_list = dict()
+    if group_opposite is None:
+        group_opposite, _ = load_references()
+    opposites = reverse_relations(group_opposite)
 
+    relation_bits = dict()
+    match_masks = dict()
     for pt_id, og_matches in matches_dict.items():
-        for g in og_matches:
-            if tuple([pt_id, g[1]]) in match_linked_list.keys():
-                match_linked_list[tuple([pt_id, g[1]])].add(g[0])
-            else:
-                someSet = set()
-                someSet.add(g[0])
-                match_linked_list[tuple([pt_id, g[1]])] = someSet
+        for relation, match_id in og_matches:
+            bit = relation_bits.get(relation)
+            if bit is None:
+                bit = relation_bits[relation] = 1 << len(relation_bits)
+            match = tuple([pt_id, match_id])
+            match_masks[match] = match_masks.get(match, 0) | bit
+
+    relations = list(relation_bits)
+    resolutions = dict()
+    for mask in set(match_masks.values()):
+        resolutions[mask] = resolve_relation_set(set(relations[i] for i in range(len(relations)) if mask >> i & 1))
 
     cleaned_matched_list = dict()
-
-    for match, og_relations in match_linked_list.items():
-        if len(og_relations) > 1:
-            if 'Parent/Parent-in-law' in og_relations:
-                if 'Parent' in og_relations:
-                    cleaned_matched_list[match] = 'Parent'
-
-            elif 'Parent/Aunt/Uncle' in og_relations:
-                if 'Parent' in og_relations:
-                    match_linked_list[match] = 'Parent'
-                elif 'Aunt/Uncle' in og_relations:
-                    cleaned_matched_list[match] = 'Aunt/Uncle'
-
-            elif 'Sibling/Sibling-in-law' in og_relations:
-                if 'Sibling' in og_relations:
-                    cleaned_matched_list[match] = 'Sibling'
-
-            elif 'Sibling/Cousin' in og_relations:
-                if 'Sibling' in og_relations:
-                    cleaned_matched_list[match] = 'Sibling'
-                elif 'Cousin' in og_relations:
-                    cleaned_matched_list[match] = 'Cousin'
-
-            elif 'Child/Nephew/Niece' in og_relations:
-                if 'Child' in og_relations:
-                    cleaned_matched_list[match] = 'Child'
-                elif 'Nephew/Niece' in og_relations:
-                    cleaned_matched_list[match] = 'Nephew/Niece'
-
-            elif 'Child/Child-in-law' in og_relations:
-                if 'Child' in og_relations:
-                    cleaned_matched_list[match] = 'Child'
-
-            elif 'Nephew/Niece/Nephew-in-law/Niece-in-law' in og_relations:
-                if 'Nephew/Niece' in og_relations:
-                    cleaned_matched_list[match] = 'Nephew/Niece'
-
-            elif 'Grandparent/Grandparent-in-law' in og_relations:
-                if 'Grandparent' in og_relations:
-                    cleaned_matched_list[match] = 'Grandparent'
-
-            elif 'Grandchild/Grandchild-in-law' in og_relations:
-                if 'Grandchild' in og_relations:
-                    cleaned_matched_list[match] = 'Grandchild'
-
-            elif 'Grandnephew/Grandniece/Grandnephew-in-law/Grandniece-in-law' in og_relations:
-                if 'Grandnephew/Grandniece' in og_relations:
-                    cleaned_matched_list[match] = 'Grandnephew/Grandniece'
-
-            elif 'Grandaunt/Granduncle/Grandaunt-in-law/Granduncle-in-law' in og_relations:
-                if 'Grandaunt/Granduncle' in og_relations:
-                    cleaned_matched_list[match] = 'Grandaunt/Granduncle'
-
-            elif 'Great-grandparent/Great-grandparent-in-law' in og_relations:
-                if 'Great-grandparent' in og_relations:
-                    cleaned_matched_list[match] = 'Great-grandparent'
-
-            elif 'Great-grandchild/Great-grandchild-in-law' in og_relations:
-                if 'Great-grandchild' in og_relations:
-                    cleaned_matched_list[match] = 'Great-grandchild'
-        else:
-            cleaned_matched_list[match] = og_relations.pop()
+    for match, mask in match_masks.items():
+        relation = resolutions[mask]
+        if relation is not None:
+            cleaned_matched_list[match] = relation
 
     # Add bidirectional relations
-    to_add = dict()
-    for match, relation in cleaned_matched_list.items():
-        new_relation = bi_directional(relation)
-        if new_relation is not None:
-            to_add[tuple([match[1], match[0]])] = new_relation
-
+    to_add = {tuple([match[1], match[0]]): opposites[relation] for match, relation in cleaned_matched_list.items() if relation in opposites}
     cleaned_matched_list.update(to_add)
 
-    outfile = open(file_location + os.sep + out_file_name, 'wt')
+    return cleaned_matched_list
 
-    for match, relation in cleaned_matched_list.items():
-        outfile.write(match[0] + "\t" + relation + "\t" + match[1] + "\n")
-    outfile.close()
 
-    return cleaned_matched_list
+def load_inference_rules(rules_file=None):
+    """
+    Loads the relationship inference rules and compiles them into an integer
+    composition matrix.  Each rule infers a relationship for a patient from
+    its relation to a match followed by the match's relation to a third
+    patient.
+
+    Args:
+        rules_file (str): Tab seperated rules file, defaults to
+                          reference_files/relationship_inference_rules.tsv
+
+    Returns:
+        relation_names (list): Relationship of each integer code.  Codes of
+                               relationships that compose come first.
+        composition (array): Square int16 matrix, composition[a, b] is the
+                             code inferred from relation a followed by
+                             relation b, or -1.
+    """
+
+    if rules_file is None:
+        rules_file = reference_file('relationship_inference_rules.tsv')
+
+    rules = list()
+    infile = open(rules_file, 'rt')
+    for line in infile:
+        if line.strip() == "" or line.startswith("relationship\t"):
+            continue
+        fields = [x.strip() for x in line.strip().split("\t")]
+        rules.append(tuple(fields[:3]))
+    infile.close()
+
+    relation_names = list()
+    for rule in rules:
+        for relation in rule[:2]:
+            if relation not in relation_names:
+                relation_names.append(relation)
+    n_composable = len(relation_names)
+    for rule in rules:
+        if rule[2] not in relation_names:
+            relation_names.append(rule[2])
+
+    composition = np.full((n_composable, n_composable), -1, dtype=np.int16)
+    for relation, match_relation, inferred in rules:
+        composition[relation_names.index(relation), relation_names.index(match_relation)] = relation_names.index(inferred)
 
+    return relation_names, composition
 
-def infer_relations(file_location, in_file_name, out_file_name):
+
+def add_inferred_relation(matches_dict, new_relations, empi_key, relation, match_rel, composition):
     """
-    Infers relations through already found relations.
+    Composes empi_key's relation code to a match with the match's relation
+    match_rel, recording the inferred relation in new_relations if it is not
+    already known.
 
     Args:
-        file_location (str): Location of temp files
-        in_file_name (str): Name of input file with relations
-        out_file_name (str): Name of file to output infered relations to
+        matches_dict (dict): Dictionary of provided and infered relationships
+        new_relations (dict): Relations inferred in the current round
+        empi_key (str): Patient relations are inferred for
+        relation (int): Relation code of empi_key to the match
+        match_rel (tuple): (relation code, third patient) of the match
+        composition (list): Composition matrix rows as lists
+    """
+
+    # we won't infer relationships from the individual to themselves
+    if empi_key == match_rel[1] or match_rel[0] >= len(composition):
+        return
+    inferred = composition[relation][match_rel[0]]
+    if inferred < 0:
+        return
+    inferred = tuple([inferred, match_rel[1]])
+    if inferred not in matches_dict[empi_key]:
+        new_relations.setdefault(empi_key, set()).add(inferred)
+
+
+def report_inference_rounds(round_added):
+    """
+    Prints the number of relations added in each inference round.
+    """
+    for i, added in enumerate(round_added):
+        print("\tInference round " + str(i + 1) + ":\t" + str(added) + " relations added")
+    print("\tInference reached fixpoint after " + str(len(round_added)) + " rounds")
+
+
+def infer_relation_sets(relations, inference_rules):
+    """
+    Infers relations with per patient sets of relations.  Relationships are
+    integer coded while inferring so each rule is a matrix lookup, and
+    rounds are semi-naive.
+
+    Args:
+        relations (list): (pt_id, relation, match_id) tuples
+        inference_rules (tuple): Output of load_inference_rules()
 
     Returns:
         match_dict: Dictionary containtaining actual and infered matches
-
+        round_added (list): Number of relations added in each round
     """
-    matches_dict = dict()
+    relation_names = list(inference_rules[0])
+    relation_codes = {relation: code for code, relation in enumerate(relation_names)}
+    composition = inference_rules[1].tolist()
+    n_composable = len(composition)
 
-    infile = open(file_location + os.sep + in_file_name, 'rt')
-    outfile = open(file_location + os.sep + out_file_name, 'wt')
+    matches_dict = dict()
 
-    for i, line in enumerate(infile):
-        if "mrn" in line.lower():
-            continue
-        fields = line.strip().split("\t")
-        if fields[0].strip() == fields[2].strip():
-            continue
-        if fields[0].strip() in matches_dict:
-            matches_dict[fields[0].strip()].add(tuple([fields[1].strip(), fields[2].strip()]))
+    for pt_id, relation, match_id in relations:
+        if relation not in relation_codes:
+            relation_codes[relation] = len(relation_names)
+            relation_names.append(relation)
+        if pt_id in matches_dict:
+            matches_dict[pt_id].add(tuple([relation_codes[relation], match_id]))
         else:
             someSet = set()
-            someSet.add(tuple([fields[1].strip(), fields[2].strip()]))
-            matches_dict[fields[0].strip()] = someSet
-    infile.close()
+            someSet.add(tuple([relation_codes[relation], match_id]))
+            matches_dict[pt_id] = someSet
+
+    # Semi-naive evaluation, each round only composes the relations derived
+    # in the previous round with the existing ones.
+    incoming = dict()
+    for empi_key, emp_rel in matches_dict.items():
+        for match in emp_rel:
+            if match[0] < n_composable:
+                incoming.setdefault(match[1], set()).add(tuple([match[0], empi_key]))
+
+    delta = {empi_key: set(emp_rel) for empi_key, emp_rel in matches_dict.items()}
+    round_added = list()
+    while delta:
+        with measure('round ' + str(len(round_added) + 1)) as metric:
+            new_relations = dict()
+
+            # new relations of empi_key followed by all relations of the match
+            for empi_key, emp_rel in delta.items():
+                for match in emp_rel:
+                    if match[0] >= n_composable or match[1] not in matches_dict:
+                        continue
+                    for match_rel in matches_dict[match[1]]:
+                        add_inferred_relation(matches_dict, new_relations, empi_key, match[0], match_rel, composition)
+
+            # all relations into a match followed by its new relations
+            for match_key, match_rels in delta.items():
+                for relation, empi_key in incoming.get(match_key, ()):
+                    for match_rel in match_rels:
+                        add_inferred_relation(matches_dict, new_relations, empi_key, relation, match_rel, composition)
+
+            added = 0
+            for empi_key, emp_rel in new_relations.items():
+                matches_dict[empi_key].update(emp_rel)
+                added += len(emp_rel)
+                for match in emp_rel:
+                    if match[0] < n_composable:
+                        incoming.setdefault(match[1], set()).add(tuple([match[0], empi_key]))
+
+            if added > 0:
+                round_added.append(added)
+            metric['rows_out'] = {'added': added}
+        delta = new_relations
+
+    for empi_key, emp_rel in matches_dict.items():
+        matches_dict[empi_key] = set(tuple([relation_names[match[0]], match[1]]) for match in emp_rel)
+
+    return matches_dict, round_added
+
+
+def write_inferred_relations(matches_dict, file_location, out_file_name, mrn_ids=None, file_format='tsv'):
+    """
+    Writes the provided and infered relations of an inference engine, decoding
+    coded MRNs with mrn_ids.
+    """
 
-    # NOTE!!  JULIA STARTS ARRAYS AT 1!!!!
-    a = 1
-    while a > 0:  # while because we loop till no more updates are found.
-        a = 0  # break while variable
-        for empi_key, or_emp_rel in matches_dict.items():
-            emp_rel = or_emp_rel.copy()
-            for match in or_emp_rel:   # looping through all the matches for empi_key
-                if match[1] in matches_dict:    # if match also has other matches, get those to loop through.
-                    for match_rel in matches_dict[match[1]]:    # loop through their relationships
-                        if empi_key == match_rel[1]:      # we won't infer relationships from the individual to themselves
-                            continue
-
-                        if match[0] == "Parent":  # parent of match[1] is emp_rel
-
-                            if match_rel[0] == "Sibling":  # match[1] siblings are aunt/uncle of empi_key
-                                if tuple(["Aunt/Uncle", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Aunt/Uncle", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Aunt/Uncle":
-                                if tuple(["Grandaunt/Granduncle", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Grandaunt/Granduncle", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Child":
-                                if tuple(["Sibling", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Sibling", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Grandchild":
-                                if tuple(["Child/Nephew/Niece", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Child/Nephew/Niece", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Grandparent":
-                                if tuple(["Great-grandparent", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Great-grandparent", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Nephew/Niece":
-                                if tuple(["Cousin", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Cousin", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Parent":
-                                if tuple(["Grandparent", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Grandparent", match_rel[1]]))
-                                    a += 1
-
-                        elif match[0] == "Child":
-                            if match_rel[0] == "Sibling":
-                                if tuple(["Child", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Child", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Aunt/Uncle":
-                                if tuple(["Sibling/Sibling-in-law", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Sibling/Sibling-in-law", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Child":
-                                if tuple(["Grandchild", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Grandchild", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Grandchild":
-                                if tuple(["Great-grandchild", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Great-grandchild", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Grandparent":
-                                if tuple(["Parent/Parent-in-law", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Parent/Parent-in-law", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Nephew/Niece":
-                                if tuple(["Grandchild/Grandchild-in-law", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Grandchild/Grandchild-in-law", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Parent":
-                                if tuple(["Spouse", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Spouse", match_rel[1]]))
-                                    a += 1
-
-                        elif match[0] == "Sibling":
-                            if match_rel[0] == "Sibling":
-                                if tuple(["Sibling", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Sibling", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Aunt/Uncle":
-                                if tuple(["Aunt/Uncl", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Aunt/Uncl", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Child":
-                                if tuple(["Nephew/Niece", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Nephew/Niece", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Grandchild":
-                                if tuple(["Grandnephew/Grandniece", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Grandnephew/Grandniece", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Grandparent":
-                                if tuple(["Grandparent", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Grandparent", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Nephew/Niece":
-                                if tuple(["Child/Nephew/Niece", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Child/Nephew/Niece", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Parent":
-                                if tuple(["Parent", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Parent", match_rel[1]]))
-                                    a += 1
-
-                        elif match[0] == "Aunt/Uncle":
-                            if match_rel[0] == "Sibling":
-                                if tuple(["Parent/Aunt/Uncle", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Parent/Aunt/Uncle", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Aunt/Uncle":
-                                if tuple(["Grandaunt/Granduncle/Grandaunt-in-law/Granduncle-in-law", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Grandaunt/Granduncle/Grandaunt-in-law/Granduncle-in-law", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Child":
-                                if tuple(["Cousin", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Cousin", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Grandchild":
-                                if tuple(["First cousin once removed", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["First cousin once removed", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Grandparent":
-                                if tuple(["Great-grandparent/Great-grandparent-in-law", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Great-grandparent/Great-grandparent-in-law", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Nephew/Niece":
-                                if tuple(["Sibling/Cousin", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Sibling/Cousin", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Parent":
-                                if tuple(["Grandparent/Grandparent-in-law", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Grandparent/Grandparent-in-law", match_rel[1]]))
-                                    a += 1
-
-                        elif match[0] == "Grandchild":
-                            if match_rel[0] == "Sibling":
-                                if tuple(["Grandchild", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Grandchild", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Aunt/Uncle":
-                                if tuple(["Child/Child-in-law", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Child/Child-in-law", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Child":
-                                if tuple(["Great-grandchild", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Great-grandchild", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Grandchild":
-                                if tuple(["Great-great-grandchild", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Great-great-grandchild", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Grandparent":
-                                if tuple(["Spouse", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Spouse", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Nephew/Niece":
-                                if tuple(["Great-grandchild/Great-grandchild-in-law", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Great-grandchild/Great-grandchild-in-law", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Parent":
-                                if tuple(["Child/Child-in-law", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Child/Child-in-law", match_rel[1]]))
-                                    a += 1
-
-                        elif match[0] == "Grandparent":
-                            if match_rel[0] == "Sibling":
-                                if tuple(["Grandaunt/Granduncle", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Grandaunt/Granduncle", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Aunt/Uncle":
-                                if tuple(["Great-grandaunt/Great-granduncle", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Great-grandaunt/Great-granduncle", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Child":
-                                if tuple(["Parent/Aunt/Uncle", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Parent/Aunt/Uncle", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Grandchild":
-                                if tuple(["Sibling/Cousin", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Sibling/Cousin", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Grandparent":
-                                if tuple(["Great-great-grandparent", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Great-great-grandparent", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Nephew/Niece":
-                                if tuple(["First cousin once removed", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["First cousin once removed", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Parent":
-                                if tuple(["Great-grandparent", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Great-grandparent", match_rel[1]]))
-                                    a += 1
-
-                        elif match[0] == "Nephew/Niece":
-                            if match_rel[0] == "Sibling":
-                                if tuple(["Nephew/Niece/Nephew-in-law/Niece-in-law", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Nephew/Niece/Nephew-in-law/Niece-in-law", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Aunt/Uncle":
-                                if tuple(["Sibling/Sibling-in-law", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Sibling/Sibling-in-law", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Child":
-                                if tuple(["Grandnephew/Grandniece", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Grandnephew/Grandniece", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Grandchild":
-                                if tuple(["Great-grandnephew/Great-grandniece", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Great-grandnephew/Great-grandniece", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Grandparent":
-                                if tuple(["Parent/Parent-in-law", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Parent/Parent-in-law", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Nephew/Niece":
-                                if tuple(["Grandnephew/Grandniece/Grandnephew-in-law/Grandniece-in-law", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Grandnephew/Grandniece/Grandnephew-in-law/Grandniece-in-law", match_rel[1]]))
-                                    a += 1
-                            elif match_rel[0] == "Parent":
-                                if tuple(["Sibling/Sibling-in-law", match_rel[1]]) not in emp_rel:
-                                    emp_rel.add(tuple(["Sibling/Sibling-in-law", match_rel[1]]))
-                                    a += 1
-
-            matches_dict[empi_key]=emp_rel
-        if a == 0:
-            break
+    decode_mrn = mrn_decoder(mrn_ids)
 
+    if file_format != 'tsv':
+        rows = [tuple([decode_mrn(ptid), x[0], decode_mrn(x[1])]) for ptid, match_rel in matches_dict.items() for x in match_rel if ptid != x[-1]]
+        write_frame(pd.DataFrame(rows, columns=LINK_LIST_COLUMNS), file_location, out_file_name, file_format)
+        return
+
+    outfile = open(file_location + os.sep + out_file_name, 'wt')
     for ptid,match_rel in matches_dict.items():
         for x in match_rel:
             if ptid == x[-1]:
                 continue
-            outfile.write(ptid+"\t")
-            outfile.write("\t".join(x))
+            outfile.write(decode_mrn(ptid)+"\t")
+            outfile.write(x[0] + "\t" + decode_mrn(x[1]))
             outfile.write("\n")
     outfile.close()
 
-    return matches_dict
+
+def infer_relation_matrices(relations, inference_rules):
+    """
+    Infers relations with a sparse adjacency matrix per relationship over
+    integer patient ids.  Every inference rule is a sparse matrix product,
+    for example Parent x Sibling -> Aunt/Uncle.  Rounds are semi-naive,
+    multiplying only the relations new in the previous round, until no new
+    relation is found.  Requires scipy.
+
+    Args:
+        relations (list): (pt_id, relation, match_id) tuples
+        inference_rules (tuple): Output of load_inference_rules()
+
+    Returns:
+        match_dict: Dictionary containtaining actual and infered matches
+        round_added (list): Number of relations added in each round
+    """
+
+    from scipy import sparse
+
+    relation_names, composition = inference_rules
+
+    pt_codes, pt_ids = pd.factorize(np.array([x[0] for x in relations] + [x[2] for x in relations], dtype=object))
+    n_pts = len(pt_ids)
+    from_codes = pt_codes[:len(relations)]
+    to_codes = pt_codes[len(relations):]
+    relation_of = pd.Series([x[1] for x in relations], dtype=object)
+
+    def to_matrix(rows, cols):
+        return sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(n_pts, n_pts))
+
+    matrices = dict()
+    for relation in pd.unique(relation_of):
+        has_relation = (relation_of == relation).values
+        matrix = to_matrix(from_codes[has_relation], to_codes[has_relation])
+        matrix.data[:] = 1
+        matrices[relation] = matrix
+
+    rules = list()
+    for a, b in zip(*np.nonzero(composition >= 0)):
+        rules.append(tuple([relation_names[a], relation_names[b], relation_names[composition[a, b]]]))
+
+    delta = dict(matrices)
+    round_added = list()
+    while delta:
+        with measure('round ' + str(len(round_added) + 1)) as metric:
+            new_matrices = dict()
+            for relation, match_relation, inferred in rules:
+                product = None
+                if relation in delta and match_relation in matrices:
+                    product = delta[relation] @ matrices[match_relation]
+                if match_relation in delta and relation in matrices:
+                    other = matrices[relation] @ delta[match_relation]
+                    product = other if product is None else product + other
+                if product is None or product.nnz == 0:
+                    continue
+
+                # no relations to themselves and only those not already known
+                product = product.tocoo()
+                keep = product.row != product.col
+                product = to_matrix(product.row[keep], product.col[keep])
+                if inferred in matrices:
+                    product = product - product.multiply(matrices[inferred])
+                if inferred in new_matrices:
+                    product = product + new_matrices[inferred]
+                product.eliminate_zeros()
+                product.data[:] = 1
+                if product.nnz > 0:
+                    new_matrices[inferred] = product
+
+            added = sum(x.nnz for x in new_matrices.values())
+            for relation, matrix in new_matrices.items():
+                if relation in matrices:
+                    matrix = matrices[relation] + matrix
+                matrix.data[:] = 1
+                matrices[relation] = matrix
+
+            if added > 0:
+                round_added.append(added)
+            metric['rows_out'] = {'added': added}
+        delta = new_matrices
+
+    pt_ids = np.asarray(pt_ids, dtype=object)
+    matches_dict = dict()
+    for relation, matrix in matrices.items():
+        matrix = matrix.tocoo()
+        for pt_id, match_id in zip(pt_ids[matrix.row], pt_ids[matrix.col]):
+            if pt_id in matches_dict:
+                matches_dict[pt_id].add(tuple([relation, match_id]))
+            else:
+                matches_dict[pt_id] = {tuple([relation, match_id])}
+
+    return matches_dict, round_added
+
+
+INFER_CORES = {'sets': infer_relation_sets, 'sparse': infer_relation_matrices}
+
+
+def split_families(relations):
+    """
+    Splits relations into families, the connected components of the
+    relationship graph get_family_groups() assigns family IDs to.  Inference
+    never crosses families, so each can be inferred on its own.
+
+    Args:
+        relations (list): (pt_id, relation, match_id) tuples
+
+    Returns:
+        families (list): Lists of relations of each family, largest first
+    """
+
+    codes, pt_ids = pd.factorize(np.array([x[0] for x in relations] + [x[2] for x in relations], dtype=object))
+    parent = np.arange(len(pt_ids), dtype=np.int64)
+    union_families(parent, codes[:len(relations)], codes[len(relations):])
+    family_of = find_family_roots(parent)[codes[:len(relations)]].tolist()
+
+    families = dict()
+    for family_id, relation in zip(family_of, relations):
+        if family_id in families:
+            families[family_id].append(relation)
+        else:
+            families[family_id] = [relation]
+    families = list(families.values())
+
+    return sorted(families, key=len, reverse=True)
+
+
+def batch_families(families, n_batches):
+    """
+    Groups families into roughly n_batches batches of similar relation
+    counts.  Families at least a batch in size get a batch of their own,
+    smaller ones are packed together.
+
+    Args:
+        families (list): Output of split_families(), largest first
+        n_batches (int): Number of batches aimed for
+
+    Returns:
+        batches (list): Lists of relations of each batch
+    """
+
+    target = max(1, sum(len(x) for x in families) // max(1, n_batches))
+
+    batches = list()
+    batch = list()
+    for family in families:
+        if len(family) >= target:
+            batches.append(family)
+            continue
+        batch.extend(family)
+        if len(batch) >= target:
+            batches.append(batch)
+            batch = list()
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+# Read-only inference state of the worker processes, set by
+# init_infer_worker().
+_infer_worker_state = None
+
+
+def init_infer_worker(state):
+    """
+    Process pool initializer storing the inference engine, rules and
+    relationship group opposites.
+    """
+    global _infer_worker_state
+    _infer_worker_state = state
+
+
+def infer_family_batch(relations):
+    """
+    Infers and cleans the relations of one batch of families.
+
+    Args:
+        relations (list): (pt_id, relation, match_id) tuples of the batch
+
+    Returns:
+        matches_dict (dict): Actual and infered matches of the batch
+        round_added (list): Number of relations added in each round
+        cleaned_matched_list (dict): Cleaned link list of the batch
+    """
+    engine, inference_rules, group_opposite = _infer_worker_state
+    matches_dict, round_added = INFER_CORES[engine](relations, inference_rules)
+    return matches_dict, round_added, resolve_inferences(matches_dict, group_opposite)
+
+
+def infer_and_clean_families(relations, inference_rules, workers, engine='sets', group_opposite=None):
+    """
+    Infers and cleans relations family by family in a process pool.  The
+    relationship graph is split into families first, large families are
+    inferred on their own and small ones in batches, and the results are
+    merged.
+
+    Args:
+        relations (list): (pt_id, relation, match_id) tuples
+        inference_rules (tuple): Output of load_inference_rules()
+        workers (int): Number of worker processes
+        engine (str): Inference engine, see INFER_CORES
+        group_opposite (dict): Opposite of each relationship group, loaded
+                               from the default references if None
+
+    Returns:
+        match_dict: Dictionary containtaining actual and infered matches
+        round_added (list): Number of relations added in each round, summed
+                            over families
+        cleaned_matched_list: Cleaned Dictionary Link list of actual and
+                              infered relations
+    """
+
+    if group_opposite is None:
+        group_opposite, _ = load_references()
+
+    families = split_families(relations)
+    batches = batch_families(families, workers * 4)
+    print("\tInferring " + str(len(families)) + " families in " + str(len(batches)) + " batches")
+
+    with multiprocessing.Pool(processes=workers, initializer=init_infer_worker, initargs=((engine, inference_rules, group_opposite),)) as pool:
+        results = pool.map(infer_family_batch, batches, chunksize=1)
+
+    matches_dict = dict()
+    round_added = list()
+    cleaned_matched_list = dict()
+    for batch_matches, batch_added, batch_cleaned in results:
+        matches_dict.update(batch_matches)
+        cleaned_matched_list.update(batch_cleaned)
+        for i, added in enumerate(batch_added):
+            if i < len(round_added):
+                round_added[i] += added
+            else:
+                round_added.append(added)
+
+    return matches_dict, round_added, cleaned_matched_list
+
+
+def relations_from_frame(df, mrn_ids=None):
+    """
+    Converts a cleaned match Dataframe to (pt_id, relation, match_id)
+    relation tuples, skipping self relations.  MRNs coded with mrn_ids are
+    recoded to the codes of their stripped MRNs.
+    """
+
+    if mrn_ids is None:
+        strip_mrn = str.strip
+    else:
+        strip_mrn = strip_mrn_ids(mrn_ids).__getitem__
+
+    relations = list()
+    for pt_id, relation, match_id in df[['empi_or_mrn', 'relationship', 'relation_empi_or_mrn']].itertuples(index=False):
+        pt_id = strip_mrn(pt_id)
+        match_id = strip_mrn(match_id)
+        if pt_id != match_id:
+            relations.append(tuple([pt_id, relation.strip(), match_id]))
+
+    return relations
+
+
+def relations_from_link_list(link_list):
+    """
+    Converts a relationship linklist dictionary to relation tuples.
+    """
+    return [tuple([match[0], relation, match[1]]) for match, relation in link_list.items() if match[0] != match[1]]
+
+
+def run_inference(relations, cli_args, inference_rules, infer_out_file_name, clean_out_file_name, mrn_ids=None, group_opposite=None):
+    """
+    Infers and cleans relations in memory with the engine and number of
+    workers given on the command line.  The inferred and cleaned relations
+    are only written out with --keep_intermediates.
+
+    Args:
+        relations (list): (pt_id, relation, match_id) tuples
+        cli_args (args): Parsed command line arguments
+        inference_rules (tuple): Output of load_inference_rules()
+        infer_out_file_name (str): Name of file to output infered relations to
+        clean_out_file_name (str): Name of file to output cleaned relations to
+        mrn_ids (dict): MRN dictionary the relations are coded with, None if
+                        they hold MRN strings
+        group_opposite (dict): Opposite of each relationship group, loaded
+                               from the default references if None
+
+    Returns:
+        match_dict: Dictionary containtaining actual and infered matches
+        cleaned_matched_list: Cleaned Dictionary Link list of actual and
+                              infered relations
+    """
+
+    if group_opposite is None:
+        group_opposite, _ = load_references()
+
+    if cli_args.workers > 1:
+        with measure('infer_and_clean_families', row_counts({'relations': relations})) as metric:
+            matches_dict, round_added, cleaned_matched_list = infer_and_clean_families(relations, inference_rules, cli_args.workers, cli_args.infer_engine, group_opposite)
+            metric['rows_out'] = {'relations': sum(len(x) for x in matches_dict.values()), 'cleaned_matched_list': len(cleaned_matched_list)}
+            metric['round_added'] = round_added
+    else:
+        with measure('infer_relations', row_counts({'relations': relations})) as metric:
+            matches_dict, round_added = INFER_CORES[cli_args.infer_engine](relations, inference_rules)
+            metric['rows_out'] = {'relations': sum(len(x) for x in matches_dict.values())}
+            metric['round_added'] = round_added
+        with measure('clean_inferences', {'relations': metric['rows_out']['relations']}) as metric:
+            cleaned_matched_list = resolve_inferences(matches_dict, group_opposite)
+            metric['rows_out'] = row_counts({'cleaned_matched_list': cleaned_matched_list})
+    report_inference_rounds(round_added)
+
+    if cli_args.keep_intermediates:
+        write_inferred_relations(matches_dict, cli_args.out_dir, infer_out_file_name, mrn_ids, cli_args.output_format)
+        write_link_list(cleaned_matched_list, cli_args.out_dir, clean_out_file_name, mrn_ids, cli_args.output_format)
+
+    return matches_dict, cleaned_matched_list
+
+
+def reference_file(file_name):
+    """Location of a file in the reference_files directory"""
+
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    return dir_path + os.sep + 'reference_files' + os.sep + file_name
 
 
 def load_references():
@@ -898,11 +1288,10 @@ def load_references():
                         to standardized terms
         rel_abbrev_group: Distionary for flipping relationships.
     """
-    dir_path = os.path.dirname(os.path.realpath(__file__))
     group_opposite = dict()
     rel_abbrev_group = dict()
 
-    infile = open(dir_path+os.sep+'reference_files' + os.sep + 'relationships_lookup.tsv', 'rt')
+    infile = open(reference_file('relationships_lookup.tsv'), 'rt')
     for line in infile:
         if line.strip() == "":
             continue
@@ -912,7 +1301,7 @@ def load_references():
         rel_abbrev_group[fields[1].lower()] = fields[2]
     infile.close()
 
-    infile = open(dir_path+os.sep+'reference_files' + os.sep + 'relationships_and_opposites.tsv', 'rt')
+    infile = open(reference_file('relationships_and_opposites.tsv'), 'rt')
     for line in infile:
         if line.strip() == "":
             continue
@@ -922,16 +1311,20 @@ def load_references():
     return group_opposite, rel_abbrev_group
 
 
-def merge_matches_demog(df_cumc_patient, dg_df):
+def merge_matches_demog(df_cumc_patient, dg_dict):
     """
-    Merges demographic data with match data.
+    Merges demographic data with match data.  Both sides of each match are
+    looked up by MRN id in the demographic arrays, matches without
+    demographic data on either side are dropped.
 
     Args:
         df_cumc_patient (df): Pandas Dataframe of Matches
-        dg_df (df): Pandas Dataframe of Demographic data
+        dg_dict (Demographics): Demographic data by MRN id
 
     Returns:
-        df_cumc_patient: Pandas Dataframe of Matches and Demographic Data
+        df_cumc_patient: Pandas Dataframe of Matches and Demographic Data,
+                         int16 birth years with MISSING_BIRTH_YEAR if
+                         missing and a float32 age_dif, NaN if either is
 
     Todo:
         Validate and Standardize Sex data.
@@ -940,29 +1333,75 @@ def merge_matches_demog(df_cumc_patient, dg_df):
 
     # a.mrn, b.relationship_group, a.relation_mrn, a.matched_path, child.year as DOB_empi, parent.year as DOB_matched, child.year - parent.year as age_dif, null as exclude
 
-    df_cumc_patient = pd.merge(df_cumc_patient, dg_df, how='inner', left_on='empi_or_mrn', right_on='MRN')
-    df_cumc_patient = df_cumc_patient.drop(columns=['MRN'])
-    df_cumc_patient.columns = ['empi_or_mrn', 'relationship_group', 'relation_empi_or_mrn', 'matched_path', 'DOB_empi','SEX_empi']
+    empi = df_cumc_patient['empi_or_mrn'].to_numpy()
+    relation = df_cumc_patient['relation_empi_or_mrn'].to_numpy()
+    known = dg_dict.contains(empi) & dg_dict.contains(relation)
+    empi, relation = empi[known], relation[known]
+
+    dob_empi = dg_dict.birth_years[empi]
+    dob_matched = dg_dict.birth_years[relation]
+    df_cumc_patient = pd.DataFrame({
+        'empi_or_mrn': empi,
+        'relationship_group': df_cumc_patient['relationship'].to_numpy()[known],
+        'relation_empi_or_mrn': relation,
+        'matched_path': df_cumc_patient['matched_path'].to_numpy()[known],
+        'DOB_empi': dob_empi,
+        'SEX_empi': SEX_CODES[dg_dict.sex_codes[empi]],
+        'DOB_matched': dob_matched,
+        'SEX_matched': SEX_CODES[dg_dict.sex_codes[relation]],
+    })
+    missing = (dob_empi == MISSING_BIRTH_YEAR) | (dob_matched == MISSING_BIRTH_YEAR)
+    df_cumc_patient['age_dif'] = np.where(missing, np.nan, dob_empi.astype(np.float32) - dob_matched.astype(np.float32)).astype(np.float32)
+
+    # exclude anything with year of birth <1900, missing years are kept
+    keep = ((dob_empi > 1900) | (dob_empi == MISSING_BIRTH_YEAR)) & ((dob_matched > 1900) | (dob_matched == MISSING_BIRTH_YEAR))
+
+    return df_cumc_patient[keep]
+
+
+# Cleanup rules by relationship group: age difference window, direction
+# the match is flipped in and whether same sex matches are excluded.
+# Matches with an age difference strictly inside the window are excluded,
+# those past it in the flip direction (-1 below, 1 above) are flipped to the
+# opposite relationship group.
+CLEANUP_RULES = [
+    ('Parent', 10, -1, False),
+    ('Child', 10, 1, False),
+    ('Grandparent', 20, -1, False),
+    ('Grandchild', 20, 1, False),
+    ('Spouse', np.nan, 0, True),  # Same Sex Spouses do not contribute to heritability
+]
+
+
+def cleanup_rule_table(groups, group_opposite):
+    """
+    Looks up the cleanup rules and opposite of each relationship group.
 
-    df_cumc_patient = pd.merge(df_cumc_patient, dg_df, how='inner', left_on='relation_empi_or_mrn', right_on='MRN')
-    df_cumc_patient = df_cumc_patient.drop(columns=['MRN'])
-    df_cumc_patient.columns = ['empi_or_mrn', 'relationship_group', 'relation_empi_or_mrn', 'matched_path', 'DOB_empi','SEX_empi', 'DOB_matched', 'SEX_matched']
-    df_cumc_patient['DOB_empi'] = pd.to_numeric(df_cumc_patient['DOB_empi'], downcast="float")
-    df_cumc_patient['DOB_matched'] = pd.to_numeric(df_cumc_patient['DOB_matched'], downcast="float")
+    Args:
+        groups (array): Distinct relationship groups
+        group_opposite (dict): Opposite of each relationship group
 
-    # exclude anything with year of birth <1900
-    df_cumc_patient = df_cumc_patient[~(df_cumc_patient['DOB_empi'] <= 1900)]
-    df_cumc_patient = df_cumc_patient[~(df_cumc_patient['DOB_matched'] <= 1900)]
+    Returns:
+        windows (array): Age difference window of each group, NaN if none
+        flip_signs (array): Flip direction of each group, 0 if none
+        same_sex (array): Whether same sex matches of each group are excluded
+        opposites (array): Opposite of each group, NaN if it has none
+    """
 
-    df_cumc_patient['age_dif'] = df_cumc_patient['DOB_empi'] - df_cumc_patient['DOB_matched']
+    rules = {group: rule for group, *rule in CLEANUP_RULES}
+    windows = np.array([rules.get(x, (np.nan, 0, False))[0] for x in groups], dtype=np.float64)
+    flip_signs = np.array([rules.get(x, (np.nan, 0, False))[1] for x in groups], dtype=np.float64)
+    same_sex = np.array([rules.get(x, (np.nan, 0, False))[2] for x in groups], dtype=bool)
+    opposites = np.array([group_opposite.get(x, np.nan) for x in groups], dtype=object)
 
-    return df_cumc_patient
+    return windows, flip_signs, same_sex, opposites
 
 
 def match_cleanup(df, group_opposite, high_match):
     """
     Cleans up Matches before infering relationship.  Dropping improbably
-    matches and flipping probable but possible incorect relationships
+    matches and flipping probable but possible incorect relationships, by
+    the rules of CLEANUP_RULES looked up by relationship group code.
 
     Args:
         df (df): Pandas Dataframe of Matches and Demographic data
@@ -976,45 +1415,30 @@ def match_cleanup(df, group_opposite, high_match):
 
     # Conflicting ages dropped in import step
 
-    # exclude PARENTS with age difference BETWEEN -10 AND 10 years
-    indexNames = df[(df['relationship_group'] == 'Parent') & (df['age_dif'] < 10) & (df['age_dif'] > -10)].index
-    df.drop(indexNames, inplace=True)
-
-    # exclude CHILD with age difference BETWEEN -10 AND 10 years
-    indexNames = df[(df['relationship_group'] == 'Child') & (df['age_dif'] < 10) & (df['age_dif'] > -10)].index
-    df.drop(indexNames, inplace=True)
-
-    # exclude GRANDPARENTS with age difference BETWEEN -20 AND 20 years
-    indexNames = df[(df['relationship_group'] == 'Grandparent') & (df['age_dif'] < 20) & (df['age_dif'] > -20)].index
-    df.drop(indexNames, inplace=True)
-
-    # exclude GRANDCHILD with age difference BETWEEN -20 AND 20 years
-    indexNames = df[(df['relationship_group'] == 'Grandchild') & (df['age_dif'] < 20) & (df['age_dif'] > -20)].index
-    df.drop(indexNames, inplace=True)
-
-    # exclude Same Sex Spouses as do not contribute to heritability
-    indexNames = df[(df['SEX_empi'] == df['SEX_matched']) & (df['relationship_group'] =='Spouse')].index
-    df.drop(indexNames, inplace=True)
-
-    # flip PARENTS with age difference <-10
-    df_sub_p = df[(df['relationship_group'] == 'Parent') & (df['age_dif'] < -10)]
-    # flip CHILD with age difference >10
-    df_sub_c = df[(df['relationship_group'] == 'Child') & (df['age_dif'] > 10)]
-    # flip GRANDPARENTS with age difference <-20
-    df_sub_gp = df[(df['relationship_group'] == 'Grandparent') & (df['age_dif'] < -20)]
-    # flip GRANDCHILD with age difference >20
-    df_sub_gc = df[(df['relationship_group'] == 'Grandchild') & (df['age_dif'] > 20)]
-
-    # merge sub and flip and recombine
-    df_sub_concat = pd.concat([df_sub_p, df_sub_c, df_sub_gp, df_sub_gc])
-    df_sub_concat['relationship_group'] = df_sub_concat['relationship_group'].map(group_opposite)
-    df.loc[df_sub_concat.index, :] = df_sub_concat
-
-    # Remove High matches
-    df = df[df.groupby(['relation_empi_or_mrn'])['empi_or_mrn'].transform('nunique') <= high_match]
-    df = df[df.groupby(['empi_or_mrn'])['relation_empi_or_mrn'].transform('nunique') <= high_match]
-
-    df = df[['empi_or_mrn','relationship_group','relation_empi_or_mrn']]
+    group_codes, groups = pd.factorize(df['relationship_group'], use_na_sentinel=False)
+    windows, flip_signs, same_sex, opposites = cleanup_rule_table(groups, group_opposite)
+
+    # Comparisons with a missing age difference or window are False
+    age_dif = df['age_dif'].to_numpy(dtype=np.float64, na_value=np.nan)
+    window = windows[group_codes]
+    with np.errstate(invalid='ignore'):
+        exclude = np.abs(age_dif) < window
+        exclude |= same_sex[group_codes] & (df['SEX_empi'] == df['SEX_matched']).to_numpy()
+        flip = ~exclude & (flip_signs[group_codes] * age_dif > window)
+
+    # Remove High matches.  Counted over the distinct pairs, the matches of
+    # each empi are counted after dropping the relations with high matches.
+    keep = ~exclude
+    empi_codes, empis = pd.factorize(df['empi_or_mrn'])
+    relation_codes, relations = pd.factorize(df['relation_empi_or_mrn'])
+    pairs = np.where(keep, empi_codes.astype(np.int64) * len(relations) + relation_codes, -1)
+    pair = keep & ~pd.Series(pairs).duplicated().to_numpy()
+    keep &= (np.bincount(relation_codes[pair], minlength=len(relations)) <= high_match)[relation_codes]
+    pair &= keep
+    keep &= (np.bincount(empi_codes[pair], minlength=len(empis)) <= high_match)[empi_codes]
+
+    df = df.loc[keep, ['empi_or_mrn', 'relationship_group', 'relation_empi_or_mrn']]
+    df['relationship_group'] = np.where(flip[keep], opposites[group_codes[keep]], groups[group_codes[keep]])
     df.columns = ['empi_or_mrn', 'relationship', 'relation_empi_or_mrn']
 
     # Swap columns into standard linked list format
@@ -1182,241 +1606,2168 @@ def find_matches(pt_df, ec_df, drop):
     return df_cumc_patient.drop_duplicates()
 
 
-def clean_split_names(a_str):
+# Contact columns combinations matched on and the matched_path label recorded
+# for each, in the same order find_matches() concatenates them.
+MATCH_PATHS = [
+    (('FirstName',), 'first'),
+    (('LastName',), 'last'),
+    (('PhoneNumber',), 'phone'),
+    (('Zipcode',), 'zip'),
+    (('FirstName', 'LastName'), 'first,last'),
+    (('FirstName', 'PhoneNumber'), 'first,phone'),
+    (('FirstName', 'Zipcode'), 'first,zip'),
+    (('LastName', 'PhoneNumber'), 'last,phone'),
+    (('LastName', 'Zipcode'), 'last,zip'),
+    (('PhoneNumber', 'Zipcode'), 'phone,zip'),
+    (('FirstName', 'LastName', 'PhoneNumber'), 'first,last,phone'),
+    (('FirstName', 'LastName', 'Zipcode'), 'fist,last,zip'),
+    (('FirstName', 'PhoneNumber', 'Zipcode'), 'first,phone,zip'),
+    (('LastName', 'PhoneNumber', 'Zipcode'), 'last,phone,zip'),
+    (('FirstName', 'LastName', 'PhoneNumber', 'Zipcode'), 'first,last,phone,zip'),
+]
+MATCH_COLUMNS = MATCH_PATHS[-1][0]
+
+
+def encode_match_keys(pt_df):
     """
-    Cleans and splits names for matching.  Unidecode coverted Unicode characters to UTF-8 ones.
+    Integer codes the PT contact columns and every MATCH_PATHS combination of
+    them.  Combinations are built from their prefix combination by packing
+    the two codes into an int64 and re-factorizing, so codes stay dense.
+    Missing values are coded -1 and never match.
 
     Args:
-        s_str (str): String to be split
+        pt_df (df): Pandas Dataframe of Patient Information
 
     Returns:
-        n_str: (str) New cleaned and normalized string
-
-    Todo:
-        Split on space for matching of all portions of hyphenaded names and
-        update find_matches() to match on all portions of split names
+        pt_keys (dict): Column combination to (codes, lookup) where codes is
+                        the per row key code and lookup is a pandas Index of
+                        the raw value or packed prefix/column pair per code.
     """
 
-    #unicode letters and symbols to
+    pt_keys = dict()
+
+    for column in MATCH_COLUMNS:
+        codes, uniques = pd.factorize(pt_df[column])
+        pt_keys[tuple([column])] = (codes.astype(np.int64), pd.Index(uniques))
+
+    for columns, path in MATCH_PATHS:
+        if columns in pt_keys:
+            continue
+        prefix_codes, prefix_lookup = pt_keys[columns[:-1]]
+        column_codes, column_lookup = pt_keys[columns[-1:]]
+
+        packed = pack_key_codes(prefix_codes, column_codes, len(column_lookup))
+        codes, uniques = pd.factorize(packed[packed >= 0])
+        all_codes = np.full(len(packed), -1, dtype=np.int64)
+        all_codes[packed >= 0] = codes
+        pt_keys[columns] = (all_codes, pd.Index(uniques))
+
+    return pt_keys
+
+
+def pack_key_codes(prefix_codes, column_codes, n_column_codes):
+    """
+    Packs a prefix key code and a column code into a single int64, -1 when
+    either is missing.
+    """
+    packed = prefix_codes * n_column_codes + column_codes
+    packed[(prefix_codes < 0) | (column_codes < 0)] = -1
+    return packed
+
+
+def encode_ec_keys(ec_df, pt_keys):
+    """
+    Codes the Emergency Contact columns with the PT key lookups from
+    encode_match_keys().  Values never seen in the PT data code to -1.
+
+    Args:
+        ec_df (df): Pandas Dataframe of Emergency Contact Information
+        pt_keys (dict): Output of encode_match_keys()
+
+    Returns:
+        ec_keys (dict): Column combination to per EC row key codes
+    """
+
+    ec_keys = dict()
+
+    for column in MATCH_COLUMNS:
+        codes = pt_keys[tuple([column])][1].get_indexer(ec_df['EC_' + column])
+        ec_keys[tuple([column])] = codes.astype(np.int64)
+
+    for columns, path in MATCH_PATHS:
+        if columns in ec_keys:
+            continue
+        packed = pack_key_codes(ec_keys[columns[:-1]], ec_keys[columns[-1:]], len(pt_keys[columns[-1:]][1]))
+        codes = pt_keys[columns][1].get_indexer(packed)
+        codes[packed < 0] = -1
+        ec_keys[columns] = codes.astype(np.int64)
+
+    return ec_keys
+
+
+def count_key_mrns(pt_keys, mrn_codes, row_mask=None):
+    """
+    Counts, in a single pass over all MATCH_PATHS key codes at once, the
+    number of distinct MRNs holding each key.  Keys of each path are offset
+    into their own range so one hashed unique over (key, MRN) pairs covers
+    all 15 paths.
+
+    Args:
+        pt_keys (dict): Output of encode_match_keys()
+        mrn_codes (array): Integer code of each PT row's MRN
+        row_mask (array): Optional boolean mask of PT rows to consider
+
+    Returns:
+        offsets (array): Start of each path's key range
+        mrns_per_key (array): Number of distinct MRNs holding each key
+        key_mrn (array): MRN code of one holder of each key, -1 if none
+        key_first (array): Position of the first PT row holding the key
+    """
+
+    n_rows = len(mrn_codes)
+    rows = np.arange(n_rows, dtype=np.int64)
+    if row_mask is not None:
+        rows = rows[row_mask]
+
+    offsets = np.zeros(len(MATCH_PATHS) + 1, dtype=np.int64)
+    all_keys = list()
+    all_rows = list()
+    for i, (columns, path) in enumerate(MATCH_PATHS):
+        codes, lookup = pt_keys[columns]
+        offsets[i + 1] = offsets[i] + len(lookup)
+        path_codes = codes[rows]
+        has_key = path_codes >= 0
+        all_keys.append(path_codes[has_key] + offsets[i])
+        all_rows.append(rows[has_key])
+
+    all_keys = np.concatenate(all_keys)
+    all_rows = np.concatenate(all_rows)
+    n_keys = offsets[-1]
+    n_mrns = int(mrn_codes.max()) + 1 if n_rows > 0 else 1
+
+    key_first = np.full(n_keys, n_rows, dtype=np.int64)
+    np.minimum.at(key_first, all_keys, all_rows)
+
+    pairs = pd.unique(all_keys * n_mrns + mrn_codes[all_rows])
+    pair_keys = pairs // n_mrns
+    mrns_per_key = np.bincount(pair_keys, minlength=n_keys)
+
+    key_mrn = np.full(n_keys, -1, dtype=np.int64)
+    key_mrn[pair_keys] = pairs % n_mrns
+
+    return offsets, mrns_per_key, key_mrn, key_first
+
+
+def unique_key_table(pt_keys, mrn_codes, row_mask=None):
+    """
+    Finds which keys of every MATCH_PATHS combination belong to exactly one
+    MRN.
+
+    Args:
+        pt_keys (dict): Output of encode_match_keys()
+        mrn_codes (array): Integer code of each PT row's MRN
+        row_mask (array): Optional boolean mask of PT rows to consider
+
+    Returns:
+        offsets (array): Start of each path's key range
+        key_mrn (array): MRN code of each key, -1 if not unique to one MRN
+        key_first (array): Position of the first PT row holding the key
+    """
+
+    offsets, mrns_per_key, key_mrn, key_first = count_key_mrns(pt_keys, mrn_codes, row_mask)
+    key_mrn[mrns_per_key != 1] = -1
+
+    return offsets, key_mrn, key_first
+
+
+def probe_unique_keys(ec_keys, offsets, key_mrn, key_first, ec_rows=None):
+    """
+    Looks up every EC row against the unique key table for all MATCH_PATHS.
+
+    Args:
+        ec_keys (dict): Output of encode_ec_keys()
+        offsets, key_mrn, key_first: Output of unique_key_table()
+        ec_rows (list): Optional positions of the EC rows to probe, one
+                        array per path
+
+    Returns:
+        hits (list): One (ec_row, mrn_code, pt_first_row) array tuple per
+                     path, ordered as pd.merge() on the PT frame would be.
+    """
+
+    hits = list()
+    for i, (columns, path) in enumerate(MATCH_PATHS):
+        codes = ec_keys[columns]
+        rows = np.arange(len(codes), dtype=np.int64) if ec_rows is None else ec_rows[i]
+        codes = codes[rows]
+        rows = rows[codes >= 0]
+        keys = codes[codes >= 0] + offsets[i]
+        matched = key_mrn[keys] >= 0
+        rows = rows[matched]
+        keys = keys[matched]
+        hits.append(sort_hits(rows, key_mrn[keys], key_first[keys]))
+
+    return hits
+
+
+def sort_hits(ec_rows, mrn_codes, first):
+    """
+    Orders one path's hits by first PT row then EC row, the row order of
+    pd.merge() with the PT frame on the left.
+    """
+    order = np.lexsort((ec_rows, first))
+    return ec_rows[order], mrn_codes[order], first[order]
+
+
+def hits_to_matches(hits, ec_df, mrn_lookup):
+    """
+    Converts probe_unique_keys() hits to the match Dataframe find_matches()
+    returns, dropping blank and self relationships and duplicates.
+    """
+
+    path_frames = list()
+    for (columns, path), (ec_rows, mrn_codes, first) in zip(MATCH_PATHS, hits):
+        path_frames.append(pd.DataFrame({
+            'empi_or_mrn': ec_df['MRN_1'].values[ec_rows],
+            'relationship': ec_df['EC_Relationship'].values[ec_rows],
+            'relation_empi_or_mrn': mrn_lookup[mrn_codes],
+            'matched_path': path}))
+
+    df_cumc_patient = pd.concat(path_frames, ignore_index=True)
+
+    # remove blank and self relationships
+    df_cumc_patient = df_cumc_patient[df_cumc_patient.relationship != ""]
+    df_cumc_patient = df_cumc_patient.loc[~(df_cumc_patient['empi_or_mrn'] == df_cumc_patient['relation_empi_or_mrn'])]
+
+    return df_cumc_patient.drop_duplicates()
+
+
+def find_matches_coded(pt_df, ec_df, drop):
+    """
+    Single pass version of find_matches().  Contact columns are integer
+    coded once, uniqueness of all 15 column combinations is computed in one
+    pass over the codes and every EC row is probed once against all of them,
+    instead of 15 groupby/merge passes over the string columns.  Returns the
+    same rows as find_matches().
+
+    Args:
+        ec_df (df): Pandas Dataframe of Emergency Contact Information
+        pt_df (df): Pandas Dataframe of Patient Information
+        drop (boolean/option): How to handle duplicate MRNs in PT Contact data
+                               frame, see find_matches()
+
+    Returns:
+        df_cumc_patient: Pandas Dataframe of Matches
+    """
+
+    if drop:
+        # True, no drop based off of unique MRN
+        pt_df = pt_df.drop_duplicates()
+    else:
+        pt_df = pt_df.drop_duplicates(subset=['MRN'], keep=drop)
+
+    mrn_codes, mrn_lookup = pd.factorize(pt_df['MRN'])
+    pt_keys = encode_match_keys(pt_df)
+    ec_keys = encode_ec_keys(ec_df, pt_keys)
+
+    offsets, key_mrn, key_first = unique_key_table(pt_keys, mrn_codes.astype(np.int64))
+    hits = probe_unique_keys(ec_keys, offsets, key_mrn, key_first)
+
+    return hits_to_matches(hits, ec_df, np.asarray(mrn_lookup))
+
+
+def build_posting_lists(pt_df, mrn_codes):
+    """
+    Builds an inverted index of each PT contact column, the pandas port of
+    the first_hash/last_hash/phone_hash/zip_hash buckets of the original
+    find_matches.py.  Every distinct value points at the sorted PT row ids
+    holding it, stored CSR style in two flat arrays.  Row ids rather than
+    MRNs are posted so that combinations still have to match on one PT row,
+    as they do with pd.merge().
+
+    Args:
+        pt_df (df): Pandas Dataframe of Patient Information
+        mrn_codes (array): Integer code of each PT row's MRN
+
+    Returns:
+        pt_index (dict): Column to (lookup, indptr, postings, row_codes,
+                         value_mrn).  Rows holding value code v are
+                         postings[indptr[v]:indptr[v+1]], value_mrn[v] is
+                         the MRN code holding v or -1 if several do.
+    """
+
+    pt_index = dict()
+    n_mrns = int(mrn_codes.max()) + 1 if len(mrn_codes) > 0 else 1
+
+    for column in MATCH_COLUMNS:
+        row_codes, uniques = pd.factorize(pt_df[column])
+        row_codes = row_codes.astype(np.int64)
+        has_value = np.flatnonzero(row_codes >= 0)
+        postings = has_value[np.argsort(row_codes[has_value], kind='stable')]
+
+        indptr = np.zeros(len(uniques) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(row_codes[has_value], minlength=len(uniques)), out=indptr[1:])
+
+        pairs = pd.unique(row_codes[has_value] * n_mrns + mrn_codes[has_value])
+        mrns_per_value = np.bincount(pairs // n_mrns, minlength=len(uniques))
+        value_mrn = np.full(len(uniques), -1, dtype=np.int64)
+        value_mrn[pairs // n_mrns] = pairs % n_mrns
+        value_mrn[mrns_per_value != 1] = -1
+
+        pt_index[column] = (pd.Index(uniques), indptr, postings, row_codes, value_mrn)
+
+    return pt_index
+
+
+def probe_posting_lists(pt_index, mrn_codes, ec_codes, ec_rows):
+    """
+    Answers all MATCH_PATHS combinations for each EC row by intersecting
+    posting lists.  Each combination starts from its prefix combination's
+    rows, or from the next column's posting list when that is shorter, and
+    keeps the rows whose remaining columns match, so an empty prefix ends
+    the search early.
+
+    Args:
+        pt_index (dict): Output of build_posting_lists()
+        mrn_codes (array): Integer code of each PT row's MRN
+        ec_codes (dict): Column to EC value codes in the PT lookup
+        ec_rows (array): Positions of the EC rows to probe
+
+    Returns:
+        hits (list): One (ec_row, mrn_code, pt_first_row) array tuple per
+                     path, see probe_unique_keys()
+    """
+
+    path_hits = [(list(), list(), list()) for path in MATCH_PATHS]
+    ec_rows = np.asarray(ec_rows, dtype=np.int64)
+    ec_values = [ec_codes[column][ec_rows].tolist() for column in MATCH_COLUMNS]
+
+    for ec_row, row_values in zip(ec_rows.tolist(), zip(*ec_values)):
+        values = dict(zip(MATCH_COLUMNS, row_values))
+
+        candidates = dict()
+        for i, (columns, path) in enumerate(MATCH_PATHS):
+            column = columns[-1]
+            code = values[column]
+            if code < 0 or (len(columns) > 1 and candidates[columns[:-1]] is None):
+                candidates[columns] = None
+                continue
+
+            lookup, indptr, postings, row_codes, value_mrn = pt_index[column]
+            if len(columns) == 1:
+                rows = postings[indptr[code]:indptr[code + 1]]
+                candidates[columns] = rows
+                if value_mrn[code] >= 0:
+                    path_hits[i][0].append(ec_row)
+                    path_hits[i][1].append(value_mrn[code])
+                    path_hits[i][2].append(rows[0])
+                continue
+
+            rows = candidates[columns[:-1]]
+            if len(rows) > indptr[code + 1] - indptr[code]:
+                rows = postings[indptr[code]:indptr[code + 1]]
+                for prefix_column in columns[:-1]:
+                    rows = rows[pt_index[prefix_column][3][rows] == values[prefix_column]]
+            else:
+                rows = rows[row_codes[rows] == code]
+            candidates[columns] = rows
+
+            if len(rows) > 0:
+                mrns = mrn_codes[rows]
+                if (mrns == mrns[0]).all():
+                    path_hits[i][0].append(ec_row)
+                    path_hits[i][1].append(mrns[0])
+                    path_hits[i][2].append(rows[0])
+
+    hits = list()
+    for rows, mrns, first in path_hits:
+        hits.append(sort_hits(np.array(rows, dtype=np.int64), np.array(mrns, dtype=np.int64), np.array(first, dtype=np.int64)))
+
+    return hits
+
+
+def find_matches_index(pt_df, ec_df, drop):
+    """
+    Inverted index version of find_matches().  Builds posting lists of the
+    PT contact columns once and intersects them for every EC row, so memory
+    scales with the distinct values rather than with merge output.  Returns
+    the same rows as find_matches().
+
+    Args:
+        ec_df (df): Pandas Dataframe of Emergency Contact Information
+        pt_df (df): Pandas Dataframe of Patient Information
+        drop (boolean/option): How to handle duplicate MRNs in PT Contact data
+                               frame, see find_matches()
+
+    Returns:
+        df_cumc_patient: Pandas Dataframe of Matches
+    """
+
+    if drop:
+        # True, no drop based off of unique MRN
+        pt_df = pt_df.drop_duplicates()
+    else:
+        pt_df = pt_df.drop_duplicates(subset=['MRN'], keep=drop)
+
+    mrn_codes, mrn_lookup = pd.factorize(pt_df['MRN'])
+    mrn_codes = mrn_codes.astype(np.int64)
+    pt_index = build_posting_lists(pt_df, mrn_codes)
+
+    ec_codes = dict()
+    for column in MATCH_COLUMNS:
+        ec_codes[column] = pt_index[column][0].get_indexer(ec_df['EC_' + column])
+
+    hits = probe_posting_lists(pt_index, mrn_codes, ec_codes, range(len(ec_df.index)))
+
+    return hits_to_matches(hits, ec_df, np.asarray(mrn_lookup))
+
+
+# Read-only matching state of the worker processes, set by
+# init_match_worker().  Workers forked from the parent inherit it without a
+# copy.
+_match_worker_state = None
+
+
+def init_match_worker(state):
+    """
+    Process pool initializer storing the shared matching state.
+    """
+    global _match_worker_state
+    _match_worker_state = state
+
+
+def probe_match_shard(ec_rows):
+    """
+    Probes one shard of EC rows against the shared matching state.
+
+    Args:
+        ec_rows (array): Positions of the EC rows in the shard
+
+    Returns:
+        hits (list): Per path hits of the shard, see probe_unique_keys()
+    """
+    engine, state = _match_worker_state
+    if engine == 'index':
+        pt_index, mrn_codes, ec_codes = state
+        return probe_posting_lists(pt_index, mrn_codes, ec_codes, ec_rows)
+
+    ec_keys, offsets, key_mrn, key_first = state
+    return probe_unique_keys(ec_keys, offsets, key_mrn, key_first, [ec_rows] * len(MATCH_PATHS))
+
+
+def find_matches_parallel(pt_df, ec_df, drop, workers, engine='index'):
+    """
+    Sharded version of find_matches(), replacing the hand split start:end
+    batches of the original batch_find_matches.py.  The PT indexes of the
+    coded or index engine are built once and shared read-only with a local
+    process pool, which probes shards of EC rows concurrently.  Shard hits
+    are merged and sorted the same way as a single process run, so the
+    output does not depend on the number of workers.
+
+    Args:
+        ec_df (df): Pandas Dataframe of Emergency Contact Information
+        pt_df (df): Pandas Dataframe of Patient Information
+        drop (boolean/option): How to handle duplicate MRNs in PT Contact data
+                               frame, see find_matches()
+        workers (int): Number of worker processes
+        engine (str): Engine the PT indexes come from, coded or index
+
+    Returns:
+        df_cumc_patient: Pandas Dataframe of Matches
+    """
+
+    if drop:
+        # True, no drop based off of unique MRN
+        pt_df = pt_df.drop_duplicates()
+    else:
+        pt_df = pt_df.drop_duplicates(subset=['MRN'], keep=drop)
+
+    mrn_codes, mrn_lookup = pd.factorize(pt_df['MRN'])
+    mrn_codes = mrn_codes.astype(np.int64)
+
+    if engine == 'index':
+        pt_index = build_posting_lists(pt_df, mrn_codes)
+        ec_codes = dict()
+        for column in MATCH_COLUMNS:
+            ec_codes[column] = pt_index[column][0].get_indexer(ec_df['EC_' + column])
+        state = (engine, (pt_index, mrn_codes, ec_codes))
+    else:
+        pt_keys = encode_match_keys(pt_df)
+        ec_keys = encode_ec_keys(ec_df, pt_keys)
+        offsets, key_mrn, key_first = unique_key_table(pt_keys, mrn_codes)
+        state = (engine, (ec_keys, offsets, key_mrn, key_first))
+
+    # several shards per worker to even out the load
+    shards = np.array_split(np.arange(len(ec_df.index), dtype=np.int64), max(1, workers * 4))
+
+    with multiprocessing.Pool(processes=workers, initializer=init_match_worker, initargs=(state,)) as pool:
+        shard_hits = pool.map(probe_match_shard, shards)
+
+    hits = list()
+    for i in range(len(MATCH_PATHS)):
+        hits.append(sort_hits(*[np.concatenate([x[i][j] for x in shard_hits]) for j in range(3)]))
+
+    return hits_to_matches(hits, ec_df, np.asarray(mrn_lookup))
+
+
+# How find_matches() is run on PT data with duplicate MRNs, in the order
+# main() concatenates the results.
+DROP_MODES = ['first', 'last', False, True]
+
+
+def drop_mode_mask(pt_df, drop):
+    """
+    Boolean mask of the PT rows find_matches() keeps for a drop option.
+    """
+    if drop:
+        return ~pt_df.duplicated().values
+    return ~pt_df.duplicated(subset=['MRN'], keep=drop).values
+
+
+def find_matches_shared(pt_df, ec_df, drops=DROP_MODES):
+    """
+    Runs find_matches() for every duplicate MRN drop option at once.  The
+    drop options only differ in which rows of duplicated MRNs they keep, so
+    keys no duplicated MRN holds match the same way under every option and
+    are counted and probed once.  Only the keys held by a duplicated MRN are
+    re-evaluated for each option.  Returns the same rows, in the same order,
+    as concatenating and de-duplicating the find_matches() output of each
+    drop option.
+
+    Args:
+        ec_df (df): Pandas Dataframe of Emergency Contact Information
+        pt_df (df): Pandas Dataframe of Patient Information
+        drops (list): Drop options, see find_matches()
+
+    Returns:
+        df_cumc_patient: Pandas Dataframe of Matches
+    """
+
+    mrn_codes, mrn_lookup = pd.factorize(pt_df['MRN'])
+    mrn_codes = mrn_codes.astype(np.int64)
+    mrn_lookup = np.asarray(mrn_lookup)
+    pt_keys = encode_match_keys(pt_df)
+    ec_keys = encode_ec_keys(ec_df, pt_keys)
+
+    dup_mrn = pt_df.duplicated(subset=['MRN'], keep=False).values
+
+    # MRNs are either duplicated or not, so the two MRN counts of a key add up
+    offsets, base_count, base_mrn, base_first = count_key_mrns(pt_keys, mrn_codes, ~dup_mrn)
+    offsets, dup_count, dup_mrn_any, dup_first = count_key_mrns(pt_keys, mrn_codes, dup_mrn)
+    has_dup = dup_count > 0
+
+    shared_mrn = base_mrn.copy()
+    shared_mrn[(base_count != 1) | has_dup] = -1
+    shared_hits = probe_unique_keys(ec_keys, offsets, shared_mrn, base_first)
+
+    # EC rows probing a key held by a duplicated MRN, per path
+    dup_ec_rows = list()
+    for i, (columns, path) in enumerate(MATCH_PATHS):
+        codes = ec_keys[columns]
+        probes = np.flatnonzero(codes >= 0)
+        dup_ec_rows.append(probes[has_dup[codes[probes] + offsets[i]]])
+
+    drop_frames = list()
+    for n, drop in enumerate(drops):
+        rows = drop_mode_mask(pt_df, drop) & dup_mrn
+        offsets, drop_count, drop_mrn, drop_first = count_key_mrns(pt_keys, mrn_codes, rows)
+
+        key_mrn = np.where(base_count > 0, base_mrn, drop_mrn)
+        key_mrn[(base_count + drop_count) != 1] = -1
+        key_first = np.minimum(base_first, drop_first)
+        hits = probe_unique_keys(ec_keys, offsets, key_mrn, key_first, dup_ec_rows)
+
+        if n == 0:
+            # the first option returns every row, later ones only add rows for
+            # keys a duplicated MRN holds
+            hits = [sort_hits(*[np.concatenate(x) for x in zip(a, b)]) for a, b in zip(shared_hits, hits)]
+        drop_frames.append(hits_to_matches(hits, ec_df, mrn_lookup))
+
+    return pd.concat(drop_frames, ignore_index=True).drop_duplicates()
+
+
+MATCH_ENGINES = {'pandas': find_matches, 'coded': find_matches_coded, 'index': find_matches_index}
+
+
+def clean_split_names(a_str):
+    """
+    Cleans and splits names for matching.  Unidecode coverted Unicode characters to UTF-8 ones.
+
+    Args:
+        s_str (str): String to be split
+
+    Returns:
+        n_str: (str) New cleaned and normalized string
+
+    Todo:
+        Split on space for matching of all portions of hyphenaded names and
+        update find_matches() to match on all portions of split names
+    """
+
+    #unicode letters and symbols to
     n_str = unidecode.unidecode(a_str.strip())
 
-    if n_str.strip().lower() == 'none' or n_str.strip().lower() == 'null':
-        return None
+    if n_str.strip().lower() == 'none' or n_str.strip().lower() == 'null':
+        return None
+
+    return a_str.strip().lower().replace("-", " ")  # .split(" ")  TODO
+
+
+def normalize_phone_num(a_str):
+    """
+    Normalizes Phone Number, removing any seperators and country codes.
+
+    Args:
+        a_str (str): String to be Normalizes
+
+    Returns:
+        c_str (str): Cleaned and normalized Phone number String
+
+    """
+
+    # Normalize
+    c_str = a_str.strip().lower().replace("-", "").replace("(", "").replace(")", "").replace(" ", "").replace(".", "").replace("*", "").replace("#", "").replace("+", "").strip()
+
+    # remove phone extentions
+    if "," in c_str:
+        c_str = c_str.split(",")[0]
+
+    if "x" in c_str.lower():
+        c_str = c_str.lower().split("x")[0]
+
+    if "e" in c_str.lower():
+        c_str = c_str.split("e")[0]
+
+    # Drop country codes, only the last 10 digits
+    if len(c_str) > 10:
+        c_str=c_str[-10:]
+
+    # empty phone number
+    if c_str.strip()=="0000000000":
+        return None
+
+    # 10 digit phone number
+    if len(c_str) != 10:
+        return None
+
+    # Only numbers in a phone number
+    if not c_str.isnumeric():
+        return None
+
+    return c_str
+
+
+def normalize_zip_code(a_str):
+    """
+    Normalizes Zip Code
+
+    Args:
+        a_str (str): A string to be Normalized
+
+    Returns:
+        c_str (str): Cleaned and normalized zip code string
+
+    """
+
+    # Normalize
+    c_str = a_str.strip().lower().replace("-", "").replace("(", "").replace(")", "").replace(" ", "").replace(".", "").replace("*", "").replace("#", "").strip()
+
+    # Drop 4 digit extention
+    if len(c_str) >5:
+        c_str=c_str[:5]
+
+    # 5 digit zip code.
+    if len(c_str) != 5:
+        return None
+
+    # Only numbers
+    if not c_str.isnumeric():
+        return None
+
+    return c_str
+
+
+def ascii_table(chars):
+    """Lookup table over byte values marking the given characters"""
+
+    table = np.zeros(256, dtype=bool)
+    table[[ord(x) for x in chars]] = True
+    return table
+
+
+MAX_VECTOR_WIDTH = 64
+WHITESPACE = ascii_table('\t\n\x0b\x0c\r\x1c\x1d\x1e\x1f ')
+# Separators are removed along with the zero padding
+PHONE_SEPARATORS = ascii_table('-() .*#+\x00')
+PHONE_EXTENTIONS = ascii_table(',xXeE')
+ZIP_SEPARATORS = ascii_table('-() .*#\x00')
+DIGITS = ascii_table('0123456789')
+LOWER_CASE = np.arange(256, dtype=np.uint8)
+LOWER_CASE[ord('A'):ord('Z') + 1] += 32
+
+
+def string_code_matrix(strings, max_width=MAX_VECTOR_WIDTH):
+    """
+    Lays a Series of strings out as a matrix of ASCII codes, one row per
+    string, padded with zeros.  Only ASCII strings of at most max_width
+    characters are laid out, the rest are left to the scalar normalizers.
+
+    Args:
+        strings (Series): Strings to lay out
+        max_width (int): Longest string laid out
+
+    Returns:
+        codes (array): uint8 character codes, one row per string
+        vector (array): Mask of the rows laid out
+    """
+
+    values = strings.to_numpy(dtype=object)
+    try:
+        lengths = np.fromiter(map(len, values), dtype=np.int64, count=len(values))
+    except TypeError:
+        # Missing values are left to the scalar normalizers
+        lengths = np.fromiter((len(x) if isinstance(x, str) else max_width + 1 for x in values), dtype=np.int64, count=len(values))
+    vector = lengths <= max_width
+    if not vector.all():
+        values = np.where(vector, values, '')
+    values = values.astype(str)
+
+    codes = values.view(np.uint32).reshape(len(values), values.dtype.itemsize // 4)
+    # Strings containing NUL are cut short by numpy
+    vector &= (codes != 0).sum(axis=1) == lengths
+    vector &= (codes < 128).all(axis=1)
+
+    codes = codes.astype(np.uint8)
+    codes[~vector] = 0
+
+    return codes, vector
+
+
+def code_matrix_strings(codes):
+    """
+    Turns a matrix of ASCII codes back into strings, dropping the zero
+    padding.
+
+    Args:
+        codes (array): Character codes, one row per string
+
+    Returns:
+        array: Object array of strings
+    """
+
+    if codes.shape[1] == 0:
+        return np.full(codes.shape[0], '', dtype=object)
+
+    return np.ascontiguousarray(codes, dtype=np.uint32).view('U' + str(codes.shape[1])).ravel().astype(object)
+
+
+def strip_bounds(codes):
+    """
+    Finds the first and one past the last non whitespace character of each
+    row of a code matrix, as str.strip() would leave them.
+
+    Args:
+        codes (array): Character codes, one row per string
+
+    Returns:
+        start (array): Index of the first non whitespace character
+        end (array): Index one past the last, start if there is none
+    """
+
+    content = (codes != 0) & ~WHITESPACE[codes]
+    has_content = content.any(axis=1)
+    start = np.where(has_content, content.argmax(axis=1), 0)
+    end = np.where(has_content, codes.shape[1] - content[:, ::-1].argmax(axis=1), start)
+
+    return start, end
+
+
+def flatten_codes(codes, keep):
+    """
+    Concatenates the kept characters of every row of a code matrix.
+
+    Args:
+        codes (array): Character codes, one row per string
+        keep (array): Mask of the characters to keep
+
+    Returns:
+        flat (array): Kept characters, row after row
+        offsets (array): Start of each row in flat, and the end of the last
+    """
+
+    offsets = np.zeros(len(codes) + 1, dtype=np.int64)
+    np.cumsum(keep.sum(axis=1), out=offsets[1:])
+
+    return codes[keep], offsets
+
+
+def first_in_rows(mask, offsets):
+    """
+    Index of the first marked character of each row of flattened codes, the
+    end of the row if none is marked.
+    """
+
+    marked = np.append(np.flatnonzero(mask), offsets[-1])
+    first = marked[np.searchsorted(marked, offsets[:-1])]
+
+    return np.minimum(first, offsets[1:])
+
+
+def strip_flat_bounds(flat, offsets):
+    """
+    Finds the first and one past the last non whitespace character of each
+    row of flattened codes, as str.strip() would leave them.  Whitespace is
+    rare, so only its positions are searched.
+
+    Args:
+        flat (array): Flattened character codes
+        offsets (array): Start of each row in flat, and the end of the last
+
+    Returns:
+        start (array): Index of the first non whitespace character
+        end (array): Index one past the last, start if there is none
+    """
+
+    spaces = np.flatnonzero(WHITESPACE[flat])
+    start = offsets[:-1].copy()
+    end = offsets[1:].copy()
+    if len(spaces) == 0:
+        return start, end
+
+    row = np.searchsorted(offsets, spaces, side='right') - 1
+    rank = np.arange(len(spaces))
+
+    # A leading space is preceded by spaces alone, a trailing one followed
+    first_rank = np.searchsorted(spaces, offsets[:-1])
+    leading = spaces - offsets[:-1][row] == rank - first_rank[row]
+    start += np.bincount(row[leading], minlength=len(start))
+
+    last_rank = np.searchsorted(spaces, offsets[1:]) - 1
+    trailing = offsets[1:][row] - 1 - spaces == last_rank[row] - rank
+    end -= np.bincount(row[trailing], minlength=len(end))
+
+    return start, np.maximum(end, start)
+
+
+def digit_strings(flat, start, width):
+    """
+    Gathers width characters of flattened codes from each start, keeping
+    those that are all digits.
+
+    Args:
+        flat (array): Flattened character codes
+        start (array): First character of each window
+        width (int): Characters in a window
+
+    Returns:
+        array: Object array of the digit strings, None for the rest
+    """
+
+    window = flat[start[:, None] + np.arange(width)]
+    digits = DIGITS[window].all(axis=1)
+
+    strings = np.full(len(start), None, dtype=object)
+    strings[digits] = code_matrix_strings(window[digits])
+
+    return strings
+
+
+def apply_vectorized(strings, vectorized, scalar):
+    """
+    Normalizes a Series with a vectorized normalizer over its short ASCII
+    strings and the matching scalar normalizer over the rest.
+
+    Args:
+        strings (Series): Strings to be normalized
+        vectorized (function): Takes a code matrix and returns an object
+            array of normalized strings or None
+        scalar (function): Scalar normalizer giving the same results
+
+    Returns:
+        Series: Normalized strings
+    """
+
+    codes, vector = string_code_matrix(strings)
+
+    normalized = np.empty(len(strings), dtype=object)
+    normalized[vector] = vectorized(codes if vector.all() else codes[vector])
+    if not vector.all():
+        normalized[~vector] = [scalar(x) for x in strings.to_numpy(dtype=object)[~vector]]
+
+    return pd.Series(normalized, index=strings.index, name=strings.name)
+
+
+def clean_split_name_codes(codes):
+    """Vectorized clean_split_names() over a matrix of ASCII codes"""
+
+    codes = LOWER_CASE[codes]
+
+    # Shift the stripped names to the start of each row, only names starting
+    # or ending in whitespace move
+    if codes.shape[1]:
+        last = np.maximum((codes != 0).sum(axis=1) - 1, 0)
+        edged = WHITESPACE[codes[:, 0]] | WHITESPACE[codes[np.arange(len(codes)), last]]
+        if edged.any():
+            start, end = strip_bounds(codes[edged])
+            cols = np.arange(codes.shape[1])
+            stripped = np.take_along_axis(codes[edged], np.minimum(start[:, None] + cols, codes.shape[1] - 1), axis=1)
+            stripped[cols >= (end - start)[:, None]] = 0
+            codes[edged] = stripped
+    codes[codes == ord("-")] = ord(" ")
+
+    names = code_matrix_strings(codes)
+    names[(names == 'none') | (names == 'null')] = None
+
+    return names
+
+
+def clean_split_name_series(names):
+    """
+    Vectorized clean_split_names() over a Series of names.
+
+    Args:
+        names (Series): Strings to be cleaned
+
+    Returns:
+        Series: Cleaned and normalized strings, None for null names
+    """
+
+    return apply_vectorized(names, clean_split_name_codes, clean_split_names)
+
+
+def normalize_phone_num_codes(codes):
+    """Vectorized normalize_phone_num() over a matrix of ASCII codes"""
+
+    flat, offsets = flatten_codes(codes, ~PHONE_SEPARATORS[codes])
+
+    start, end = strip_flat_bounds(flat, offsets)
+
+    # remove phone extentions, everything from the first of , x or e
+    end = np.minimum(end, first_in_rows(PHONE_EXTENTIONS[flat], offsets))
+
+    # Drop country codes, only the last 10 digits
+    valid = end - start >= 10
+    phone_nums = np.full(len(codes), None, dtype=object)
+    phone_nums[valid] = digit_strings(flat, end[valid] - 10, 10)
+    phone_nums[phone_nums == "0000000000"] = None
+
+    return phone_nums
+
+
+def normalize_phone_num_series(phone_nums):
+    """
+    Vectorized normalize_phone_num() over a Series of phone numbers.
+
+    Args:
+        phone_nums (Series): Strings to be Normalized
+
+    Returns:
+        Series: Cleaned and normalized phone numbers, None if not valid
+    """
+
+    return apply_vectorized(phone_nums, normalize_phone_num_codes, normalize_phone_num)
+
+
+def normalize_zip_code_codes(codes):
+    """Vectorized normalize_zip_code() over a matrix of ASCII codes"""
+
+    flat, offsets = flatten_codes(codes, ~ZIP_SEPARATORS[codes])
+
+    start, end = strip_flat_bounds(flat, offsets)
+
+    # Drop 4 digit extention
+    valid = end - start >= 5
+    zip_codes = np.full(len(codes), None, dtype=object)
+    zip_codes[valid] = digit_strings(flat, start[valid], 5)
+
+    return zip_codes
+
+
+def normalize_zip_code_series(zip_codes):
+    """
+    Vectorized normalize_zip_code() over a Series of zip codes.
+
+    Args:
+        zip_codes (Series): Strings to be Normalized
+
+    Returns:
+        Series: Cleaned and normalized zip codes, None if not valid
+    """
+
+    return apply_vectorized(zip_codes, normalize_zip_code_codes, normalize_zip_code)
+
+
+NORMALIZE_CACHE_VERSION = 1
+
+
+def load_normalize_cache(cache_file):
+    """
+    Loads the raw to normalized values saved by earlier runs.  A missing
+    cache file, or one written by a different version of the normalizers,
+    gives an empty cache.
+
+    Args:
+        cache_file (str): Location of the pickled cache
+
+    Returns:
+        dict: Normalized value of each raw value, by normalizer name
+    """
+
+    if cache_file is None or not os.path.exists(cache_file):
+        return dict()
+
+    with open(cache_file, 'rb') as infile:
+        cache = pickle.load(infile)
+
+    if cache.get('version') != NORMALIZE_CACHE_VERSION:
+        return dict()
+
+    return cache['values']
+
+
+def save_normalize_cache(normalize_cache, cache_file):
+    """
+    Saves the normalized values for the next run, replacing the cache file
+    only once it is completely written.
+
+    Args:
+        normalize_cache (dict): Normalized value of each raw value, by
+            normalizer name
+        cache_file (str): Location of the pickled cache
+    """
+
+    with open(cache_file + '.tmp', 'wb') as outfile:
+        pickle.dump({'version': NORMALIZE_CACHE_VERSION, 'values': normalize_cache}, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_file + '.tmp', cache_file)
+
+
+def normalize_distinct(strings, normalizer, normalize_cache=None):
+    """
+    Normalizes each distinct value of a Series once and maps the results
+    back onto its rows.  With a cache only values not seen before are
+    normalized, and the cache is updated with them.
+
+    Args:
+        strings (Series): Strings to be normalized
+        normalizer (function): Vectorized normalizer over a Series
+        normalize_cache (dict): Normalized value of each raw value, by
+            normalizer name
+
+    Returns:
+        Series: Normalized strings
+    """
+
+    codes, uniques = pd.factorize(strings, use_na_sentinel=False)
+    uniques = pd.Series(uniques, dtype=object)
+
+    if normalize_cache is None:
+        normalized = normalizer(uniques).to_numpy(dtype=object)
+    else:
+        cache = normalize_cache.setdefault(normalizer.__name__, dict())
+        normalized = np.array([cache.get(x, cache) for x in uniques], dtype=object)
+        # The cache itself marks values not cached
+        unseen = np.fromiter((x is cache for x in normalized), dtype=bool, count=len(normalized))
+        if unseen.any():
+            normalized[unseen] = normalizer(uniques[unseen]).to_numpy(dtype=object)
+            cache.update((x, y) for x, y in zip(uniques[unseen], normalized[unseen]) if isinstance(x, str))
+
+    return pd.Series(normalized[codes], index=strings.index, name=strings.name)
+
+
+def build_mrn_dictionary(mrn_columns):
+    """
+    Builds the MRN dictionary shared by every stage, giving each MRN a dense
+    integer id.  Ids follow the sort order of the MRN strings, so sorting or
+    grouping by id orders MRNs as their strings would.
+
+    Args:
+        mrn_columns (list): Series of MRN strings
+
+    Returns:
+        mrn_ids (dict): Id of each MRN string
+    """
+
+    mrns = pd.unique(pd.concat(mrn_columns, ignore_index=True).dropna())
+    mrns.sort()
+
+    return dict(zip(mrns.tolist(), range(len(mrns))))
+
+
+def encode_mrns(mrns, mrn_ids):
+    """
+    Codes a Series of MRN strings with the MRN dictionary, missing MRNs as -1.
+
+    Args:
+        mrns (Series): MRN strings
+        mrn_ids (dict): Id of each MRN string
+
+    Returns:
+        array: int32 MRN ids
+    """
+
+    mrn_index = pd.Index(list(mrn_ids), dtype=object)
+    return mrn_index.get_indexer(mrns).astype(np.int32)
+
+
+def mrn_decoder(mrn_ids):
+    """
+    Returns the function giving the MRN string of an MRN id, or passing MRN
+    strings through when mrn_ids is None.
+    """
+
+    if mrn_ids is None:
+        return str
+    return list(mrn_ids).__getitem__
+
+
+def decode_mrn_columns(df, mrn_ids, columns):
+    """
+    Copies a Dataframe with its MRN id columns decoded to MRN strings, for
+    writing out.
+    """
+
+    mrn_names = np.array(list(mrn_ids), dtype=object)
+    return df.assign(**{column: mrn_names[df[column].to_numpy()] for column in columns})
+
+
+def strip_mrn_ids(mrn_ids):
+    """
+    Gives each MRN id the id of its MRN string stripped of whitespace, adding
+    the stripped MRNs missing from the dictionary.
+
+    Args:
+        mrn_ids (dict): Id of each MRN string
+
+    Returns:
+        list: Id of the stripped MRN of each id
+    """
+
+    return [mrn_ids.setdefault(mrn.strip(), len(mrn_ids)) for mrn in list(mrn_ids)]
+
+
+# Sex of each sex code, code 0 for MRN ids without demographic data
+SEX_CODES = np.array([None, 'F', 'M'], dtype=object)
+MISSING_BIRTH_YEAR = np.iinfo(np.int16).min
+
+
+class Demographics(collections.abc.Mapping):
+    """
+    Demographic data held in arrays indexed by MRN id, a code into SEX_CODES
+    and an int16 birth year for each id.  Read only mapping of an MRN id to
+    its (sex, birth year) tuple, birth year None if missing, as the
+    demographic dictionary it replaces.  contains(), sex_codes_of() and
+    birth_years_of() look up arrays of ids at once.
+    """
+
+    def __init__(self, sex_codes, birth_years):
+        self.sex_codes = sex_codes
+        self.birth_years = birth_years
+
+    def __contains__(self, mrn_id):
+        return isinstance(mrn_id, (int, np.integer)) and 0 <= mrn_id < len(self.sex_codes) and self.sex_codes[mrn_id] != 0
+
+    def __getitem__(self, mrn_id):
+        if mrn_id not in self:
+            raise KeyError(mrn_id)
+        birth_year = int(self.birth_years[mrn_id])
+        return tuple([SEX_CODES[self.sex_codes[mrn_id]], None if birth_year == MISSING_BIRTH_YEAR else birth_year])
+
+    def __iter__(self):
+        return iter(np.flatnonzero(self.sex_codes).tolist())
+
+    def __len__(self):
+        return int(np.count_nonzero(self.sex_codes))
+
+    def contains(self, mrn_ids):
+        """Whether each of an array of MRN ids has demographic data"""
+
+        mrn_ids = np.asarray(mrn_ids, dtype=np.int64)
+        known = (mrn_ids >= 0) & (mrn_ids < len(self.sex_codes))
+        known[known] = self.sex_codes[mrn_ids[known]] != 0
+        return known
+
+    def sex_codes_of(self, mrn_ids):
+        """Sex code of each of an array of MRN ids, 0 if unknown"""
+
+        return np.where(self.contains(mrn_ids), self.sex_codes[np.clip(mrn_ids, 0, max(len(self.sex_codes) - 1, 0))], 0)
+
+    def birth_years_of(self, mrn_ids):
+        """Birth year of each of an array of MRN ids, MISSING_BIRTH_YEAR if unknown"""
+
+        return np.where(self.contains(mrn_ids), self.birth_years[np.clip(mrn_ids, 0, max(len(self.birth_years) - 1, 0))], MISSING_BIRTH_YEAR)
+
+
+def parse_birth_years(birth_years):
+    """
+    Parses birth years to int16.  Birth years that are not whole numbers
+    within the range of int16 are read as missing, MISSING_BIRTH_YEAR.
+
+    Args:
+        birth_years (Series): Birth years as read
+
+    Returns:
+        array: int16 birth years
+    """
+
+    years = pd.to_numeric(birth_years, errors='coerce').to_numpy(dtype=np.float64)
+    valid = (years == np.floor(years)) & (years > MISSING_BIRTH_YEAR) & (years <= np.iinfo(np.int16).max)
+
+    return np.where(valid, years, MISSING_BIRTH_YEAR).astype(np.int16)
+
+
+def decode_birth_year_columns(df, columns):
+    """
+    Copies a Dataframe with its int16 birth year columns as float32, NaN
+    where missing, for writing out.
+    """
+
+    return df.assign(**{column: np.where(df[column].to_numpy() == MISSING_BIRTH_YEAR, np.nan, df[column].to_numpy()).astype(np.float32) for column in columns})
+
+
+def build_demographics(mrns, sexes, birth_years, n_ids):
+    """
+    Builds the demographic arrays of coded, distinct MRNs.  Rows without an
+    MRN, coded -1, are skipped.
+
+    Args:
+        mrns (array): MRN ids
+        sexes (Series): Sex of each MRN, F or M
+        birth_years (array): int16 birth year of each MRN, see
+            parse_birth_years()
+        n_ids (int): Number of ids in the MRN dictionary
+
+    Returns:
+        Demographics: Demographic data by MRN id
+    """
+
+    mrns = np.asarray(mrns, dtype=np.int64)
+    coded = mrns >= 0
+    sexes = sexes.to_numpy()[coded]
+
+    sex_codes = np.zeros(n_ids, dtype=np.int8)
+    sex_codes[mrns[coded]] = np.select([sexes == SEX_CODES[1], sexes == SEX_CODES[2]], [1, 2], 0)
+
+    demographic_years = np.full(n_ids, MISSING_BIRTH_YEAR, dtype=np.int16)
+    demographic_years[mrns[coded]] = np.asarray(birth_years)[coded]
+
+    return Demographics(sex_codes, demographic_years)
+
+
+PT_COLUMNS = ['MRN', 'FirstName', 'LastName', 'PhoneNumber', 'Zipcode']
+EC_COLUMNS = ['MRN_1', 'EC_FirstName', 'EC_LastName', 'EC_PhoneNumber', 'EC_Zipcode', 'EC_Relationship']
+DG_COLUMNS = ['MRN', 'BirthYear', 'Sex']
+LINK_LIST_COLUMNS = ['empi_or_mrn', 'relationship', 'relation_empi_or_mrn']
+
+# Input and output file formats.  parquet and feather require pyarrow.
+FILE_FORMATS = ('tsv', 'parquet', 'feather')
+
+
+def format_file_name(file_name, file_format):
+    """Swaps the .tsv extension of a file name for that of file_format"""
+
+    if file_format == 'tsv':
+        return file_name
+    return os.path.splitext(file_name)[0] + '.' + file_format
+
+
+def read_columnar_batches(in_file, file_format, chunk_rows=None):
+    """
+    Reads a Parquet or Feather file as Arrow tables, whole or in batches.
+    Requires pyarrow.
+
+    Args:
+        in_file (str): Location of the file
+        file_format (str): parquet or feather
+        chunk_rows (int): Rows per batch, the whole file in one if None
+
+    Yields:
+        Table or RecordBatch: The next batch of rows
+    """
+
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+
+    if file_format == 'parquet':
+        parquet_file = pq.ParquetFile(in_file)
+        if chunk_rows is None:
+            yield parquet_file.read()
+        else:
+            yield from parquet_file.iter_batches(batch_size=chunk_rows)
+    else:
+        table = feather.read_table(in_file, memory_map=True)
+        if chunk_rows is None:
+            yield table
+        else:
+            yield from table.to_batches(max_chunksize=chunk_rows)
+
+
+def string_columns(batch):
+    """
+    Casts each column of an Arrow table or batch to an object array of
+    strings, None for nulls.
+    """
+
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    return [pc.cast(column, pa.string()).to_numpy(zero_copy_only=False) for column in batch.columns]
+
+
+def read_columnar_chunks(in_file, columns, file_format, chunk_rows=None):
+    """
+    Reads a Parquet or Feather file as string columns, whole or in chunks,
+    as read_tsv_chunks() reads a tab seperated one.  Typed columns are cast
+    to strings and nulls read as NaN.
+
+    Args:
+        in_file (str): Location of the file
+        columns (list): Column names given to the file's columns
+        file_format (str): parquet or feather
+        chunk_rows (int): Rows per chunk, the whole file in one if None
+
+    Yields:
+        DataFrame: The next chunk of rows
+    """
+
+    for batch in read_columnar_batches(in_file, file_format, chunk_rows):
+        chunk = pd.DataFrame({i: np.where(pd.isnull(values), np.nan, values) for i, values in enumerate(string_columns(batch))})
+        chunk.columns = columns
+        yield chunk
+
+
+def read_input_chunks(in_file, columns, input_format, encoding=None, encoding_sample_bytes=ENCODING_SAMPLE_BYTES, chunk_rows=None):
+    """
+    Reads an input file of any of FILE_FORMATS as string columns, whole or
+    in chunks.  The encoding of a tab seperated file is detected if not
+    given.
+    """
+
+    if input_format == 'tsv':
+        return read_tsv_chunks(in_file, columns, encoding or find_encoding(in_file, encoding_sample_bytes), chunk_rows)
+    return read_columnar_chunks(in_file, columns, input_format, chunk_rows)
+
+
+def read_input_lines(in_file, input_format='tsv'):
+    """
+    Reads the rows of an input file of any of FILE_FORMATS as tab seperated
+    lines.  Parquet and Feather files have no header line, and nulls are
+    read as empty fields.
+    """
+
+    if input_format == 'tsv':
+        with open(in_file, 'rt') as infile:
+            yield from infile
+        return
+
+    for batch in read_columnar_batches(in_file, input_format):
+        columns = [np.where(pd.isnull(values), '', values) for values in string_columns(batch)]
+        for row in zip(*columns):
+            yield "\t".join(row) + "\n"
+
+
+def write_frame(df, file_location, out_file_name, file_format='tsv'):
+    """
+    Writes a DataFrame as a tab seperated, Parquet or Feather file, swapping
+    the .tsv extension of out_file_name for that of the format.  The
+    columnar formats keep the column types and dictionary encode text
+    columns.
+    """
+
+    out_file = file_location + os.sep + format_file_name(out_file_name, file_format)
+
+    if file_format == 'tsv':
+        df.to_csv(out_file, sep='\t', index=False)
+        return
+
+    df = df.astype({column: 'category' for column in df.columns if df[column].dtype == object})
+    if file_format == 'parquet':
+        df.to_parquet(out_file, index=False)
+    else:
+        df.reset_index(drop=True).to_feather(out_file)
+
+
+def read_tsv_chunks(in_file, columns, encoding, chunk_rows=None):
+    """
+    Reads a tab seperated file as string columns, whole or in chunks.
+
+    Args:
+        in_file (str): Location of the tab seperated file
+        columns (list): Column names given to the file's columns
+        encoding (str): Encoding of the file
+        chunk_rows (int): Rows per chunk, the whole file in one if None
+
+    Yields:
+        DataFrame: The next chunk of rows
+    """
+
+    reader = pd.read_csv(in_file, sep='\t', dtype=str, encoding=encoding, chunksize=chunk_rows)
+    for chunk in ([reader] if chunk_rows is None else reader):
+        chunk.columns = columns
+        yield chunk
+
+
+def encode_raw_rows(chunk, dictionaries):
+    """
+    Codes the raw rows of a chunk against dictionaries of every value seen in
+    each column so far, so rows can be compared across chunks without
+    keeping them.  Missing values are coded -1 and left out of the
+    dictionaries.
+
+    Args:
+        chunk (DataFrame): Raw rows
+        dictionaries (list): Code of each value of each column, extended
+            with the new values of the chunk
+
+    Returns:
+        array: int32 codes of the distinct rows of the chunk
+    """
+
+    codes = np.empty((len(chunk.index), len(chunk.columns)), dtype=np.int32)
+    for i, column in enumerate(chunk.columns):
+        value_codes, uniques = pd.factorize(chunk[column])
+        dictionary = dictionaries[i]
+        unique_codes = np.array([dictionary.setdefault(x, len(dictionary)) for x in uniques] + [-1], dtype=np.int32)
+        codes[:, i] = unique_codes[value_codes]
+
+    return distinct_rows(codes)
+
+
+def distinct_rows(codes):
+    """Drops repeated rows of a code matrix, keeping the first of each"""
+
+    return pd.DataFrame(codes).drop_duplicates().to_numpy()
+
+
+def stream_clean(chunks, clean_chunk, as_str=True):
+    """
+    Cleans a file chunk by chunk, keeping only the distinct cleaned rows of
+    each, while counting the raw rows, distinct raw rows and distinct raw
+    IDs the whole file would have.
+
+    Args:
+        chunks (iterator): DataFrames of raw rows, IDs in the first column
+        clean_chunk (function): Normalizes and filters a DataFrame of rows
+        as_str (bool): Read missing values as the string 'nan'
+
+    Returns:
+        df (DataFrame): Distinct cleaned rows, in order of first appearance
+        raw_rows (int): Raw rows read
+        raw_distinct_rows (int): Distinct raw rows read
+        raw_ids (int): Distinct raw IDs read
+    """
+
+    raw_rows = 0
+    dictionaries = None
+    raw_codes = list()
+    cleaned = list()
+
+    for chunk in chunks:
+        if as_str:
+            chunk = chunk.astype(str)
+        if dictionaries is None:
+            dictionaries = [dict() for column in chunk.columns]
+
+        raw_rows += len(chunk.index)
+        raw_codes.append(encode_raw_rows(chunk, dictionaries))
+        cleaned.append(clean_chunk(chunk).drop_duplicates())
+
+        # Drop rows repeated across chunks each time the rows kept double
+        if sum(len(x) for x in raw_codes) > 2 * len(raw_codes[0]):
+            raw_codes = [distinct_rows(np.concatenate(raw_codes))]
+        if sum(len(x.index) for x in cleaned) > 2 * len(cleaned[0].index):
+            cleaned = [pd.concat(cleaned).drop_duplicates()]
+
+    if len(cleaned) == 1:
+        df = cleaned[0]
+    else:
+        df = pd.concat(cleaned).drop_duplicates()
+
+    raw_distinct_rows = len(distinct_rows(np.concatenate(raw_codes)))
+
+    return df, raw_rows, raw_distinct_rows, len(dictionaries[0])
+
+
+def clean_pt_chunk(pt_df, normalize_cache=None):
+    """
+    Normalizes Patient rows and drops those without a first name, last name
+    or phone number.
+
+    Args:
+        pt_df (DataFrame): Raw Patient rows
+        normalize_cache (dict): Normalized values by normalizer name
+
+    Returns:
+        DataFrame: Cleaned Patient rows
+    """
+
+    pt_df['FirstName'] = normalize_distinct(pt_df['FirstName'], clean_split_name_series, normalize_cache)
+    pt_df['LastName'] = normalize_distinct(pt_df['LastName'], clean_split_name_series, normalize_cache)
+    pt_df['PhoneNumber'] = normalize_distinct(pt_df['PhoneNumber'], normalize_phone_num_series, normalize_cache)
+    pt_df['Zipcode'] = normalize_distinct(pt_df['Zipcode'], normalize_zip_code_series, normalize_cache)
+
+    # Require First, Last, Phone Number not be Null
+    return pt_df.dropna(subset=['FirstName', 'LastName', 'PhoneNumber'])
+
+
+def clean_ec_chunk(ec_df, rel_abbrev_group, normalize_cache=None):
+    """
+    Normalizes Emergency Contact rows and drops those without a first name,
+    last name, phone number or known relationship.
+
+    Args:
+        ec_df (DataFrame): Raw Emergency Contact rows
+        rel_abbrev_group (dict): Relationship group of each relationship
+        normalize_cache (dict): Normalized values by normalizer name
+
+    Returns:
+        DataFrame: Cleaned Emergency Contact rows
+    """
+
+    ec_df['EC_FirstName'] = normalize_distinct(ec_df['EC_FirstName'], clean_split_name_series, normalize_cache)
+    ec_df['EC_LastName'] = normalize_distinct(ec_df['EC_LastName'], clean_split_name_series, normalize_cache)
+    ec_df['EC_PhoneNumber'] = normalize_distinct(ec_df['EC_PhoneNumber'], normalize_phone_num_series, normalize_cache)
+    ec_df['EC_Zipcode'] = normalize_distinct(ec_df['EC_Zipcode'], normalize_zip_code_series, normalize_cache)
+
+    # Standardize relationships
+    ec_df['EC_Relationship'] = ec_df['EC_Relationship'].str.lower()
+    ec_df['EC_Relationship'] = ec_df['EC_Relationship'].map(rel_abbrev_group)
+
+    # drop unknown relationship
+    ec_df = ec_df.loc[ec_df["EC_Relationship"].isin(rel_abbrev_group.values())]
+
+    # Require First, Last, Phone Number, and EC Relation not be Null
+    return ec_df.dropna(subset=['EC_FirstName', 'EC_PhoneNumber', 'EC_LastName', 'EC_Relationship'])
+
+
+def clean_dg_chunk(dg_df, normalize_cache=None):
+    """
+    Sets Sex to the letters F or M and drops any non conforming Demographic
+    rows.
+
+    Args:
+        dg_df (DataFrame): Raw Demographic rows
+        normalize_cache (dict): Normalized values by normalizer name
+
+    Returns:
+        DataFrame: Cleaned Demographic rows
+    """
 
-    return a_str.strip().lower().replace("-", " ")  # .split(" ")  TODO
+    dg_df['Sex'] = normalize_distinct(dg_df['Sex'], fix_sex_series, normalize_cache)
 
+    return dg_df.dropna(subset=['Sex'])
 
-def normalize_phone_num(a_str):
+
+def normalize_load(pt_file, ec_file, dg_file, rel_abbrev_group, file_location, normalize_cache=None, encoding=None, encoding_sample_bytes=ENCODING_SAMPLE_BYTES, chunk_rows=None, input_format='tsv'):
     """
-    Normalizes Phone Number, removing any seperators and country codes.
+    Normalizes names from the Emergency Contact and Patient data and loads
+    it into pandas data frame.  With chunk_rows the files are streamed in
+    chunks, keeping only the distinct cleaned rows of each, and the QC
+    counts are gathered as the chunks stream in.
 
     Args:
-        a_str (str): String to be Normalizes
+        pt_file (str): Location of the tab seperated Patient data file
+        ec_file (str): Location of the tab seperated Emergency Contact file
+        normalize_cache (dict): Normalized values from earlier runs, updated
+            with the values normalized by this one
+        encoding (str): Encoding of tab seperated input files, detected for
+            each file if None
+        encoding_sample_bytes (int): Bytes of each file read to detect its
+            encoding
+        chunk_rows (int): Rows read at a time, whole files if None
+        input_format (str): Format of the input files, one of FILE_FORMATS
 
     Returns:
-        c_str (str): Cleaned and normalized Phone number String
+        list: list containing the pandas dataframes of cleaned data, with
+              MRNs coded by the MRN dictionary, the Demographics of the
+              MRN ids and the MRN dictionary
+
+    Todo:
+        Validate MRN format.
 
     """
 
-    # Normalize
-    c_str = a_str.strip().lower().replace("-", "").replace("(", "").replace(")", "").replace(" ", "").replace(".", "").replace("*", "").replace("#", "").replace("+", "").strip()
+    outfile = open(file_location + os.sep + "QC_stats.tsv", 'wt')
 
-    # remove phone extentions
-    if "," in c_str:
-        c_str = c_str.split(",")[0]
+    # Values repeat across chunks, so normalize each once
+    if normalize_cache is None and chunk_rows is not None:
+        normalize_cache = dict()
 
-    if "x" in c_str.lower():
-        c_str = c_str.lower().split("x")[0]
+    pt_chunks = read_input_chunks(pt_file, PT_COLUMNS, input_format, encoding, encoding_sample_bytes, chunk_rows)
+    with measure('PT_FILE') as metric:
+        pt_df, pt_row_count, pt_distinct_count, pt_uniq_pt_count = stream_clean(pt_chunks, functools.partial(clean_pt_chunk, normalize_cache=normalize_cache))
+        metric['rows_in'] = {'raw': pt_row_count}
+        metric['rows_out'] = {'pt_df': len(pt_df.index)}
 
-    if "e" in c_str.lower():
-        c_str = c_str.split("e")[0]
+    # print("Raw number of records in PT_FILE:\t" + str(pt_row_count))
+    outfile.write("Raw number of records in PT_FILE:\t" + str(pt_row_count)+"\n")
 
-    # Drop country codes, only the last 10 digits
-    if len(c_str) > 10:
-        c_str=c_str[-10:]
+    ec_chunks = read_input_chunks(ec_file, EC_COLUMNS, input_format, encoding, encoding_sample_bytes, chunk_rows)
+    with measure('EC_FILE') as metric:
+        ec_df, ec_row_count, ec_distinct_count, ec_uniq_pt_count = stream_clean(ec_chunks, functools.partial(clean_ec_chunk, rel_abbrev_group=rel_abbrev_group, normalize_cache=normalize_cache))
+        metric['rows_in'] = {'raw': ec_row_count}
+        metric['rows_out'] = {'ec_df': len(ec_df.index)}
 
-    # empty phone number
-    if c_str.strip()=="0000000000":
-        return None
+    outfile.write("Raw number of records in EC_FILE:\t" + str(ec_row_count)+"\n")
 
-    # 10 digit phone number
-    if len(c_str) != 10:
+    # Duplicate rows dropped
+    outfile.write("Raw row duplicates dropped from PT_FILE:\t" + str(pt_row_count - pt_distinct_count)+"\n")
+    outfile.write("Raw row duplicates dropped from EC_FILE:\t" + str(ec_row_count - ec_distinct_count)+"\n")
+
+    pt_row_count = pt_distinct_count
+    ec_row_count = ec_distinct_count
+
+    outfile.write("Total rows dropped from PT_FILE for incomplete data:\t" + str(pt_row_count - len(pt_df.index))+"\n")
+    outfile.write("Total rows dropped from EC_FILE for incomplete data:\t" + str(ec_row_count - len(ec_df.index))+"\n")
+
+    outfile.write("Number of PT Record IDs dropped from analysis for incomplete data:\t"+ str(pt_uniq_pt_count - pt_df['MRN'].nunique())+"\n")
+    outfile.write("Number of EC Record IDs dropped from analysis for incomplete data:\t"+ str(ec_uniq_pt_count - ec_df['MRN_1'].nunique())+"\n")
+
+    outfile.write("Number of PT Record IDs for analysis:\t"+ str(pt_df['MRN'].nunique())+"\n")
+    outfile.write("Number of EC Record IDs for analysis:\t"+ str(ec_df['MRN_1'].nunique())+"\n\n")
+
+    dg_chunks = read_input_chunks(dg_file, DG_COLUMNS, input_format, encoding, encoding_sample_bytes, chunk_rows)
+    with measure('DG_FILE') as metric:
+        dg_df, dg_row_count, dg_distinct_count, dg_uniqe_ids = stream_clean(dg_chunks, functools.partial(clean_dg_chunk, normalize_cache=normalize_cache), as_str=False)
+        metric['rows_in'] = {'raw': dg_row_count}
+        metric['rows_out'] = {'dg_df': len(dg_df.index)}
+
+    outfile.write("Raw number of Demographic Records rows for analysis:\t"+ str(dg_row_count)+"\n")
+
+    outfile.write("Raw number of Demographic Record IDs for analysis:\t"+ str(dg_uniqe_ids)+"\n")
+
+    dg_df = dg_df.drop_duplicates(subset=['MRN'], keep=False)
+    dg_df['BirthYear'] = parse_birth_years(dg_df['BirthYear'])
+
+    outfile.write("Number of Demographic Records dropped form analysis for incomplete data:\t"+ str(dg_uniqe_ids - dg_df['MRN'].nunique())+"\n")
+
+    outfile.write("Number of Demographic Record IDs for analysis:\t"+ str(dg_df['MRN'].nunique())+"\n\n")
+
+    # MRNs are carried as ids of the shared MRN dictionary from here on
+    mrn_ids = build_mrn_dictionary([pt_df['MRN'], ec_df['MRN_1'], dg_df['MRN']])
+    pt_df['MRN'] = encode_mrns(pt_df['MRN'], mrn_ids)
+    ec_df['MRN_1'] = encode_mrns(ec_df['MRN_1'], mrn_ids)
+    dg_df['MRN'] = encode_mrns(dg_df['MRN'], mrn_ids)
+
+    dg_dict = build_demographics(dg_df['MRN'], dg_df['Sex'], dg_df['BirthYear'].to_numpy(), len(mrn_ids))
+
+    return pt_df, ec_df, dg_df, dg_dict, mrn_ids
+
+
+METRICS_VERSION = 2
+
+# Metrics of the steps measured in this process, in the order they
+# finished, and the metrics of the steps being measured
+RUN_METRICS = list()
+MEASURE_STACK = list()
+
+
+def read_peak_rss():
+    """
+    Peak resident set size of this process in bytes.  On Linux it covers the
+    time since reset_peak_rss(), elsewhere the life of the process.  None if
+    it can not be read.
+    """
+
+    try:
+        with open('/proc/self/status', 'rt') as infile:
+            for line in infile:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        import resource
+    except ImportError:
         return None
 
-    # Only numbers in a phone number
-    if not c_str.isnumeric():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+def read_rss():
+    """Resident set size of this process in bytes, None if it can not be read"""
+
+    try:
+        with open('/proc/self/status', 'rt') as infile:
+            for line in infile:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return None
+
+
+def read_child_peak_rss():
+    """
+    Largest peak resident set size of the worker processes that have exited,
+    in bytes.  None if it can not be read.
+    """
+
+    try:
+        import resource
+    except ImportError:
         return None
 
-    return c_str
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
 
 
-def normalize_zip_code(a_str):
+def reset_peak_rss():
+    """Resets the peak resident set size on Linux, returns whether it could"""
+
+    try:
+        with open('/proc/self/clear_refs', 'wt') as outfile:
+            outfile.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def row_counts(values):
+    """Number of rows of each DataFrame, dictionary or list of a dict of state"""
+
+    return {name: len(value) for name, value in values.items() if isinstance(value, (pd.DataFrame, dict, list, Demographics))}
+
+
+@contextlib.contextmanager
+def measure(step, rows_in=None):
     """
-    Normalizes Zip Code
+    Measures the wall time, CPU time and peak resident set size of a step of
+    the pipeline and appends them to RUN_METRICS.  Steps measured within a
+    step are named after it, as in infer/round 1.  The step may set the
+    rows_in and rows_out row counts of the yielded metric.
+
+    CPU time of worker processes is counted once they have exited.  Peak
+    RSS covers the step itself where the platform can reset it, the life of
+    the process otherwise, see peak_rss_scope.  It includes the memory held
+    before the step started, rss_growth_bytes is the peak less the RSS at
+    the start of the step.  child_peak_rss_bytes is the peak RSS of the
+    largest worker process that exited during the step, known only when it
+    is above that of every earlier worker.
 
     Args:
-        a_str (str): A string to be Normalized
+        step (str): Name of the step
+        rows_in (dict): Number of rows of each input of the step
 
-    Returns:
-        c_str (str): Cleaned and normalized zip code string
+    Yields:
+        dict: The metric of the step
+    """
 
+    name = step if not MEASURE_STACK else MEASURE_STACK[-1]['step'] + '/' + step
+    metric = {'step': name, 'rows_in': rows_in or dict(), 'rows_out': dict()}
+
+    # The step's reset loses the peak of the enclosing step so far
+    peak_rss = read_peak_rss()
+    if MEASURE_STACK and peak_rss is not None:
+        MEASURE_STACK[-1]['peak_rss_seen'] = max(MEASURE_STACK[-1]['peak_rss_seen'] or 0, peak_rss)
+    metric['peak_rss_scope'] = 'step' if reset_peak_rss() else 'process'
+    metric['peak_rss_seen'] = None
+    start_rss = read_rss()
+    start_child_peak_rss = read_child_peak_rss()
+
+    MEASURE_STACK.append(metric)
+    start_times = os.times()
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    try:
+        yield metric
+    finally:
+        MEASURE_STACK.pop()
+        end_times = os.times()
+        metric['wall_seconds'] = time.perf_counter() - start_wall
+        metric['cpu_seconds'] = time.process_time() - start_cpu
+        metric['child_cpu_seconds'] = (end_times.children_user + end_times.children_system) - (start_times.children_user + start_times.children_system)
+
+        peak_rss = read_peak_rss()
+        if peak_rss is not None and metric['peak_rss_seen'] is not None:
+            peak_rss = max(peak_rss, metric['peak_rss_seen'])
+        metric['peak_rss_bytes'] = peak_rss
+        metric['rss_growth_bytes'] = None if peak_rss is None or start_rss is None else max(peak_rss - start_rss, 0)
+        child_peak_rss = read_child_peak_rss()
+        metric['child_peak_rss_bytes'] = child_peak_rss if child_peak_rss is not None and child_peak_rss > start_child_peak_rss else None
+        del metric['peak_rss_seen']
+        if MEASURE_STACK and peak_rss is not None:
+            MEASURE_STACK[-1]['peak_rss_seen'] = max(MEASURE_STACK[-1]['peak_rss_seen'] or 0, peak_rss)
+
+        RUN_METRICS.append(metric)
+
+
+def write_run_metrics(file_location, started):
     """
+    Writes the metrics of the steps measured so far to run_metrics.json.
 
-    # Normalize
-    c_str = a_str.strip().lower().replace("-", "").replace("(", "").replace(")", "").replace(" ", "").replace(".", "").replace("*", "").replace("#", "").strip()
+    Args:
+        file_location (str): Directory output files are saved to
+        started (float): Time the run started, seconds since the epoch
+    """
 
-    # Drop 4 digit extention
-    if len(c_str) >5:
-        c_str=c_str[:5]
+    run_metrics = {'version': METRICS_VERSION, 'started': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(started)), 'argv': sys.argv[1:], 'steps': RUN_METRICS}
 
-    # 5 digit zip code.
-    if len(c_str) != 5:
-        return None
+    with open(file_location + os.sep + 'run_metrics.json', 'wt') as outfile:
+        json.dump(run_metrics, outfile, indent=1)
 
-    # Only numbers
-    if not c_str.isnumeric():
-        return None
 
-    return c_str
+def read_qc_stats(file_location):
+    """Reads the QC stats written so far"""
+
+    with open(file_location + os.sep + "QC_stats.tsv", 'rt') as infile:
+        return infile.read()
 
 
-def normalize_load(pt_file, ec_file, dg_file, rel_abbrev_group, file_location):
+def load_stage(cli_args, rel_abbrev_group):
+    """
+    Step 1: Loads and normalizes the PT, EC and Demographic data.
     """
-    Normalizes names from the Emergency Contact and Patient data and loads
-    it into pandas data frame.
 
-    Args:
-        pt_file (str): Location of the tab seperated Patient data file
-        ec_file (str): Location of the tab seperated Emergency Contact file
+    normalize_cache = None
+    if cli_args.normalize_cache is not None:
+        normalize_cache = load_normalize_cache(cli_args.normalize_cache)
+    pt_df, ec_df, dg_df, dg_dict, mrn_ids = normalize_load(cli_args.pt_file, cli_args.ec_file, cli_args.dg_file, rel_abbrev_group, cli_args.out_dir, normalize_cache, cli_args.encoding, cli_args.encoding_sample_mb * 1024 * 1024, cli_args.chunk_rows, cli_args.input_format)
+    if normalize_cache is not None:
+        save_normalize_cache(normalize_cache, cli_args.normalize_cache)
 
-    Returns:
-        list: list containing two pandas dataframes of cleaned data
+    # Demographics are looked up in dg_dict from here on
+    return {'pt_df': pt_df, 'ec_df': ec_df, 'dg_dict': dg_dict, 'mrn_ids': mrn_ids, 'qc_stats': read_qc_stats(cli_args.out_dir)}
 
-    Todo:
-        Validate MRN format.
 
+def match_stage(cli_args, pt_df, ec_df, mrn_ids):
+    """
+    Matches PT to EC data.
     """
 
-    outfile = open(file_location + os.sep + "QC_stats.tsv", 'wt')
+    print("Finding Matches")
+
+    # Matches on unique, so deal with duplicat MRNs by dropping first, then last, then all
+    if cli_args.share_drop_matching:
+        with measure('find_matches_shared', row_counts({'pt_df': pt_df, 'ec_df': ec_df})) as metric:
+            df_cumc_patient = find_matches_shared(pt_df, ec_df)
+            metric['rows_out'] = row_counts({'df_cumc_patient': df_cumc_patient})
+    else:
+        match_engine = MATCH_ENGINES[cli_args.match_engine]
+        if cli_args.workers > 1 and cli_args.match_engine != 'pandas':
+            match_engine = functools.partial(find_matches_parallel, workers=cli_args.workers, engine=cli_args.match_engine)
 
-    my_encoding = find_encoding(pt_file)
-    pt_df = pd.read_csv(pt_file, sep='\t', dtype=str, encoding=my_encoding)
-    pt_df.columns = ['MRN', 'FirstName', 'LastName', 'PhoneNumber', 'Zipcode']
-    pt_df['MRN'] = pt_df['MRN'].astype(str)
-    pt_df['FirstName'] = pt_df['FirstName'].astype(str)
-    pt_df['LastName'] = pt_df['LastName'].astype(str)
-    pt_df['PhoneNumber'] = pt_df['PhoneNumber'].astype(str)
-    pt_df['Zipcode'] = pt_df['Zipcode'].astype(str)
-    pt_row_count = len(pt_df.index)
+        matches = list()
+        for drop in DROP_MODES:
+            with measure('find_matches drop=' + str(drop), row_counts({'pt_df': pt_df, 'ec_df': ec_df})) as metric:
+                matches.append(match_engine(pt_df, ec_df, drop))
+                metric['rows_out'] = row_counts({'df_cumc_patient': matches[-1]})
+        df_cumc_patient_last, df_cumc_patient_first, df_cumc_patient_false, df_cumc_patient_true = matches
 
-    # print("Raw number of records in PT_FILE:\t" + str(pt_row_count))
-    outfile.write("Raw number of records in PT_FILE:\t" + str(pt_row_count)+"\n")
+        df_cumc_patient = pd.concat([df_cumc_patient_last, df_cumc_patient_first, df_cumc_patient_false, df_cumc_patient_true], ignore_index=True)
+        df_cumc_patient.reset_index(drop=True)
 
-    my_encoding = find_encoding(ec_file)
-    ec_df = pd.read_csv(ec_file, sep='\t', dtype=str, encoding=my_encoding)
-    ec_df.columns = ['MRN_1', 'EC_FirstName', 'EC_LastName', 'EC_PhoneNumber', 'EC_Zipcode', 'EC_Relationship']
-    ec_df['MRN_1'] = ec_df['MRN_1'].astype(str)
-    ec_df['EC_FirstName'] = ec_df['EC_FirstName'].astype(str)
-    ec_df['EC_LastName'] = ec_df['EC_LastName'].astype(str)
-    ec_df['EC_PhoneNumber'] = ec_df['EC_PhoneNumber'].astype(str)
-    ec_df['EC_Zipcode'] = ec_df['EC_Zipcode'].astype(str)
-    ec_df['EC_Relationship'] = ec_df['EC_Relationship'].astype(str)
+        df_cumc_patient = df_cumc_patient.drop_duplicates()
+    if cli_args.keep_intermediates:
+        write_frame(decode_mrn_columns(df_cumc_patient, mrn_ids, ['empi_or_mrn', 'relation_empi_or_mrn']), cli_args.out_dir, 'df_cumc_patient.tmp.tsv', cli_args.output_format)
 
-    ec_row_count = len(ec_df.index)
+    return {'df_cumc_patient': df_cumc_patient}
 
-    outfile.write("Raw number of records in EC_FILE:\t" + str(ec_row_count)+"\n")
 
-    # Drop duplicate rows
-    pt_df = pt_df.drop_duplicates()
-    ec_df = ec_df.drop_duplicates()
+def clean_stage(cli_args, df_cumc_patient, dg_dict, mrn_ids, group_opposite):
+    """
+    Step 2: Merges demographic data with the matches and cleans them.
+    """
+
+    print("Cleaning Matches")
+    with measure('merge_matches_demog', row_counts({'df_cumc_patient': df_cumc_patient, 'dg_dict': dg_dict})) as metric:
+        df_cumc_patient_wdg = merge_matches_demog(df_cumc_patient, dg_dict)
+        metric['rows_out'] = row_counts({'df_cumc_patient_wdg': df_cumc_patient_wdg})
+    if cli_args.keep_intermediates:
+        write_frame(decode_birth_year_columns(decode_mrn_columns(df_cumc_patient_wdg, mrn_ids, ['empi_or_mrn', 'relation_empi_or_mrn']), ['DOB_empi', 'DOB_matched']), cli_args.out_dir, 'df_cumc_patient_wdg.tmp.tsv', cli_args.output_format)
+    with measure('match_cleanup', row_counts({'df_cumc_patient_wdg': df_cumc_patient_wdg})) as metric:
+        df_cumc_patient_wdg_clean = match_cleanup(df_cumc_patient_wdg, group_opposite, cli_args.high_match)
+        metric['rows_out'] = row_counts({'df_cumc_patient_wdg_clean': df_cumc_patient_wdg_clean})
+    if cli_args.keep_intermediates:
+        write_frame(decode_mrn_columns(df_cumc_patient_wdg_clean, mrn_ids, ['empi_or_mrn', 'relation_empi_or_mrn']), cli_args.out_dir, 'patient_relations_w_opposites_clean.tmp.tsv', cli_args.output_format)
 
-    outfile.write("Raw row duplicates dropped from PT_FILE:\t" + str(pt_row_count - len(pt_df.index))+"\n")
-    outfile.write("Raw row duplicates dropped from EC_FILE:\t" + str(ec_row_count - len(ec_df.index))+"\n")
+    return {'df_cumc_patient_wdg_clean': df_cumc_patient_wdg_clean}
 
-    pt_row_count = len(pt_df.index)
-    ec_row_count = len(ec_df.index)
 
-    pt_uniq_pt_count = pt_df['MRN'].nunique()
-    ec_uniq_pt_count = ec_df['MRN_1'].nunique()
+def infer_stage(cli_args, df_cumc_patient_wdg_clean, mrn_ids, inference_rules, group_opposite):
+    """
+    Infers relations from the cleaned matches.  Adds the stripped MRNs to
+    the MRN dictionary.
+    """
 
-    # Clean up PT info
-    pt_df = pt_df.astype(str)
-    pt_df['FirstName'] = pt_df['FirstName'].apply(clean_split_names)
-    pt_df['LastName'] = pt_df['LastName'].apply(clean_split_names)
-    pt_df['PhoneNumber'] = pt_df['PhoneNumber'].apply(normalize_phone_num)
-    pt_df['Zipcode'] = pt_df['Zipcode'].apply(normalize_zip_code)
+    print("Infering relations")
+    relations = relations_from_frame(df_cumc_patient_wdg_clean, mrn_ids)
+    matches_dict, cleaned_matched_link_list = run_inference(relations, cli_args, inference_rules, "output_actual_and_inferred_relationships1.tmp.tsv", "patient_relations_w_infered1.tmp.tsv", mrn_ids, group_opposite)
 
-    # Clean up Emergency Contact
-    ec_df = ec_df.astype(str)
-    ec_df['EC_FirstName'] = ec_df['EC_FirstName'].apply(clean_split_names)
-    ec_df['EC_LastName'] = ec_df['EC_LastName'].apply(clean_split_names)
-    ec_df['EC_PhoneNumber'] = ec_df['EC_PhoneNumber'].apply(normalize_phone_num)
-    ec_df['EC_Zipcode'] = ec_df['EC_Zipcode'].apply(normalize_zip_code)
+    return {'cleaned_matched_link_list': cleaned_matched_link_list, 'mrn_ids': mrn_ids}
 
-    # Standardize relationships
-    ec_df['EC_Relationship'] = ec_df['EC_Relationship'].str.lower()
-    ec_df['EC_Relationship'] = ec_df['EC_Relationship'].map(rel_abbrev_group)
 
-    # drop unknown relationship
-    ec_df = ec_df.loc[ec_df["EC_Relationship"].isin(rel_abbrev_group.values())]
+def links_stage(cli_args, cleaned_matched_link_list, dg_dict, rel_abbrev_group, pt_df, ec_df, mrn_ids, qc_stats, group_opposite):
+    """
+    Calculates stats against the provided Mother/Child links and adds them
+    and the Other Familial links to the inferred relations.
+    """
 
-    pt_df = pt_df.drop_duplicates()
-    ec_df = ec_df.drop_duplicates()
+    # Appended to the QC stats of the load, which an earlier attempt at this
+    # stage may have appended to already
+    with open(cli_args.out_dir + os.sep + "QC_stats.tsv", 'wt') as outfile:
+        outfile.write(qc_stats)
 
-    # Require First, Last, Phone Number, and EC Relation not be Null
-    ec_df.dropna(subset=['EC_FirstName'], inplace=True)
-    ec_df.dropna(subset=['EC_PhoneNumber'], inplace=True)
-    ec_df.dropna(subset=['EC_LastName'], inplace=True)
-    ec_df.dropna(subset=['EC_Relationship'], inplace=True)
+    if cli_args.of_link is None and cli_args.mc_link is None:
+        return dict()
 
-    # Require First, Last, Phone Number not be Null
-    pt_df_hasNA = pt_df[pt_df.isna().any(axis=1)]
-    pt_df.dropna(subset=['FirstName'], inplace=True)
-    pt_df.dropna(subset=['LastName'], inplace=True)
-    pt_df.dropna(subset=['PhoneNumber'], inplace=True)
+    print("Calulating stats")
 
-    pt_df = pt_df.drop_duplicates()
-    ec_df = ec_df.drop_duplicates()
+    more_stats(cleaned_matched_link_list, dg_dict, rel_abbrev_group, pt_df, ec_df, cli_args, mrn_ids)
+    cleaned_matched_link_list = stats_and_load_other_links(cli_args, cleaned_matched_link_list, dg_dict, rel_abbrev_group, pt_df, ec_df, mrn_ids, group_opposite)
 
-    outfile.write("Total rows dropped from PT_FILE for incomplete data:\t" + str(pt_row_count - len(pt_df.index))+"\n")
-    outfile.write("Total rows dropped from EC_FILE for incomplete data:\t" + str(ec_row_count - len(ec_df.index))+"\n")
+    if cli_args.keep_intermediates:
+        write_link_list(cleaned_matched_link_list, cli_args.out_dir, "patient_relations_w_infered_w_of_mc.tmp.tsv", mrn_ids, cli_args.output_format)
 
-    outfile.write("Number of PT Record IDs dropped from analysis for incomplete data:\t"+ str(pt_uniq_pt_count - pt_df['MRN'].nunique())+"\n")
-    outfile.write("Number of EC Record IDs dropped from analysis for incomplete data:\t"+ str(ec_uniq_pt_count - ec_df['MRN_1'].nunique())+"\n")
+    return {'cleaned_matched_link_list': cleaned_matched_link_list, 'mrn_ids': mrn_ids, 'qc_stats': read_qc_stats(cli_args.out_dir)}
 
-    outfile.write("Number of PT Record IDs for analysis:\t"+ str(pt_df['MRN'].nunique())+"\n")
-    outfile.write("Number of EC Record IDs for analysis:\t"+ str(ec_df['MRN_1'].nunique())+"\n\n")
 
-    my_encoding = find_encoding(dg_file)
-    dg_df = pd.read_csv(dg_file, sep='\t', dtype=str, encoding=my_encoding)
-    dg_df.columns = ['MRN', 'BirthYear', 'Sex']
+def reinfer_stage(cli_args, cleaned_matched_link_list, mrn_ids, inference_rules, group_opposite):
+    """
+    Infers relations again with the provided links added.
+    """
+
+    print("Infering relations")
+    relations = relations_from_link_list(cleaned_matched_link_list)
+    matches_dict, cleaned_matched_link_list = run_inference(relations, cli_args, inference_rules, "output_actual_and_inferred_relationships2.tmp.tsv", "cleaned_patient_relations_w_infered2.tmp.tsv", mrn_ids, group_opposite)
 
-    outfile.write("Raw number of Demographic Records rows for analysis:\t"+ str(len(dg_df.index))+"\n")
+    return {'cleaned_matched_link_list': cleaned_matched_link_list}
 
-    outfile.write("Raw number of Demographic Record IDs for analysis:\t"+ str(dg_df['MRN'].nunique())+"\n")
 
-    dg_df = dg_df.drop_duplicates()
-    dg_uniqe_ids = dg_df['MRN'].nunique()
+def final_stage(cli_args, cleaned_matched_link_list, dg_dict, mrn_ids):
+    """
+    Writes the final relations.
+    """
 
-    # Set Sex to the letters F or M and drop any non conforming
-    dg_df['Sex'] = dg_df['Sex'].apply(fix_sex)
-    dg_df_hasNA = dg_df[dg_df.isna().any(axis=1)]
-    dg_df.dropna(subset=['Sex'], inplace=True)
+    print("Writing Final Out")
+    final_out(cleaned_matched_link_list, dg_dict, cli_args.out_dir, "final_patient_relations_w_infered.tsv", mrn_ids, cli_args.output_format)
 
-    dg_df = dg_df.drop_duplicates()
+    return dict()
 
-    dg_df = dg_df.drop_duplicates(subset=['MRN'], keep=False)
 
-    outfile.write("Number of Demographic Records dropped form analysis for incomplete data:\t"+ str(dg_uniqe_ids - dg_df['MRN'].nunique())+"\n")
+def families_stage(cli_args):
+    """
+    Groups the final relations into families.
+    """
+
+    print("Writing Families")
+    get_family_groups(cli_args.out_dir, "final_patient_relations_w_infered.tsv", file_format=cli_args.output_format)
+
+    return dict()
+
+
+# Stages of main() in order: name, function, the state it needs and the
+# files it may write to the output directory.  Functions return the state
+# they produce.
+PIPELINE_STAGES = [
+    ('load', load_stage, ['rel_abbrev_group'], ['QC_stats.tsv']),
+    ('match', match_stage, ['pt_df', 'ec_df', 'mrn_ids'], ['df_cumc_patient.tmp.tsv']),
+    ('clean', clean_stage, ['df_cumc_patient', 'dg_dict', 'mrn_ids', 'group_opposite'], ['df_cumc_patient_wdg.tmp.tsv', 'patient_relations_w_opposites_clean.tmp.tsv']),
+    ('infer', infer_stage, ['df_cumc_patient_wdg_clean', 'mrn_ids', 'inference_rules', 'group_opposite'], ['output_actual_and_inferred_relationships1.tmp.tsv', 'patient_relations_w_infered1.tmp.tsv']),
+    ('links', links_stage, ['cleaned_matched_link_list', 'dg_dict', 'rel_abbrev_group', 'pt_df', 'ec_df', 'mrn_ids', 'qc_stats', 'group_opposite'], ['QC_stats.tsv', 'MissingPT_ContactInfo.tsv', 'MissingECInfo.tsv', 'all_tp_pt.tsv', 'all_tp_ec.tsv', 'all_tp.tsv', 'all_c_tp_ec.tsv', 'patient_relations_w_infered_w_of_mc.tmp.tsv']),
+    ('reinfer', reinfer_stage, ['cleaned_matched_link_list', 'mrn_ids', 'inference_rules', 'group_opposite'], ['output_actual_and_inferred_relationships2.tmp.tsv', 'cleaned_patient_relations_w_infered2.tmp.tsv']),
+    ('final', final_stage, ['cleaned_matched_link_list', 'dg_dict', 'mrn_ids'], ['final_patient_relations_w_infered.tsv']),
+    ('families', families_stage, [], ['all_family_IDS.tsv']),
+]
+STAGE_NAMES = [stage[0] for stage in PIPELINE_STAGES]
+
+CHECKPOINT_VERSION = 1
+HASH_BLOCK_BYTES = 1024 * 1024
+
+
+def stage_dependencies(stage, cli_args):
+    """
+    Input files and parameters a stage's results depend on, besides the
+    results of the stages before it.
+
+    Args:
+        stage (str): Stage name, one of STAGE_NAMES
+        cli_args (args): Parsed command line arguments
+
+    Returns:
+        files (list): Input files read by the stage
+        params (dict): Parameters used by the stage
+    """
+
+    files = list()
+    params = {'keep_intermediates': cli_args.keep_intermediates, 'output_format': cli_args.output_format}
+
+    if stage == 'load':
+        files = [cli_args.pt_file, cli_args.ec_file, cli_args.dg_file, reference_file('relationships_lookup.tsv')]
+        params.update({'input_format': cli_args.input_format, 'encoding': cli_args.encoding})
+    elif stage == 'clean':
+        files = [reference_file('relationships_and_opposites.tsv')]
+        params['high_match'] = cli_args.high_match
+    elif stage == 'infer' or stage == 'reinfer':
+        files = [cli_args.inference_rules or reference_file('relationship_inference_rules.tsv'), reference_file('relationships_and_opposites.tsv')]
+    elif stage == 'links':
+        files = [x for x in [cli_args.mc_link, cli_args.of_link] if x is not None]
+        if files:
+            files += [cli_args.pt_file, cli_args.ec_file, reference_file('relationships_and_opposites.tsv')]
+        params.update({'mc_link': cli_args.mc_link, 'of_link': cli_args.of_link, 'input_format': cli_args.input_format})
+
+    return files, params
+
+
+def hash_file(file_name, file_hashes):
+    """
+    Hashes the content of a file, reusing the hash recorded in file_hashes
+    while the size and modification time of the file are unchanged.
+
+    Args:
+        file_name (str): File to hash
+        file_hashes (dict): Size, modification time and SHA-256 of files
+            hashed before, updated with this file's
+
+    Returns:
+        str: Hex SHA-256 digest of the file
+    """
+
+    file_name = os.path.realpath(file_name)
+    file_stat = os.stat(file_name)
+
+    recorded = file_hashes.get(file_name)
+    if recorded is not None and recorded['size'] == file_stat.st_size and recorded['mtime_ns'] == file_stat.st_mtime_ns:
+        return recorded['sha256']
+
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as infile:
+        for block in iter(functools.partial(infile.read, HASH_BLOCK_BYTES), b''):
+            digest.update(block)
+
+    file_hashes[file_name] = {'size': file_stat.st_size, 'mtime_ns': file_stat.st_mtime_ns, 'sha256': digest.hexdigest()}
+
+    return digest.hexdigest()
+
+
+def load_manifest(manifest_file):
+    """
+    Loads the checkpoint manifest, starting a new one if it does not exist
+    or was written by another CHECKPOINT_VERSION.
+    """
+
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'rt') as infile:
+            manifest = json.load(infile)
+        if manifest.get('version') == CHECKPOINT_VERSION:
+            return manifest
+
+    return {'version': CHECKPOINT_VERSION, 'files': dict(), 'stages': dict()}
+
+
+def save_manifest(manifest, manifest_file):
+    """Saves the checkpoint manifest, replacing the old one once written"""
+
+    with open(manifest_file + '.tmp', 'wt') as outfile:
+        json.dump(manifest, outfile, indent=1, sort_keys=True)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def checkpoint_file(checkpoint_dir, stage, name):
+    """Location of the checkpoint of a piece of state a stage produced"""
+
+    return checkpoint_dir + os.sep + stage + '.' + name + '.pkl'
+
+
+def stage_done(manifest, checkpoint_dir, stage, key):
+    """
+    Whether a stage was checkpointed with the same key and its checkpoints
+    and output files are all still there.
+    """
+
+    record = manifest['stages'].get(stage)
+    if record is None or record['key'] != key:
+        return False
+
+    checkpoints = [checkpoint_file(checkpoint_dir, stage, name) for name in record['produced']]
+    return all(os.path.exists(x) for x in checkpoints + record['outputs'])
 
-    outfile.write("Number of Demographic Record IDs for analysis:\t"+ str(dg_df['MRN'].nunique())+"\n\n")
 
-    dg_dict = dict()
+def run_pipeline(cli_args, state):
+    """
+    Runs the stages of PIPELINE_STAGES in order.  With --checkpoint the state
+    each stage produces is pickled to the checkpoints directory of the
+    output directory, next to a manifest of the hashes of the input files,
+    the parameters and the output files of each stage.  A later run skips
+    the stages whose inputs and parameters are unchanged and resumes from
+    the last good checkpoint, or from --from_stage if that is earlier.
+    Checkpointed state is only loaded when a stage that runs needs it.
+    With --to_stage the stages after it are not run.
+
+    Args:
+        cli_args (args): Parsed command line arguments
+        state (dict): Reference data the stages need, updated with the
+            state the stages produce
+    """
 
-    for index, row in dg_df.iterrows():
-        dg_dict[row['MRN']] = tuple([row['Sex'], row['BirthYear']])
+    started = time.time()
+    checkpoint_dir = None
+    start = 0
+    end = len(STAGE_NAMES) if cli_args.to_stage is None else STAGE_NAMES.index(cli_args.to_stage) + 1
+
+    if cli_args.checkpoint or cli_args.from_stage is not None:
+        checkpoint_dir = cli_args.out_dir + os.sep + 'checkpoints'
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        manifest_file = checkpoint_dir + os.sep + 'manifest.json'
+        manifest = load_manifest(manifest_file)
+
+        # Each key covers the stages before it, so changed inputs or
+        # parameters invalidate their stage and every stage after it
+        keys = list()
+        dependencies = list()
+        key = str(CHECKPOINT_VERSION)
+        for stage in STAGE_NAMES:
+            files, params = stage_dependencies(stage, cli_args)
+            inputs = {os.path.realpath(x): hash_file(x, manifest['files']) for x in files}
+            key = hashlib.sha256(json.dumps([key, stage, inputs, params], sort_keys=True).encode()).hexdigest()
+            keys.append(key)
+            dependencies.append(tuple([inputs, params]))
+
+        for i, stage in enumerate(STAGE_NAMES):
+            if stage == cli_args.from_stage or not stage_done(manifest, checkpoint_dir, stage, keys[i]):
+                break
+            start = i + 1
+        if start >= end:
+            print("All stages checkpointed, nothing to run")
+            return
+        if start > 0:
+            print("Resuming from stage " + STAGE_NAMES[start])
+
+        for stage in STAGE_NAMES[start:]:
+            manifest['stages'].pop(stage, None)
+        save_manifest(manifest, manifest_file)
+
+        RUN_METRICS.extend({'step': stage, 'skipped': True} for stage in STAGE_NAMES[:start])
+
+    for i in range(start, end):
+        stage, stage_function, needs, out_file_names = PIPELINE_STAGES[i]
+
+        # Load needed state from the last skipped stage that produced it
+        for name in needs:
+            if name not in state:
+                producer = [x for x in STAGE_NAMES[:start] if name in manifest['stages'][x]['produced']][-1]
+                with open(checkpoint_file(checkpoint_dir, producer, name), 'rb') as infile:
+                    state[name] = pickle.load(infile)
+
+        with measure(stage, row_counts({name: state[name] for name in needs})) as metric:
+            produced = stage_function(cli_args, **{name: state[name] for name in needs})
+            metric['rows_out'] = row_counts(produced)
+        state.update(produced)
+        write_run_metrics(cli_args.out_dir, started)
+
+        if checkpoint_dir is None:
+            continue
+
+        for name, value in produced.items():
+            with open(checkpoint_file(checkpoint_dir, stage, name), 'wb') as outfile:
+                pickle.dump(value, outfile, protocol=pickle.HIGHEST_PROTOCOL)
 
-    return pt_df, ec_df, dg_df, dg_dict
+        out_files = [cli_args.out_dir + os.sep + x for x in out_file_names] + [cli_args.out_dir + os.sep + format_file_name(x, cli_args.output_format) for x in out_file_names]
+        inputs, params = dependencies[i]
+        manifest['stages'][stage] = {'key': keys[i], 'inputs': inputs, 'params': params, 'produced': sorted(produced), 'outputs': sorted(set(x for x in out_files if os.path.exists(x)))}
+        save_manifest(manifest, manifest_file)
 
 
 def parse_arguments():
@@ -1468,7 +3819,81 @@ def parse_arguments():
                         type=str,
                         help='Other Familial linkcages captured in the EHR for integration into families')
 
+    parser.add_argument('--match_engine', action='store', default='pandas',
+                        dest='match_engine',
+                        choices=sorted(MATCH_ENGINES),
+                        help='Implementation used to match PT and EC contact data.  pandas runs a groupby and merge per column combination, coded matches all combinations in a single pass over integer coded columns, index intersects inverted index posting lists for each EC row')
+
+    parser.add_argument('--share_drop_matching', action='store_true', default=False,
+                        dest='share_drop_matching',
+                        help='Match PT data once for all duplicate MRN drop options, re-evaluating only keys held by duplicated MRNs.  Uses the coded engine')
+
+    parser.add_argument('--workers', action='store', default=1,
+                        dest='workers',
+                        type=int,
+                        help='Number of processes used to infer relationships family by family and, with the coded or index match engine, to match shards of the EC data in parallel')
+
+    parser.add_argument('--inference_rules', action='store',
+                        dest='inference_rules',
+                        type=str,
+                        help='Tab seperated relationship inference rules file.  Defaults to reference_files/relationship_inference_rules.tsv')
+
+    parser.add_argument('--infer_engine', action='store', default='sets',
+                        dest='infer_engine',
+                        choices=sorted(INFER_CORES),
+                        help='Implementation used to infer relationships.  sets composes relations per patient, sparse multiplies sparse adjacency matrices (requires scipy)')
+
+    parser.add_argument('--keep_intermediates', action='store_true', default=False,
+                        dest='keep_intermediates',
+                        help='Write the *.tmp.tsv files of each stage to the output directory.  Stages otherwise hand their data to each other in memory')
+
+    parser.add_argument('--normalize_cache', action='store',
+                        dest='normalize_cache',
+                        type=str,
+                        help='File caching normalized names, phone numbers, zip codes and sexes across runs, so only newly seen values are normalized.  Created if it does not exist')
+
+    parser.add_argument('--encoding', action='store',
+                        dest='encoding',
+                        type=str,
+                        help='Character encoding of the PT, EC and Demographic files.  Skips detecting the encoding of each file')
+
+    parser.add_argument('--encoding_sample_mb', action='store', default=ENCODING_SAMPLE_BYTES // (1024 * 1024),
+                        dest='encoding_sample_mb',
+                        type=int,
+                        help='Megabytes read from the start of each input file to detect its encoding, along with a few blocks from the rest of the file')
+
+    parser.add_argument('--chunk_rows', action='store',
+                        dest='chunk_rows',
+                        type=int,
+                        help='Stream the PT, EC and Demographic files in chunks of this many rows, keeping only the distinct cleaned rows of each chunk.  Bounds memory for large extracts')
+
+    parser.add_argument('--input_format', action='store', default='tsv',
+                        dest='input_format',
+                        choices=FILE_FORMATS,
+                        help='Format of the PT, EC, Demographic, Mother/Child and Other Familial link files.  Columns of parquet and feather files are read by position and cast to strings (requires pyarrow)')
+
+    parser.add_argument('--output_format', action='store', default='tsv',
+                        dest='output_format',
+                        choices=FILE_FORMATS,
+                        help='Format of the relationship and family output files and the intermediate files.  parquet and feather keep column types and dictionary encode text columns (requires pyarrow).  QC files are always tab seperated')
+
+    parser.add_argument('--checkpoint', action='store_true', default=False,
+                        dest='checkpoint',
+                        help='Checkpoint the results of each stage to the checkpoints directory of the output directory, with a manifest of the input file hashes and parameters of each stage.  A rerun skips the stages whose inputs and parameters are unchanged and resumes from the last good checkpoint')
+
+    parser.add_argument('--from_stage', action='store',
+                        dest='from_stage',
+                        choices=STAGE_NAMES,
+                        help='Rerun from this stage on, loading the results of the stages before it from their checkpoints.  Implies --checkpoint')
+
+    parser.add_argument('--to_stage', action='store',
+                        dest='to_stage',
+                        choices=STAGE_NAMES,
+                        help='Stop after this stage.  With --from_stage set to the same stage only that stage is run, on the checkpointed results of the stages before it')
+
     args = parser.parse_args()
+    if args.from_stage is not None and args.to_stage is not None and STAGE_NAMES.index(args.to_stage) < STAGE_NAMES.index(args.from_stage):
+        parser.error('--to_stage ' + args.to_stage + ' is before --from_stage ' + args.from_stage)
     if args.example is False and (args.pt_file is None or args.pt_file is None
                         or args.dg_file is None or args.out_dir is None):
 
@@ -1489,63 +3914,15 @@ def main():
         cli_args.mc_link = "example_files" + os.sep + "mc_file.tsv"
         cli_args.of_link = "example_files" + os.sep + "of_file.tsv"
         cli_args.out_dir = "example_files"
+        cli_args.keep_intermediates = True
 
     print(cli_args)
 
     print("Loading Data")
     group_opposite, rel_abbrev_group = load_references()
+    inference_rules = load_inference_rules(cli_args.inference_rules)
 
-    # Step 1: Load and Match PT to EC
-    pt_df, ec_df, dg_df, dg_dict = normalize_load(cli_args.pt_file, cli_args.ec_file, cli_args.dg_file, rel_abbrev_group, cli_args.out_dir)
-    print("Finding Matches")
-
-    # Matches on unique, so deal with duplicat MRNs by dropping first, then last, then all
-    df_cumc_patient_last = find_matches(pt_df, ec_df, 'first')
-    df_cumc_patient_first = find_matches(pt_df, ec_df, 'last')
-    df_cumc_patient_false = find_matches(pt_df, ec_df, False)
-    df_cumc_patient_true = find_matches(pt_df, ec_df, True)
-
-    df_cumc_patient = pd.concat([df_cumc_patient_last, df_cumc_patient_first, df_cumc_patient_false, df_cumc_patient_true], ignore_index=True)
-    df_cumc_patient.reset_index(drop=True)
-
-    df_cumc_patient = df_cumc_patient.drop_duplicates()
-    df_cumc_patient.to_csv(cli_args.out_dir + os.sep + 'df_cumc_patient.tmp.tsv', sep='\t', index=False)
-
-    # Step 2: Clean Matches and Relationship Inference
-    print("Cleaning Matches")
-    df_cumc_patient_wdg = merge_matches_demog(df_cumc_patient, dg_df)
-    df_cumc_patient_wdg.to_csv(cli_args.out_dir + os.sep + 'df_cumc_patient_wdg.tmp.tsv', sep='\t', index=False)
-    df_cumc_patient_wdg_clean = match_cleanup(df_cumc_patient_wdg, group_opposite, cli_args.high_match)
-    df_cumc_patient_wdg_clean.to_csv(cli_args.out_dir + os.sep + 'patient_relations_w_opposites_clean.tmp.tsv', sep='\t', index=False)
-
-    print("Infering relations")
-    matches_dict = infer_relations(cli_args.out_dir, "patient_relations_w_opposites_clean.tmp.tsv","output_actual_and_inferred_relationships1.tmp.tsv")
-    cleaned_matched_link_list = clean_inferences(cli_args.out_dir, matches_dict, "patient_relations_w_infered1.tmp.tsv")
-
-    if cli_args.of_link is not None or cli_args.mc_link is not None:
-        print("Calulating stats")
-        more_stats(cleaned_matched_link_list, dg_dict, rel_abbrev_group, pt_df, ec_df, cli_args)
-        cleaned_matched_link_list = stats_and_load_other_links(cli_args, cleaned_matched_link_list, dg_dict, rel_abbrev_group, pt_df, ec_df)
-
-        outfile = open(cli_args.out_dir + os.sep + "patient_relations_w_infered_w_of_mc.tmp.tsv", 'wt')
-        for match, relation in cleaned_matched_link_list.items():
-            outfile.write(match[0] + "\t" + relation + "\t" + match[1] + "\n")
-        outfile.close()
-
-    print("Infering relations")
-    if cli_args.of_link is None and cli_args.mc_link is None:
-        matches_dict = infer_relations(cli_args.out_dir, "patient_relations_w_infered1.tmp.tsv","output_actual_and_inferred_relationships2.tmp.tsv")
-    else:
-        matches_dict = infer_relations(cli_args.out_dir, "patient_relations_w_infered_w_of_mc.tmp.tsv","output_actual_and_inferred_relationships2.tmp.tsv")
-
-    cleaned_matched_link_list = clean_inferences(cli_args.out_dir, matches_dict, "cleaned_patient_relations_w_infered2.tmp.tsv")
-
-    print("Writing Final Out")
-    final_link_list = final_out(cleaned_matched_link_list, dg_dict, cli_args.out_dir, "final_patient_relations_w_infered.tsv")
-
-    print("Writing Families")
-    get_family_groups(cli_args.out_dir, "final_patient_relations_w_infered.tsv")
-
+    run_pipeline(cli_args, {'group_opposite': group_opposite, 'rel_abbrev_group': rel_abbrev_group, 'inference_rules': inference_rules})
 
     return
 
@@ -0,0 +1,659 @@
+import os, sys
+import argparse
+import numpy as np
+import pandas as pd
+
+
+"""
+Generates synthetic EHR extracts for RIFTEHR along with the true pedigree
+they were drawn from, so the performance and accuracy of RIFTEHR can be
+measured at any size.
+
+Families of three generations are simulated: a founding couple, their
+children, the children's spouses and the grandchildren.  Patients report
+their relatives, and some unrelated people, as emergency contacts with the
+noise seen in real extracts: typos, married and maiden names, shared and
+outdated phone numbers, phone and zip code formats, missing zip codes,
+unknown and wrong relationship codes, and duplicate records.
+
+Families are generated in blocks, each from its own random stream of the
+seed, and written as they are generated, so memory is bounded by the block
+size and the same seed always gives the same files.
+"""
+
+
+LAST_BIRTH_YEAR = 2024
+PEOPLE_PER_FAMILY = 8.9  # Mean people in a simulated family, to size blocks
+
+# Relationship codes a patient may give for a relative, by the relative's
+# sex, as found in reference_files/relationships_lookup.tsv
+RELATIONSHIP_CODES = {
+    'Spouse': (['Husband', 'SPO', 'Spouse'], ['Wife', 'SPO', 'Spouse']),
+    'Parent': (['FAT', 'FA ', 'Father', 'PAR'], ['MOT', 'MO ', 'Mother', 'PAR']),
+    'Child': (['Son', 'KID', 'CHI', 'Child'], ['Daughter', 'KID', 'CH ', 'Child']),
+    'Sibling': (['Brother', 'SIB', 'SI ', 'Sibling'], ['Sister', 'SIB', 'SI ', 'Sibling']),
+    'Grandparent': (['Grandfather', 'GRP', 'Grandparent'], ['Grandmother', 'GRP', 'Grandparent']),
+    'Grandchild': (['GCH', 'Grandchild'], ['GCH', 'Grandchild']),
+    'Aunt/Uncle': (['Uncle'], ['Aunt', 'AUN', 'AU ']),
+    'Nephew/Niece': (['Nephew', 'NNE', 'NN '], ['Niece', 'NNE', 'NN ']),
+}
+UNKNOWN_CODES = ['FRI', 'Friend', 'OTH', 'Other', 'GUA', 'Neighbor', 'XXX']
+
+# Chance a patient reports a relative as an emergency contact
+REPORT_PROBABILITY = {
+    'Spouse': 0.7,
+    'Parent': 0.3,
+    'Child': 0.3,
+    'Sibling': 0.15,
+    'Grandparent': 0.05,
+    'Grandchild': 0.04,
+    'Aunt/Uncle': 0.03,
+    'Nephew/Niece': 0.02,
+}
+YOUNG_PARENT_REPORT_PROBABILITY = 0.8
+YOUNG_BIRTH_YEAR = 2000
+
+# Chance of each kind of noise, all scaled by --noise
+NOISE = {
+    'pt_duplicate': 0.02,           # PT row repeated
+    'pt_old_phone': 0.01,           # second PT row with an outdated phone
+    'pt_missing_first_name': 0.005,
+    'pt_missing_phone': 0.02,
+    'pt_missing_zip': 0.05,
+    'dg_unknown_sex': 0.01,
+    'dg_missing_birth_year': 0.005,
+    'dg_conflict': 0.002,           # second demographic row, other year
+    'ec_name_typo': 0.02,
+    'ec_maiden_name': 0.3,          # of married women reported
+    'ec_household_phone': 0.2,      # household phone, not the patient's own
+    'ec_phone_typo': 0.01,
+    'ec_missing_zip': 0.12,
+    'ec_wrong_code': 0.02,
+    'ec_unknown_code': 0.03,
+    'ec_non_relative': 0.1,         # per patient, an unrelated contact
+    'shared_phone': 0.005,          # household phone shared with others
+}
+
+FIRST_NAME_POOL = 4000
+SURNAME_POOL = 100000
+SYLLABLES = ['ba', 'be', 'bo', 'ca', 'da', 'de', 'di', 'el', 'en', 'fa', 'ga', 'ha', 'is', 'ja', 'ka', 'ki', 'la', 'le',
+             'li', 'lo', 'ma', 'me', 'mi', 'na', 'ne', 'ni', 'no', 'ol', 'pa', 'ra', 're', 'ri', 'ro', 'sa', 'se', 'so',
+             'ta', 'te', 'ti', 'to', 'va', 'vi', 'wa', 'ya', 'za', 'an', 'ar', 'er', 'in', 'on', 'us', 'th', 'ch', 'sh']
+
+PT_HEADER = ['MRN', 'FirstName', 'LastName', 'PhoneNumber', 'Zipcode']
+EC_HEADER = ['MRN_1', 'EC_FirstName', 'EC_LastName', 'EC_PhoneNumber', 'EC_Zipcode', 'EC_Relationship']
+DG_HEADER = ['MRN', 'BirthYear', 'Sex']
+MC_HEADER = ['MRN_Mother', 'MRN_Child']
+OF_HEADER = ['MRN_2', 'MRN_3', 'Relationship']
+PEDIGREE_HEADER = ['MRN', 'family_id', 'generation', 'sex', 'birth_year', 'father_MRN', 'mother_MRN', 'spouse_MRN', 'in_ehr']
+RELATIONS_HEADER = ['empi_or_mrn', 'relationship', 'relation_empi_or_mrn']
+
+
+def name_pool(rng, size, n_syllables):
+    """
+    Makes a pool of distinct capitalized names of syllables.
+
+    Args:
+        rng (Generator): Random stream
+        size (int): Number of names
+        n_syllables (list): Numbers of syllables names may have
+
+    Returns:
+        array: Names, most common first
+    """
+
+    names = dict()
+    while len(names) < size:
+        lengths = rng.choice(n_syllables, size=size)
+        for length in np.unique(lengths):
+            picks = rng.integers(0, len(SYLLABLES), size=(int(np.sum(lengths == length)), length))
+            for row in picks:
+                names.setdefault(''.join(SYLLABLES[x] for x in row).capitalize(), None)
+
+    return np.array(list(names)[:size], dtype=object)
+
+
+def zipf_choice(rng, n_values, size, exponent=1.0):
+    """Draws indexes into a pool of n_values, the first ones most often"""
+
+    weights = 1.0 / np.arange(1, n_values + 1) ** exponent
+    return rng.choice(n_values, size=size, p=weights / weights.sum())
+
+
+def make_typos(strings, rng):
+    """Drops, doubles or swaps a random character of each string"""
+
+    typos = list()
+    for a_str, kind, where in zip(strings, rng.integers(0, 3, size=len(strings)), rng.random(len(strings))):
+        if len(a_str) < 2:
+            typos.append(a_str)
+            continue
+        i = int(where * (len(a_str) - 1))
+        if kind == 0:
+            typos.append(a_str[:i] + a_str[i + 1:])
+        elif kind == 1:
+            typos.append(a_str[:i] + a_str[i] + a_str[i:])
+        else:
+            typos.append(a_str[:i] + a_str[i + 1] + a_str[i] + a_str[i + 2:])
+
+    return np.array(typos, dtype=object)
+
+
+def format_phones(phones, rng):
+    """
+    Formats 10 digit phone numbers as they are typed into an EHR.
+
+    Args:
+        phones (array): int64 phone numbers
+        rng (Generator): Random stream
+
+    Returns:
+        array: Formatted phone numbers
+    """
+
+    area, exchange, line = phones // 10000000, phones // 10000 % 1000, phones % 10000
+    formats = rng.choice(6, size=len(phones), p=[0.45, 0.2, 0.12, 0.1, 0.08, 0.05])
+    extensions = rng.integers(1, 999, size=len(phones))
+
+    formatted = list()
+    for a, e, n, f, x in zip(area, exchange, line, formats, extensions):
+        if f == 0:
+            formatted.append('%03d-%03d-%04d' % (a, e, n))
+        elif f == 1:
+            formatted.append('(%03d) %03d-%04d' % (a, e, n))
+        elif f == 2:
+            formatted.append('%03d%03d%04d' % (a, e, n))
+        elif f == 3:
+            formatted.append('%03d.%03d.%04d' % (a, e, n))
+        elif f == 4:
+            formatted.append('1-%03d-%03d-%04d' % (a, e, n))
+        else:
+            formatted.append('%03d-%03d-%04d x%d' % (a, e, n, x))
+
+    return np.array(formatted, dtype=object)
+
+
+def random_phones(rng, size, areas=None):
+    """Draws 10 digit phone numbers, in the given area codes if any"""
+
+    if areas is None:
+        areas = rng.integers(201, 990, size=size)
+    return areas * 10000000 + rng.integers(200, 1000, size=size) * 10000 + rng.integers(0, 10000, size=size)
+
+
+def simulate_families(rng, n_families, coverage, surnames, first_names):
+    """
+    Simulates families of three generations.  People are indexed from 0 in
+    the order founding fathers, founding mothers, their children, the
+    children's spouses and the grandchildren.
+
+    Args:
+        rng (Generator): Random stream
+        n_families (int): Number of founding couples
+        coverage (float): Chance a person is a patient of the EHR
+        surnames (array): Surname pool
+        first_names (tuple): Male and female first name pools
+
+    Returns:
+        DataFrame: One row per person with family, generation, sex (M or F),
+                   birth year, father, mother and spouse indexes (-1 if
+                   none), first name, surname, household and in_ehr
+    """
+
+    # Founding couples
+    family = np.concatenate([np.arange(n_families), np.arange(n_families)])
+    sex = np.repeat(np.array(['M', 'F']), n_families)
+    father_year = rng.integers(1915, 1956, size=n_families)
+    birth_year = np.concatenate([father_year, father_year + np.rint(rng.normal(-2, 3, size=n_families)).astype(np.int64)])
+    family_surname = zipf_choice(rng, len(surnames), n_families)
+    maiden_surname = zipf_choice(rng, len(surnames), n_families)
+    married_name = rng.random(n_families) < 0.75
+    surname = np.concatenate([family_surname, np.where(married_name, family_surname, maiden_surname)])
+    birth_surname = np.concatenate([family_surname, maiden_surname])
+    spouse = np.concatenate([np.arange(n_families) + n_families, np.arange(n_families)])
+    father = np.full(2 * n_families, -1)
+    mother = np.full(2 * n_families, -1)
+    generation = np.ones(2 * n_families, dtype=np.int64)
+    household = np.concatenate([np.arange(n_families), np.arange(n_families)])
+    n_households = n_families
+
+    # Their children
+    n_children = rng.choice(6, size=n_families, p=[0.05, 0.2, 0.35, 0.22, 0.12, 0.06])
+    parents = np.repeat(np.arange(n_families), n_children)
+    n_g2 = len(parents)
+    g2 = 2 * n_families + np.arange(n_g2)
+    g2_sex = np.where(rng.random(n_g2) < 0.5, 'M', 'F')
+    g2_year = birth_year[parents + n_families] + rng.integers(18, 43, size=n_g2)
+    g2_married = (rng.random(n_g2) < 0.65) & (g2_year <= LAST_BIRTH_YEAR - 18)
+    g2_home = rng.random(n_g2) < 0.3
+    g2_household = np.where(g2_home, parents, n_households + np.arange(n_g2))
+    n_households += n_g2
+
+    # The children's spouses, from outside the family
+    married = g2[g2_married]
+    n_sp = len(married)
+    sp = 2 * n_families + n_g2 + np.arange(n_sp)
+    sp_sex = np.where(g2_sex[g2_married] == 'M', 'F', 'M')
+    sp_year = g2_year[g2_married] + np.rint(rng.normal(0, 3, size=n_sp)).astype(np.int64)
+    sp_birth_surname = zipf_choice(rng, len(surnames), n_sp)
+    g2_surname = family_surname[parents]
+    takes_name = rng.random(n_sp) < 0.75
+    sp_surname = np.where((sp_sex == 'F') & takes_name, g2_surname[g2_married], sp_birth_surname)
+    g2_used_surname = g2_surname.copy()
+    g2_used_surname[g2_married] = np.where((g2_sex[g2_married] == 'F') & takes_name, sp_birth_surname, g2_surname[g2_married])
+    g2_spouse = np.full(n_g2, -1)
+    g2_spouse[g2_married] = sp
+    g2_household[g2_married] = n_households + np.arange(n_sp)
+    n_households += n_sp
+
+    # The grandchildren of married children
+    n_grandchildren = rng.choice(6, size=n_sp, p=[0.15, 0.2, 0.3, 0.2, 0.1, 0.05])
+    couple = np.repeat(np.arange(n_sp), n_grandchildren)
+    g2_of_couple = np.flatnonzero(g2_married)[couple]
+    g3_father = np.where(g2_sex[g2_of_couple] == 'M', married[couple], sp[couple])
+    g3_mother = np.where(g2_sex[g2_of_couple] == 'M', sp[couple], married[couple])
+    mother_year = np.where(g2_sex[g2_of_couple] == 'M', sp_year[couple], g2_year[g2_of_couple])
+    g3_year = mother_year + rng.integers(18, 43, size=len(couple))
+    born = g3_year <= LAST_BIRTH_YEAR
+    couple, g3_father, g3_mother, g3_year, g2_of_couple = couple[born], g3_father[born], g3_mother[born], g3_year[born], g2_of_couple[born]
+    n_g3 = len(couple)
+    g3_sex = np.where(rng.random(n_g3) < 0.5, 'M', 'F')
+    g3_surname = np.where(g2_sex[g2_of_couple] == 'M', g2_used_surname[g2_of_couple], sp_surname[couple])
+    g3_household = np.where(rng.random(n_g3) < 0.7, g2_household[g2_of_couple], n_households + np.arange(n_g3))
+    n_households += n_g3
+
+    sex = np.concatenate([sex, g2_sex, sp_sex, g3_sex])
+    surname = np.concatenate([surname, g2_used_surname, sp_surname, g3_surname])
+    first_name = np.empty(len(sex), dtype=object)
+    is_male = sex == 'M'
+    first_name[is_male] = first_names[0][zipf_choice(rng, len(first_names[0]), int(is_male.sum()), 0.8)]
+    first_name[~is_male] = first_names[1][zipf_choice(rng, len(first_names[1]), int((~is_male).sum()), 0.8)]
+
+    people = pd.DataFrame({
+        'family': np.concatenate([family, parents, parents[g2_married], parents[g2_of_couple]]),
+        'generation': np.concatenate([generation, np.full(n_g2, 2), np.full(n_sp, 2), np.full(n_g3, 3)]),
+        'sex': sex,
+        'birth_year': np.concatenate([birth_year, g2_year, sp_year, g3_year]),
+        'father': np.concatenate([father, parents, np.full(n_sp, -1), g3_father]),
+        'mother': np.concatenate([mother, parents + n_families, np.full(n_sp, -1), g3_mother]),
+        'spouse': np.concatenate([spouse, g2_spouse, married, np.full(n_g3, -1)]),
+        'first_name': first_name,
+        'surname': surnames[surname],
+        'birth_surname': surnames[np.concatenate([birth_surname, g2_surname, sp_birth_surname, g3_surname])],
+        'household': np.concatenate([household, g2_household, g2_household[g2_married], g3_household]),
+    })
+    people['in_ehr'] = rng.random(len(people.index)) < coverage
+
+    return people
+
+
+def true_relations(people):
+    """
+    Lists the relations between people, as (person, relationship,
+    relative) rows meaning the relative is the person's relationship.
+
+    Args:
+        people (DataFrame): Output of simulate_families()
+
+    Returns:
+        DataFrame: person, relationship and relative indexes
+    """
+
+    index = np.arange(len(people.index))
+    has_spouse = people['spouse'].to_numpy() >= 0
+    spouses = pd.DataFrame({'person': index[has_spouse], 'relative': people['spouse'].to_numpy()[has_spouse]})
+
+    parent_edges = list()
+    for column in ['father', 'mother']:
+        has_parent = people[column].to_numpy() >= 0
+        parent_edges.append(pd.DataFrame({'person': index[has_parent], 'relative': people[column].to_numpy()[has_parent]}))
+    parents = pd.concat(parent_edges, ignore_index=True)
+    children = parents.rename(columns={'person': 'relative', 'relative': 'person'})
+
+    # Full siblings, people with the same mother
+    by_mother = parents[parents['relative'].isin(people.index[people['sex'] == 'F'])].sort_values(['relative', 'person'])
+    child = by_mother['person'].to_numpy()
+    group = by_mother['relative'].to_numpy()
+    sibling_edges = list()
+    for offset in range(1, len(child)):
+        same = group[offset:] == group[:-offset]
+        if not same.any():
+            break
+        sibling_edges.append(pd.DataFrame({'person': child[offset:][same], 'relative': child[:-offset][same]}))
+        sibling_edges.append(pd.DataFrame({'person': child[:-offset][same], 'relative': child[offset:][same]}))
+    siblings = pd.concat(sibling_edges, ignore_index=True) if sibling_edges else pd.DataFrame({'person': [], 'relative': []}, dtype=np.int64)
+
+    grandparents = parents.merge(parents, left_on='relative', right_on='person', suffixes=('', '_parent'))[['person', 'relative_parent']].rename(columns={'relative_parent': 'relative'})
+    grandchildren = grandparents.rename(columns={'person': 'relative', 'relative': 'person'})
+    aunts_uncles = parents.merge(siblings, left_on='relative', right_on='person', suffixes=('', '_sibling'))[['person', 'relative_sibling']].rename(columns={'relative_sibling': 'relative'})
+    nephews_nieces = aunts_uncles.rename(columns={'person': 'relative', 'relative': 'person'})
+
+    relations = list()
+    for relationship, edges in [('Spouse', spouses), ('Parent', parents), ('Child', children), ('Sibling', siblings), ('Grandparent', grandparents), ('Grandchild', grandchildren), ('Aunt/Uncle', aunts_uncles), ('Nephew/Niece', nephews_nieces)]:
+        edges = edges[['person', 'relative']].drop_duplicates()
+        relations.append(pd.DataFrame({'person': edges['person'].to_numpy(), 'relationship': relationship, 'relative': edges['relative'].to_numpy()}))
+
+    return pd.concat(relations, ignore_index=True)
+
+
+def relationship_codes(relationships, sexes, rng):
+    """Picks a relationship code for each relationship to a relative of the given sex"""
+
+    codes = np.empty(len(relationships), dtype=object)
+    for relationship, (male_codes, female_codes) in RELATIONSHIP_CODES.items():
+        for sex, sex_codes in [('M', male_codes), ('F', female_codes)]:
+            rows = np.flatnonzero((relationships == relationship) & (sexes == sex))
+            codes[rows] = np.array(sex_codes, dtype=object)[rng.integers(0, len(sex_codes), size=len(rows))]
+
+    return codes
+
+
+def generate_block(rng, n_families, mrn_offset, family_offset, coverage, noise, names):
+    """
+    Generates the extract rows and true pedigree of one block of families.
+
+    Args:
+        rng (Generator): Random stream of the block
+        n_families (int): Number of founding couples
+        mrn_offset (int): MRNs of the block start after this one
+        family_offset (int): Family ids of the block start at this one
+        coverage (float): Chance a person is a patient of the EHR
+        noise (dict): Chance of each kind of noise
+        names (tuple): Surname, male and female first name pools
+
+    Returns:
+        dict: DataFrames of the pt, ec, dg, mc and of files and of the true
+              pedigree and relations, by name
+    """
+
+    surnames, male_names, female_names = names
+    people = simulate_families(rng, n_families, coverage, surnames, (male_names, female_names))
+    n_people = len(people.index)
+    in_ehr = people['in_ehr'].to_numpy()
+
+    mrn = mrn_offset + 1 + rng.permutation(n_people)
+    mrn_str = mrn.astype(str).astype(object)
+
+    # Households share a landline and zip code, some landlines are shared
+    # across households.  Half of the people also have a cell phone.
+    n_households = int(people['household'].max()) + 1
+    areas = rng.integers(201, 990, size=n_families)
+    household_family = np.full(n_households, -1)
+    household_family[people['household'].to_numpy()] = people['family'].to_numpy()
+    household_phone = random_phones(rng, n_households, areas[household_family])
+    shared = rng.random(n_households) < noise['shared_phone']
+    household_phone[shared] = random_phones(rng, 20, areas[:1].repeat(20))[rng.integers(0, 20, size=int(shared.sum()))]
+    household_zip = (rng.integers(100, 1000, size=n_families)[household_family] * 100 + rng.integers(0, 100, size=n_households))
+    moved = rng.random(n_households) < 0.3
+    household_zip[moved] = rng.integers(1000, 100000, size=int(moved.sum()))
+
+    person_household = people['household'].to_numpy()
+    cell = random_phones(rng, n_people, areas[people['family'].to_numpy()])
+    has_cell = rng.random(n_people) < 0.5
+    phone = np.where(has_cell, cell, household_phone[person_household])
+    zip_code = household_zip[person_household]
+
+    first_name = people['first_name'].to_numpy()
+    surname = people['surname'].to_numpy()
+    sex = people['sex'].to_numpy()
+    birth_year = people['birth_year'].to_numpy()
+
+    # PT file
+    pt_rows = np.flatnonzero(in_ehr)
+    pt = pd.DataFrame({
+        'MRN': mrn_str[pt_rows],
+        'FirstName': np.where(rng.random(len(pt_rows)) < noise['pt_missing_first_name'], '', first_name[pt_rows]),
+        'LastName': surname[pt_rows],
+        'PhoneNumber': np.where(rng.random(len(pt_rows)) < noise['pt_missing_phone'], '', format_phones(phone[pt_rows], rng)),
+        'Zipcode': np.where(rng.random(len(pt_rows)) < noise['pt_missing_zip'], '', np.char.zfill(zip_code[pt_rows].astype(str), 5).astype(object)),
+    })
+    duplicate = pt[rng.random(len(pt.index)) < noise['pt_duplicate']]
+    old_phone = pt[rng.random(len(pt.index)) < noise['pt_old_phone']].copy()
+    old_phone['PhoneNumber'] = format_phones(random_phones(rng, len(old_phone.index)), rng)
+    pt = pd.concat([pt, duplicate, old_phone], ignore_index=True)
+
+    # Demographic file
+    sex_spelling = {'M': np.array(['M', 'M', 'M', 'Male', 'male', 'm'], dtype=object), 'F': np.array(['F', 'F', 'F', 'Female', 'female', 'f'], dtype=object)}
+    dg_sex = np.empty(len(pt_rows), dtype=object)
+    for a_sex, spellings in sex_spelling.items():
+        rows = np.flatnonzero(sex[pt_rows] == a_sex)
+        dg_sex[rows] = spellings[rng.integers(0, len(spellings), size=len(rows))]
+    dg_sex[rng.random(len(pt_rows)) < noise['dg_unknown_sex']] = 'U'
+    dg = pd.DataFrame({
+        'MRN': mrn_str[pt_rows],
+        'BirthYear': np.where(rng.random(len(pt_rows)) < noise['dg_missing_birth_year'], '', birth_year[pt_rows].astype(str).astype(object)),
+        'Sex': dg_sex,
+    })
+    conflict = dg[rng.random(len(dg.index)) < noise['dg_conflict']].copy()
+    conflict['BirthYear'] = (birth_year[pt_rows][conflict.index.to_numpy()] + rng.integers(1, 5, size=len(conflict.index))).astype(str)
+    dg = pd.concat([dg, conflict], ignore_index=True)
+
+    # Relatives reported as emergency contacts by patients
+    relations = true_relations(people)
+    person = relations['person'].to_numpy()
+    relative = relations['relative'].to_numpy()
+    relationship = relations['relationship'].to_numpy()
+    report = np.array([REPORT_PROBABILITY[x] for x in relationship]) if len(relationship) else np.zeros(0)
+    report = np.where((relationship == 'Parent') & (birth_year[person] >= YOUNG_BIRTH_YEAR), YOUNG_PARENT_REPORT_PROBABILITY, report)
+    reported = in_ehr[person] & (rng.random(len(person)) < report)
+    reporter, contact, contact_relationship = person[reported], relative[reported], relationship[reported]
+    codes = relationship_codes(contact_relationship, sex[contact], rng)
+
+    wrong = rng.random(len(codes)) < noise['ec_wrong_code']
+    all_codes = np.array(sorted(set(x for pair in RELATIONSHIP_CODES.values() for codes_of_sex in pair for x in codes_of_sex)), dtype=object)
+    codes[wrong] = all_codes[rng.integers(0, len(all_codes), size=int(wrong.sum()))]
+    unknown = rng.random(len(codes)) < noise['ec_unknown_code']
+    codes[unknown] = np.array(UNKNOWN_CODES, dtype=object)[rng.integers(0, len(UNKNOWN_CODES), size=int(unknown.sum()))]
+
+    # Unrelated contacts, friends and neighbors mostly given as such
+    friend_of = pt_rows[rng.random(len(pt_rows)) < noise['ec_non_relative']]
+    friend = rng.integers(0, n_people, size=len(friend_of))
+    friend_codes = np.array(UNKNOWN_CODES, dtype=object)[rng.integers(0, len(UNKNOWN_CODES), size=len(friend_of))]
+    mislabeled = rng.random(len(friend_of)) < 0.2
+    friend_codes[mislabeled] = all_codes[rng.integers(0, len(all_codes), size=int(mislabeled.sum()))]
+
+    reporter = np.concatenate([reporter, friend_of])
+    contact = np.concatenate([contact, friend])
+    codes = np.concatenate([codes, friend_codes])
+
+    ec_first = first_name[contact].copy()
+    typo = rng.random(len(contact)) < noise['ec_name_typo']
+    ec_first[typo] = make_typos(ec_first[typo], rng)
+    ec_last = surname[contact].copy()
+    maiden = (sex[contact] == 'F') & (people['birth_surname'].to_numpy()[contact] != ec_last) & (rng.random(len(contact)) < noise['ec_maiden_name'])
+    ec_last[maiden] = people['birth_surname'].to_numpy()[contact][maiden]
+    ec_phone = np.where(rng.random(len(contact)) < noise['ec_household_phone'], household_phone[person_household[contact]], phone[contact])
+    typo = rng.random(len(contact)) < noise['ec_phone_typo']
+    ec_phone[typo] = ec_phone[typo] + rng.integers(1, 10, size=int(typo.sum())) * 10 ** rng.integers(0, 7, size=int(typo.sum()))
+    ec_zip = np.char.zfill(zip_code[contact].astype(str), 5).astype(object)
+    zip4 = rng.random(len(contact)) < 0.03
+    ec_zip[zip4] = ec_zip[zip4] + '-' + np.char.zfill(rng.integers(0, 10000, size=int(zip4.sum())).astype(str), 4).astype(object)
+    ec_zip[rng.random(len(contact)) < noise['ec_missing_zip']] = ''
+
+    ec = pd.DataFrame({
+        'MRN_1': mrn_str[reporter],
+        'EC_FirstName': ec_first,
+        'EC_LastName': ec_last,
+        'EC_PhoneNumber': format_phones(ec_phone, rng),
+        'EC_Zipcode': ec_zip,
+        'EC_Relationship': codes,
+    })
+
+    # Mother/Child links recorded at birth, for births the EHR covers
+    has_mother = (people['mother'].to_numpy() >= 0) & in_ehr
+    mothers = people['mother'].to_numpy()[has_mother]
+    children = np.flatnonzero(has_mother)
+    linked = in_ehr[mothers] & (birth_year[children] >= 1995) & (rng.random(len(children)) < 0.6)
+    mc = pd.DataFrame({'MRN_Mother': mrn_str[mothers[linked]], 'MRN_Child': mrn_str[children[linked]]})
+
+    # Other family links captured by the EHR
+    close = np.isin(relationship, ['Spouse', 'Parent', 'Child', 'Sibling']) & in_ehr[person] & in_ehr[relative] & (rng.random(len(person)) < 0.01)
+    of = pd.DataFrame({
+        'MRN_2': mrn_str[person[close]],
+        'MRN_3': mrn_str[relative[close]],
+        'Relationship': relationship_codes(relationship[close], sex[relative[close]], rng),
+    })
+
+    def mrn_or_empty(indexes):
+        return np.where(indexes >= 0, mrn_str[np.maximum(indexes, 0)], '')
+
+    pedigree = pd.DataFrame({
+        'MRN': mrn_str,
+        'family_id': family_offset + people['family'].to_numpy(),
+        'generation': people['generation'].to_numpy(),
+        'sex': sex,
+        'birth_year': birth_year,
+        'father_MRN': mrn_or_empty(people['father'].to_numpy()),
+        'mother_MRN': mrn_or_empty(people['mother'].to_numpy()),
+        'spouse_MRN': mrn_or_empty(people['spouse'].to_numpy()),
+        'in_ehr': in_ehr.astype(np.int8),
+    })
+
+    both_patients = in_ehr[person] & in_ehr[relative]
+    relations = pd.DataFrame({'empi_or_mrn': mrn_str[person[both_patients]], 'relationship': relationship[both_patients], 'relation_empi_or_mrn': mrn_str[relative[both_patients]]})
+
+    return {
+        'pt': pt.iloc[np.argsort(mrn[np.concatenate([pt_rows, pt_rows[duplicate.index.to_numpy()], pt_rows[old_phone.index.to_numpy()]])], kind='stable')],
+        'ec': ec.iloc[np.argsort(mrn[reporter], kind='stable')],
+        'dg': dg.iloc[np.argsort(mrn[np.concatenate([pt_rows, pt_rows[conflict.index.to_numpy()]])], kind='stable')],
+        'mc': mc,
+        'of': of,
+        'pedigree': pedigree.iloc[np.argsort(mrn)],
+        'relations': relations,
+    }
+
+
+OUTPUT_FILES = [
+    ('pt', 'pt_file.tsv', PT_HEADER),
+    ('ec', 'ec_file.tsv', EC_HEADER),
+    ('dg', 'pt_demog.tsv', DG_HEADER),
+    ('mc', 'mc_file.tsv', MC_HEADER),
+    ('of', 'of_file.tsv', OF_HEADER),
+    ('pedigree', 'true_pedigree.tsv', PEDIGREE_HEADER),
+    ('relations', 'true_relations.tsv', RELATIONS_HEADER),
+]
+
+
+def generate(n_patients, out_dir, seed=1, coverage=0.85, noise_scale=1.0, block_families=50000):
+    """
+    Generates synthetic extracts of about n_patients patients and the true
+    pedigree of everyone in them.  Blocks of families are generated until
+    n_patients is reached, the last family may go a few patients over.
+
+    Args:
+        n_patients (int): Number of patients in the PT file
+        out_dir (str): Directory the files are written to
+        seed (int): Seed of the random streams
+        coverage (float): Chance a family member is a patient of the EHR
+        noise_scale (float): Factor on the chance of each kind of noise
+        block_families (int): Founding couples generated at a time
+
+    Returns:
+        dict: Number of rows written to each file, by name
+    """
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    names_rng = np.random.default_rng([seed, 0])
+    names = (name_pool(names_rng, SURNAME_POOL, [2, 3, 3, 4]), name_pool(names_rng, FIRST_NAME_POOL, [2, 2, 3]), name_pool(names_rng, FIRST_NAME_POOL, [2, 3, 3]))
+    noise = {kind: min(1.0, chance * noise_scale) for kind, chance in NOISE.items()}
+
+    outfiles = dict()
+    counts = dict()
+    for name, file_name, header in OUTPUT_FILES:
+        outfiles[name] = open(out_dir + os.sep + file_name, 'wt')
+        outfiles[name].write("\t".join(header) + "\n")
+        counts[name] = 0
+
+    patients = 0
+    mrn_offset = 0
+    family_offset = 0
+    block = 0
+    while patients < n_patients:
+        block += 1
+        rng = np.random.default_rng([seed, block])
+        n_families = min(block_families, int((n_patients - patients) / (PEOPLE_PER_FAMILY * coverage) * 1.05) + 10)
+        tables = generate_block(rng, n_families, mrn_offset, family_offset, coverage, noise, names)
+
+        # Stop at the family that reaches n_patients
+        pedigree = tables['pedigree']
+        family_patients = pedigree.groupby('family_id')['in_ehr'].sum()
+        keep_families = family_patients.index[:int(np.searchsorted(np.cumsum(family_patients.to_numpy()), n_patients - patients)) + 1]
+        if len(keep_families) < n_families:
+            keep_mrns = set(pedigree.loc[pedigree['family_id'].isin(keep_families), 'MRN'])
+            for name, file_name, header in OUTPUT_FILES:
+                tables[name] = tables[name][tables[name][header[0]].isin(keep_mrns)]
+
+        for name, file_name, header in OUTPUT_FILES:
+            tables[name].to_csv(outfiles[name], sep='\t', header=False, index=False)
+            counts[name] += len(tables[name].index)
+
+        patients += int(tables['pedigree']['in_ehr'].sum())
+        mrn_offset += len(pedigree.index)
+        family_offset += n_families
+        print("\tBlock " + str(block) + ":\t" + str(patients) + " patients")
+
+    for outfile in outfiles.values():
+        outfile.close()
+
+    return counts
+
+
+def parse_arguments():
+    """
+    Parses Command line arguments
+
+    Returns:
+        args: argpase object of input arguemnts
+    """
+
+    parser = argparse.ArgumentParser(description='Generates synthetic PT, EC, Demographic, Mother/Child and Other Familial link files with their true pedigree')
+
+    parser.add_argument('--patients', action='store', default=10000,
+                        dest='patients',
+                        type=int,
+                        help='Number of patients to generate')
+
+    parser.add_argument('--out_dir', action='store',
+                        dest='out_dir',
+                        type=str,
+                        required=True,
+                        help='Output Directory for the generated files')
+
+    parser.add_argument('--seed', action='store', default=1,
+                        dest='seed',
+                        type=int,
+                        help='Seed of the random streams.  The same seed and arguments give the same files')
+
+    parser.add_argument('--coverage', action='store', default=0.85,
+                        dest='coverage',
+                        type=float,
+                        help='Chance a family member is a patient, the rest only appear as emergency contacts')
+
+    parser.add_argument('--noise', action='store', default=1.0,
+                        dest='noise',
+                        type=float,
+                        help='Factor on the chance of every kind of noise, 0 for clean data')
+
+    parser.add_argument('--block_families', action='store', default=50000,
+                        dest='block_families',
+                        type=int,
+                        help='Families generated and written at a time.  Bounds memory')
+
+    return parser.parse_args()
+
+
+def main():
+    cli_args = parse_arguments()
+    print(cli_args)
+
+    counts = generate(cli_args.patients, cli_args.out_dir, cli_args.seed, cli_args.coverage, cli_args.noise, cli_args.block_families)
+    for name, file_name, header in OUTPUT_FILES:
+        print(file_name + ":\t" + str(counts[name]) + " rows")
+
+    return
+
+
+if __name__ == '__main__':
+    main()
+    exit()
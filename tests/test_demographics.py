@@ -0,0 +1,56 @@
+import os, sys
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+import equivalence_RIFTEHR
+import run_RIFTEHR
+
+
+"""
+Checks Demographic rows without an MRN do not change the demographics of
+other patients.
+"""
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLE_DIR = ROOT_DIR + os.sep + 'example_files'
+
+
+def test_build_demographics_skips_missing_mrns():
+    # MRN id -1 is a row without an MRN, it must not land on the last id
+    mrns = np.array([0, 2, -1])
+    sexes = pd.Series(['M', 'F', 'M'])
+    birth_years = np.array([1990, 1993, 1950], dtype=np.int16)
+
+    dg_dict = run_RIFTEHR.build_demographics(mrns, sexes, birth_years, 3)
+
+    assert dict(dg_dict) == {0: ('M', 1990), 2: ('F', 1993)}
+
+
+def test_demographic_row_without_mrn(tmp_path):
+    in_dir = tmp_path / 'in'
+    out_dir = tmp_path / 'out'
+    in_dir.mkdir()
+    out_dir.mkdir()
+
+    inputs = dict()
+    for argument, file_name in equivalence_RIFTEHR.EXAMPLE_INPUTS.items():
+        with open(EXAMPLE_DIR + os.sep + file_name, 'rt', newline='') as infile:
+            text = infile.read()
+        if argument == 'dg_file':
+            text = text.rstrip('\r\n') + '\n\t1950\tM\n'
+        (in_dir / file_name).write_text(text, newline='')
+        inputs[argument] = str(in_dir / file_name)
+
+    command = [sys.executable, ROOT_DIR + os.sep + 'run_RIFTEHR.py', '--out_dir', str(out_dir), '--keep_intermediates']
+    for argument, in_file in inputs.items():
+        command += ['--' + argument, in_file]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    # The row is dropped, every relation and age difference is unchanged
+    for file_name in ['df_cumc_patient_wdg.tmp.tsv', 'final_patient_relations_w_infered.tsv', 'all_family_IDS.tsv']:
+        expected = equivalence_RIFTEHR.read_rows(EXAMPLE_DIR + os.sep + file_name)
+        actual = equivalence_RIFTEHR.read_rows(str(out_dir / file_name))
+        assert not equivalence_RIFTEHR.diff_rows(expected, actual, 20), file_name
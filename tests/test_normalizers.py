@@ -0,0 +1,132 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import run_RIFTEHR
+import synthetic_ehr
+
+
+"""
+Checks the vectorized normalizers give the same results as the scalar ones
+they replace, on the example files, synthetic extracts and edge cases.
+"""
+
+
+EXAMPLE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep + 'example_files'
+
+# Vectorized normalizer, scalar normalizer and the (file, column) pairs normalized by them
+NORMALIZERS = [
+    (run_RIFTEHR.clean_split_name_series, run_RIFTEHR.clean_split_names, [('pt_file.tsv', 'FirstName'), ('pt_file.tsv', 'LastName'), ('ec_file.tsv', 'EC_FirstName'), ('ec_file.tsv', 'EC_LastName')]),
+    (run_RIFTEHR.normalize_phone_num_series, run_RIFTEHR.normalize_phone_num, [('pt_file.tsv', 'PhoneNumber'), ('ec_file.tsv', 'EC_PhoneNumber')]),
+    (run_RIFTEHR.normalize_zip_code_series, run_RIFTEHR.normalize_zip_code, [('pt_file.tsv', 'Zipcode'), ('ec_file.tsv', 'EC_Zipcode')]),
+    (run_RIFTEHR.fix_sex_series, run_RIFTEHR.fix_sex, [('pt_demog.tsv', 'Sex')]),
+]
+NORMALIZER_IDS = [x[1].__name__ for x in NORMALIZERS]
+
+EDGE_CASES = [
+    # empty and whitespace only
+    '', ' ', '   ', '\t', ' \t ', '\n',
+    # non ASCII
+    'José', 'Zoë', 'Ærøskøbing', 'Łukasz', 'ﬁnn', '李', 'Ñ', 'é', '١٢٣٤٥', '２１２５５５１２３４', '10014 ', ' 212-555-1234',
+    # names
+    'Mary-Jane', ' Smith ', 'O\'Brien', 'van der Berg', 'NONE', ' null ', 'None-', 'x', 'F', 'f ', ' m', 'Male', 'female', 'U', 'Unknown',
+    # phone numbers, 11 digits with a leading 1 and extentions
+    '212-555-1234', '(212) 555-1234', '212.555.1234', '+1 212 555 1234', '1-212-555-1234', '12125551234', '012125551234',
+    '212-555-1234 x12', '212-555-1234x', '212-555-1234 ext. 5', '212-555-1234 Ext 5', '212-555-1234,5', '212-555-1234#5', '*212*555*1234',
+    '2125551234e', 'e2125551234', '555-1234', '000-000-0000', '1-000-000-0000', '212-555-12a4', '212 555 1234 ', ' 2125551234',
+    # zip codes, ZIP+4 and partial
+    '10014', '10014-1234', '100141234', ' 10014 ', '(10014)', '1001', '1001a', 'a10014', '10014-', '1.0014', '02134', '00000', '10014 #2',
+]
+
+
+def scalar_results(scalar, values):
+    """Results of the scalar normalizer, or the type of error it raises"""
+
+    results = list()
+    for value in values:
+        try:
+            results.append(scalar(value))
+        except Exception as error:
+            results.append(type(error))
+
+    return results
+
+
+def vectorized_results(vectorized, values):
+    """Results of the vectorized normalizer, or the type of error it raises"""
+
+    try:
+        return vectorized(pd.Series(values, dtype=object)).tolist()
+    except Exception as error:
+        return [type(error)] * len(values)
+
+
+def assert_same(vectorized, scalar, values):
+    """Asserts the normalizers agree on every value, reporting those they do not"""
+
+    expected = scalar_results(scalar, values)
+    actual = vectorized_results(vectorized, values)
+    different = [(value, x, y) for value, x, y in zip(values, expected, actual) if x != y]
+
+    assert not different, different
+
+
+@pytest.fixture(scope='module')
+def synthetic_dir(tmp_path_factory):
+    out_dir = str(tmp_path_factory.mktemp('synthetic'))
+    synthetic_ehr.generate(2000, out_dir, seed=3)
+
+    return out_dir
+
+
+def read_column(file_location, column):
+    return pd.read_csv(file_location, sep='\t', dtype=str, keep_default_na=False)[column].tolist()
+
+
+@pytest.mark.parametrize('vectorized, scalar, columns', NORMALIZERS, ids=NORMALIZER_IDS)
+def test_example_values(vectorized, scalar, columns):
+    for file_name, column in columns:
+        assert_same(vectorized, scalar, read_column(EXAMPLE_DIR + os.sep + file_name, column))
+
+
+@pytest.mark.parametrize('vectorized, scalar, columns', NORMALIZERS, ids=NORMALIZER_IDS)
+def test_synthetic_values(vectorized, scalar, columns, synthetic_dir):
+    for file_name, column in columns:
+        assert_same(vectorized, scalar, read_column(synthetic_dir + os.sep + file_name, column))
+
+
+@pytest.mark.parametrize('vectorized, scalar, columns', NORMALIZERS, ids=NORMALIZER_IDS)
+def test_edge_cases(vectorized, scalar, columns):
+    assert_same(vectorized, scalar, EDGE_CASES)
+
+
+@pytest.mark.parametrize('vectorized, scalar, columns', NORMALIZERS, ids=NORMALIZER_IDS)
+def test_long_values(vectorized, scalar, columns):
+    # Longer than the vectorized normalizers lay out, mixed with short ones
+    values = ['9' * (run_RIFTEHR.MAX_VECTOR_WIDTH + 1), ' ' * run_RIFTEHR.MAX_VECTOR_WIDTH + 'F', '212-555-1234', '10014']
+    assert_same(vectorized, scalar, values)
+
+
+@pytest.mark.parametrize('vectorized, scalar, columns', NORMALIZERS, ids=NORMALIZER_IDS)
+def test_missing_values(vectorized, scalar, columns):
+    assert scalar_results(scalar, [np.nan]) == vectorized_results(vectorized, [np.nan])
+    assert scalar_results(scalar, [None]) == vectorized_results(vectorized, [None])
+
+
+@pytest.mark.parametrize('vectorized, scalar, columns', NORMALIZERS, ids=NORMALIZER_IDS)
+def test_apply_vectorized(vectorized, scalar, columns):
+    # The vectorized and scalar halves of apply_vectorized agree on every row
+    values = EDGE_CASES + ['Smith', '212-555-1234', '10014', 'M']
+    vectorized_codes = {run_RIFTEHR.clean_split_names: run_RIFTEHR.clean_split_name_codes,
+                        run_RIFTEHR.normalize_phone_num: run_RIFTEHR.normalize_phone_num_codes,
+                        run_RIFTEHR.normalize_zip_code: run_RIFTEHR.normalize_zip_code_codes,
+                        run_RIFTEHR.fix_sex: run_RIFTEHR.fix_sex_codes}[scalar]
+    strings = pd.Series(values, index=np.arange(len(values)) * 2, dtype=object, name='values')
+
+    normalized = run_RIFTEHR.apply_vectorized(strings, vectorized_codes, scalar)
+
+    assert normalized.index.equals(strings.index)
+    assert normalized.name == 'values'
+    assert_same(lambda x: run_RIFTEHR.apply_vectorized(x, vectorized_codes, scalar), scalar, values)
@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+
+import synthetic_ehr
+
+
+"""
+Checks the true pedigree of the synthetic data is consistent, whole
+families are kept when a block is cut short.
+"""
+
+
+def test_grandchildren_in_parents_family():
+    names_rng = np.random.default_rng([1, 0])
+    surnames = synthetic_ehr.name_pool(names_rng, 1000, [2, 3])
+    first_names = (synthetic_ehr.name_pool(names_rng, 100, [2, 3]), synthetic_ehr.name_pool(names_rng, 100, [2, 3]))
+
+    people = synthetic_ehr.simulate_families(np.random.default_rng(5), 1000, 0.85, surnames, first_names)
+
+    g3 = people[people['generation'] == 3]
+    assert len(g3.index) > 0
+    family = people['family'].to_numpy()
+    assert (g3['family'].to_numpy() == family[g3['father'].to_numpy()]).all()
+    assert (g3['family'].to_numpy() == family[g3['mother'].to_numpy()]).all()
+
+
+def test_cut_block_keeps_whole_families(tmp_path):
+    # Far fewer patients than the block's families hold, so the block is cut
+    synthetic_ehr.generate(5000, str(tmp_path), seed=1)
+
+    pedigree = pd.read_csv(str(tmp_path / 'true_pedigree.tsv'), sep='\t')
+    relations = pd.read_csv(str(tmp_path / 'true_relations.tsv'), sep='\t')
+    mrns = set(pedigree['MRN'])
+
+    for column in ['father_MRN', 'mother_MRN', 'spouse_MRN']:
+        assert pedigree[column].dropna().isin(mrns).all(), column
+    for column in ['empi_or_mrn', 'relation_empi_or_mrn']:
+        assert relations[column].isin(mrns).all(), column
+
+    by_mrn = pedigree.set_index('MRN')
+    g3 = pedigree[pedigree['generation'] == 3]
+    assert (g3['family_id'].to_numpy() == by_mrn.loc[g3['father_MRN'], 'family_id'].to_numpy()).all()